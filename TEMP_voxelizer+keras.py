@@ -4,10 +4,10 @@
 
 
 import numpy as np
-import tensorflow as tf
 
-elements_hash = {'C': 1, 'O': 2, 'N': 3, 'P': 4, 'S': 5, 'H': 6}
+from featurizer import ELEMENTS_HASH as elements_hash, element_codes
 from process_pdb import process_pdb
+from voxelizer import Voxelizer
 
 
 
@@ -49,9 +49,7 @@ def process_pdb_file(filepath, hashing):
     pdb_data = pdb[['orth_x', 'orth_y', 'orth_z', 'element_plus_charge']].to_numpy()
     
     # Map element charges
-    # Create a vectorized function for mapping elements
-    map_element = np.vectorize(lambda x: hashing.get(x, 7))  # Default to 7 if not found
-    pdb_data[:, 3] = map_element(pdb_data[:, 3])
+    pdb_data[:, 3] = element_codes(pdb_data[:, 3], hashing)  # Default to 7 if not found
     
     return pdb_data
 
@@ -83,107 +81,6 @@ alldata = process_all_pdb_files(list_of_data, elements_hash)
 
 
 
-class Voxelizer:
-    def __init__(self, datasets, voxel_size=1.0):
-        self.datasets = datasets
-        self.voxel_size = voxel_size
-
-        # Use the provided global_min and global_max
-        self.global_min, self.global_max = self.compute_global_boundaries()
-
-        # Compute voxel grid dimensions
-        self.compute_voxel_dimensions()
-
-    def compute_global_boundaries(self):
-        # Combine all data points from every dataset to find global min and max
-        all_points = np.vstack([data[:, :3] for data in self.datasets])
-        global_min = np.min(all_points, axis=0)
-        global_max = np.max(all_points, axis=0)
-        return global_min, global_max
-
-    def compute_voxel_dimensions(self):
-        # Calculate voxel grid dimensions based on global min, max, and voxel size
-        self.x_dim = int(np.ceil((self.global_max[0] - self.global_min[0]) / self.voxel_size))
-        self.y_dim = int(np.ceil((self.global_max[1] - self.global_min[1]) / self.voxel_size))
-        self.z_dim = int(np.ceil((self.global_max[2] - self.global_min[2]) / self.voxel_size))
-
-    def voxelize(self, data):
-        data = np.array(data)
-
-        # Shift data so that global_min corresponds to index 0
-        shifted_data = data[:, :3] - self.global_min
-
-        # Convert coordinates to voxel indices
-        x_indices = np.floor(shifted_data[:, 0] / self.voxel_size).astype(int)
-        y_indices = np.floor(shifted_data[:, 1] / self.voxel_size).astype(int)
-        z_indices = np.floor(shifted_data[:, 2] / self.voxel_size).astype(int)
-
-        # Ensure that indices are within grid dimensions
-        x_indices = np.clip(x_indices, 0, self.x_dim - 1)
-        y_indices = np.clip(y_indices, 0, self.y_dim - 1)
-        z_indices = np.clip(z_indices, 0, self.z_dim - 1)
-
-        # Create an empty voxel grid
-        voxel_grid = np.zeros((self.x_dim, self.y_dim, self.z_dim), dtype=np.float32)
-      
-        # Assign density values to voxel grid
-        for i in range(len(data)):
-            voxel_grid[x_indices[i], y_indices[i], z_indices[i]] = 1
-
-        return voxel_grid
-    
-    def indexer(self, data):
-        data = np.array(data)
-
-        # Shift data so that global_min corresponds to index 0
-        shifted_data = data[:, :3] - self.global_min
-
-        # Convert coordinates to voxel indices
-        x_indices = np.floor(shifted_data[:, 0] / self.voxel_size).astype(int)
-        y_indices = np.floor(shifted_data[:, 1] / self.voxel_size).astype(int)
-        z_indices = np.floor(shifted_data[:, 2] / self.voxel_size).astype(int)
-
-        # Ensure that indices are within grid dimensions
-        x_indices = np.clip(x_indices, 0, self.x_dim - 1)
-        y_indices = np.clip(y_indices, 0, self.y_dim - 1)
-        z_indices = np.clip(z_indices, 0, self.z_dim - 1)
-       
-        indicies = []
-        
-        # Assign density values to voxel grid
-        for i in range(len(data)):
-            indicies.append([x_indices[i], y_indices[i], z_indices[i]])
-
-        return indicies
-    
-    def valuer(self, data):
-        voxel_values_for_grid = []
-        for i in range(len(data)):
-            voxel_values_for_grid.append(data[i,3])
-        return voxel_values_for_grid
-    
-    def revert_voxels_to_coordinates(self, voxel_grid):
-        # Compute voxel centers
-        x_coords = np.linspace(self.global_min[0] + self.voxel_size / 2, 
-                               self.global_max[0] - self.voxel_size / 2, self.x_dim)
-        y_coords = np.linspace(self.global_min[1] + self.voxel_size / 2, 
-                               self.global_max[1] - self.voxel_size / 2, self.y_dim)
-        z_coords = np.linspace(self.global_min[2] + self.voxel_size / 2, 
-                               self.global_max[2] - self.voxel_size / 2, self.z_dim)
-        
-        # Get indices where voxel_grid is not zero
-        nonzero_indices = np.nonzero(voxel_grid)
-        
-        # Extract coordinates and corresponding element values of non-zero voxels
-        coordinates = []
-        for x, y, z in zip(*nonzero_indices):
-            coord = [x_coords[x], y_coords[y], z_coords[z]]
-            density = voxel_grid[x, y, z]
-            coordinates.append(coord + [density])
-        
-        return np.array(coordinates)
-
-
 # Example usage:
 
 voxelizer = Voxelizer(alldata, voxel_size=0.5)
@@ -206,33 +103,46 @@ list_of_data[194]
 
 
 
-pocket_dense_tensors = []
-
-ligand_dense_tensors = []
-
-for i in range(0,len(alldata[2:])):
-    print(i)
-    data_value = voxelizer.valuer(alldata[i])
-    data_index = voxelizer.indexer(alldata[i])
-    data_sparse_tensor = tf.sparse.SparseTensor(indices=data_index, values=data_value, dense_shape=input_shape_raw) # might change this so that it draws the shape from the voxelizer funtion
-    data_sparse_tensor = tf.sparse.reorder(data_sparse_tensor)
-    dense_tensor = tf.sparse.to_dense(data_sparse_tensor)
-    if i % 2 == 0:
-        pocket_dense_tensors.append(dense_tensor)
-    if i % 2 != 0:
-        ligand_dense_tensors.append(dense_tensor)
-        
-pocket_dense_tensors = tf.stack(pocket_dense_tensors)
-ligand_dense_tensors = tf.stack(ligand_dense_tensors)
-
-#temporary configuration of channels
-pocket_tensors = tf.expand_dims(pocket_dense_tensors, axis=-1)
-ligand_tensors = ligand_dense_tensors
+# TensorFlow is only imported once the PDB files are parsed and voxelized
+import os
+import tensorflow as tf
+from tensors import as_tensor
+
+# Pockets and ligands alternate in alldata; the last pair is left for testing
+pocket_data = alldata[0:len(alldata)-2:2]
+ligand_data = alldata[1:len(alldata)-2:2]
+
+# Splits from ligand_split.py keep every ligand cluster on one side, so near-identical ligands
+# are not in both training and validation; without the file the split is random
+SPLITS_FILE = 'ligand_splits.jsonl'
+
+if os.path.exists(SPLITS_FILE):
+    from ligand_split import load_splits, complex_split, ligand_het_id
+    splits = load_splits(SPLITS_FILE)
+    # Files are named by PDB id (i.e. 8e4l_binding_site.pdb), so the HET id is read from the ligand file
+    names = [os.path.basename(f)[:-len('_binding_site.pdb')] for f in list_of_data[0::2]][:len(pocket_data)]
+    het_ids = [ligand_het_id(f) for f in list_of_data[1::2]][:len(pocket_data)]
+    split_of = np.array([complex_split(name, splits, het_id) for name, het_id in zip(names, het_ids)])
+    train, val = np.flatnonzero(split_of == 'train'), np.flatnonzero(split_of == 'val')
+    print(f'** {len(train)} training and {len(val)} validation complexes, {(split_of == None).sum()} without a split left out')
+    if not len(train) or not len(val):
+        raise ValueError(f'{SPLITS_FILE} gives {len(train)} training and {len(val)} validation complexes; '
+                         f'its names must be complexes (i.e. 8e4l_LIG) or HET ids of the ligand files')
+else:
+    from sklearn.model_selection import train_test_split
+    # Split data into training and validation sets (80% training, 20% validation)
+    train, val = train_test_split(np.arange(len(pocket_data)), test_size=0.2, random_state=42)
+
+# Each split is voxelized straight into one aligned batch (channels last for the pockets),
+# which TensorFlow wraps without a copy
+pocket_train = as_tensor(voxelizer.batch([pocket_data[i] for i in train], channels='last'))
+pocket_val = as_tensor(voxelizer.batch([pocket_data[i] for i in val], channels='last'))
+ligand_train = as_tensor(voxelizer.batch([ligand_data[i] for i in train], channels=None))
+ligand_val = as_tensor(voxelizer.batch([ligand_data[i] for i in val], channels=None))
 
 
 
 
-import tensorflow as tf
 from tensorflow import keras
 
 input_shape = input_shape_raw +(1,)
@@ -254,23 +164,6 @@ model.summary()
 
 
 
-from sklearn.model_selection import train_test_split
-import tensorflow as tf
-
-# Convert TensorFlow tensors to NumPy arrays
-pocket_tensors_np = pocket_tensors.numpy()  # Convert to NumPy if it's a Tensor
-ligand_tensors_np = ligand_tensors.numpy()  # Convert to NumPy if it's a Tensor
-
-# Split data into training and validation sets (80% training, 20% validation)
-pocket_train_np, pocket_val_np, ligand_train_np, ligand_val_np = train_test_split(
-    pocket_tensors_np, ligand_tensors_np, test_size=0.2, random_state=42)
-
-# Optionally convert the NumPy arrays back to TensorFlow tensors
-pocket_train = tf.convert_to_tensor(pocket_train_np)
-pocket_val = tf.convert_to_tensor(pocket_val_np)
-ligand_train = tf.convert_to_tensor(ligand_train_np)
-ligand_val = tf.convert_to_tensor(ligand_val_np)
-
 # Now you can train the model with validation data
 from tensorflow.keras.callbacks import EarlyStopping
 
@@ -290,10 +183,17 @@ history = model.fit(
 
 
 
-loss, accuracy = model.evaluate(pocket_tensors, ligand_tensors)
+# Both splits, batched from the tensors above rather than concatenated into a new one
+everything = tf.data.Dataset.from_tensor_slices((pocket_train, ligand_train)).concatenate(
+    tf.data.Dataset.from_tensor_slices((pocket_val, ligand_val))).batch(3)
+loss, accuracy = model.evaluate(everything)
 print(f"Loss: {loss}")
 print(f"Accuracy: {accuracy}")
 
+# The model and the grid it was trained on, for scoring new pockets with inference.py
+model.save('pocket_model.keras')
+voxelizer.save_spec('pocket_model.grid.json')
+
 
 
 
@@ -321,33 +221,11 @@ if 'accuracy' in history.history:
 
 
 
-# TEST POCKET
-test_data_value = voxelizer.valuer(alldata[len(alldata)-2])
-test_data_index = voxelizer.indexer(alldata[len(alldata)-1])
-
-test_data_sparse_tensor = tf.sparse.SparseTensor(indices=data_index, values=data_value, dense_shape=input_shape_raw) # might change this so that it draws the shape from the voxelizer funtion
-test_data_sparse_tensor = tf.sparse.reorder(data_sparse_tensor)
-
-test_dense_tensor = tf.sparse.to_dense(data_sparse_tensor)
-        
-test_pocket_dense_tensor = test_dense_tensor
-
-
-#TEST LIGAND
-test_data_value = voxelizer.valuer(alldata[5])
-test_data_index = voxelizer.indexer(alldata[5])
-
-test_data_sparse_tensor = tf.sparse.SparseTensor(indices=data_index, values=data_value, dense_shape=input_shape_raw) # might change this so that it draws the shape from the voxelizer funtion
-test_data_sparse_tensor = tf.sparse.reorder(data_sparse_tensor)
-
-test_dense_tensor = tf.sparse.to_dense(data_sparse_tensor)
-        
-test_ligand_dense_tensor = test_dense_tensor
-
-
-
-test_pocket_tensor = tf.expand_dims(test_pocket_dense_tensor, axis=-1)
-test_ligand_tensor = test_ligand_dense_tensor
+# TEST POCKET AND LIGAND
+# The last pair of alldata, voxelized like the training batches: a batch of one pocket
+# (channels last) for model.predict and the matching ligand grid
+test_pocket_tensor = as_tensor(voxelizer.batch([alldata[len(alldata)-2]], channels='last'))
+test_ligand_tensor = as_tensor(voxelizer.batch([alldata[len(alldata)-1]], channels=None))
 
 
 
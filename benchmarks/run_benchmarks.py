@@ -0,0 +1,370 @@
+import numpy as np
+import pandas as pd
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+REPO = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from synthetic_pdb import _atom_line, write_synthetic_pdb
+from process_pdb import process_pdb
+from binding_site import split_ligand_protein, binding_site_atoms_reference, binding_site_atoms, StructureIndex, complete_residues, write_pdb
+from structure import read_pdb
+from voxelizer import Voxelizer
+
+BASELINE_DIR = Path(__file__).resolve().parent / 'baselines'
+
+def _digest(*arrays):
+    """
+    Hashes arrays/strings into a short hex digest used to compare outputs between runs.
+    """
+    h = hashlib.sha256()
+    for array in arrays:
+        if isinstance(array, (str, bytes)):
+            h.update(array.encode() if isinstance(array, str) else array)
+        else:
+            array = np.ascontiguousarray(array)
+            h.update(str(array.dtype).encode())
+            h.update(array.tobytes())
+    return h.hexdigest()[:16]
+
+def _atoms_digest(df):
+    keys = df[['chain', 'res_seq', 'atom_name']].astype(str).agg(':'.join, axis=1).to_numpy()
+    return _digest('\n'.join(sorted(keys)))
+
+def _residues_digest(df):
+    keys = df[['chain', 'res_seq', 'residue']].astype(str).agg(':'.join, axis=1).unique()
+    return _digest('\n'.join(sorted(keys)))
+
+
+'''
+Stages
+
+Each stage takes the shared context (which holds the outputs of the previous stages),
+returns its output and a digest of that output. A stage can have several implementations:
+'reference' is the current code and every other implementation is checked against it.
+'''
+
+def stage_parse(ctx):
+    pdb = process_pdb(ctx['input'])
+    coords = np.round(pdb[['orth_x', 'orth_y', 'orth_z']].to_numpy(dtype=float), 3)
+    return pdb, _digest(_atoms_digest(pdb), coords)
+
+def stage_split(ctx):
+    ligand, protein, primary_chain = split_ligand_protein(ctx['parse'], ctx['hetatm'])
+    return (ligand, protein), _digest(_atoms_digest(ligand), _atoms_digest(protein))
+
+def stage_neighbor_search(ctx):
+    ligand, protein = ctx['split']
+    bs_atoms = binding_site_atoms_reference(ligand, protein, ctx['distance'])
+    return bs_atoms, _residues_digest(bs_atoms)
+
+def stage_neighbor_search_kdtree(ctx):
+    ligand, protein = ctx['split']
+    bs_atoms = binding_site_atoms(ligand, protein, ctx['distance'], StructureIndex(ctx['parse']))
+    return bs_atoms, _residues_digest(bs_atoms)
+
+def stage_complete_residues(ctx):
+    ligand, protein = ctx['split']
+    bindingsite = complete_residues(protein, ctx['neighbor_search'])
+    return bindingsite, _atoms_digest(bindingsite)
+
+def stage_write_pdb(ctx):
+    output_file = os.path.join(ctx['workdir'], 'binding_site.pdb')
+    write_pdb(ctx['complete_residues'], output_file)
+    with open(output_file, 'rb') as f:
+        return output_file, _digest(f.read())
+
+def stage_bonds_protein_df(ctx):
+    from pdb_pandas import bonds_protein_df
+    df = ctx['complete_residues'].copy().reset_index(drop=True)
+    df = bonds_protein_df(SimpleNamespace(filepath=ctx['write_pdb'], df=df))
+    bonds = sorted(tuple(bond) for bonds in df['bond'] for bond in bonds)
+    return df, _digest(np.array(bonds, dtype=np.int64), np.concatenate([np.array(o, dtype=float) for o in df['bond_order']] or [np.zeros(0)]))
+
+def stage_dgl_graph(ctx):
+    from se3_prep import ProcessedPDB, dgl_graph
+    df = ctx['bonds_protein_df'].copy()
+    df['hashing'] = df['element_plus_charge'].map({'H': 1, 'C': 2, 'O': 3, 'N': 4, 'P': 5, 'S': 6}).fillna(7)
+    g = dgl_graph([ProcessedPDB(ctx['write_pdb'], df)])[0]
+    src, dst = g.edges()
+    return g, _digest(src.numpy(), dst.numpy(), g.ndata['coords'].numpy())
+
+def stage_voxelize(ctx):
+    ligand, protein = ctx['split']
+    datasets = [df[['orth_x', 'orth_y', 'orth_z']].to_numpy(dtype=float) for df in (ctx['complete_residues'], ligand)]
+    voxelizer = Voxelizer(datasets, voxel_size=ctx['voxel_size'])
+    grids = [voxelizer.voxelize(data) for data in datasets]
+    return grids, _digest(*grids)
+
+# stage name -> {implementation name: function}
+STAGES = {
+    'parse': {'reference': stage_parse},
+    'split': {'reference': stage_split},
+    'neighbor_search': {'reference': stage_neighbor_search, 'kdtree': stage_neighbor_search_kdtree},
+    'complete_residues': {'reference': stage_complete_residues},
+    'write_pdb': {'reference': stage_write_pdb},
+    'bonds_protein_df': {'reference': stage_bonds_protein_df},
+    'dgl_graph': {'reference': stage_dgl_graph},
+    'voxelize': {'reference': stage_voxelize},
+}
+
+# Stages that become impractically slow on large structures with the reference implementation
+SLOW_STAGES = {'neighbor_search': 'reference', 'bonds_protein_df': 'reference'}
+
+def measure(fn, ctx, repeat=3):
+    """
+    Times a stage and measures its peak memory.
+
+    The stage is run `repeat` times for timing and once more under tracemalloc
+    (which slows things down) for the peak memory of its allocations.
+
+    Returns:
+        tuple: (output, digest, median seconds, peak MB)
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output, digest = fn(ctx)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn(ctx)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return output, digest, float(np.median(times)), peak / 1e6
+
+def run(sizes, ligand_sizes, stages=None, repeat=3, distance=3.5, voxel_size=0.5, seed=0,
+        max_reference_atoms=50000, workdir=None):
+    """
+    Runs every stage on synthetic complexes of each size.
+
+    Args:
+        sizes (list of int): total number of atoms of the synthetic complexes.
+        ligand_sizes (list of int): number of ligand atoms.
+        stages (list of str): stages to report; every stage still runs if a later one needs it.
+        repeat (int): number of timed repeats per stage.
+        distance (float): binding site distance in Å.
+        voxel_size (float): voxel size in Å.
+        seed (int): random seed of the synthetic complexes.
+        max_reference_atoms (int): slow reference stages are skipped above this size.
+        workdir (str): directory for the synthetic files; a temporary directory by default.
+
+    Returns:
+        dict: results keyed by 'stage[implementation]|atoms|ligand_atoms'.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = workdir or tmp
+        os.makedirs(workdir, exist_ok=True)
+        for n_atoms in sizes:
+            for ligand_atoms in ligand_sizes:
+                input_file = os.path.join(workdir, f'synthetic_{n_atoms}_{ligand_atoms}_{seed}.pdb')
+                if not os.path.exists(input_file):
+                    write_synthetic_pdb(input_file, n_atoms=n_atoms, ligand_atoms=ligand_atoms, seed=seed)
+
+                ctx = {'input': input_file, 'hetatm': 'LIG', 'distance': distance,
+                       'voxel_size': voxel_size, 'workdir': workdir}
+
+                for stage, implementations in STAGES.items():
+                    for impl, fn in implementations.items():
+                        key = f'{stage}[{impl}]|{n_atoms}|{ligand_atoms}'
+                        if SLOW_STAGES.get(stage) == impl and n_atoms > max_reference_atoms and len(implementations) > 1:
+                            continue
+                        try:
+                            output, digest, seconds, peak_mb = measure(fn, ctx, repeat if (stages is None or stage in stages) else 1)
+                        except ImportError as e:
+                            print(f'** skipping {key}: {e}')
+                            break
+                        except KeyError as e:
+                            print(f'** skipping {key}: needs stage {e}')
+                            break
+                        if impl == 'reference' or stage not in ctx:
+                            ctx[stage] = output
+                        if stages is None or stage in stages:
+                            results[key] = {'seconds': seconds, 'peak_mb': peak_mb, 'digest': digest}
+                            print(f'{key:<50} {seconds:>10.4f} s {peak_mb:>10.1f} MB  {digest}')
+    return results
+
+def check(results):
+    """
+    Compares the output of every implementation against the reference implementation of the same stage.
+
+    Returns:
+        list of str: the mismatching results.
+    """
+    mismatches = []
+    for key, result in results.items():
+        stage_impl, n_atoms, ligand_atoms = key.split('|')
+        stage = stage_impl.split('[')[0]
+        reference = results.get(f'{stage}[reference]|{n_atoms}|{ligand_atoms}')
+        if reference and result['digest'] != reference['digest']:
+            mismatches.append(key)
+    return mismatches
+
+def check_formal_charges(workdir=None):
+    """
+    Checks that the formal charges in columns 78:80 of atom lines (i.e. N1+ and O1-) reach
+    the 'formal_charge' feature through both parsers.
+
+    Returns:
+        list of str: the parsers that lose them.
+    """
+    from featurizer import FEATURES, atom_features
+
+    lines = [_atom_line('HETATM', 1, 'N1', 'LIG', 'A', 1, 0.0, 0.0, 0.0, 'N', '1+'),
+             _atom_line('HETATM', 2, 'O1', 'LIG', 'A', 1, 1.5, 0.0, 0.0, 'O', '1-')]
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(workdir or tmp, 'charges.pdb')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\nEND\n')
+        for parser, df in (('process_pdb', process_pdb(path)), ('read_pdb', read_pdb(path).all().to_dataframe())):
+            charges = atom_features(df)[:, FEATURES.index('formal_charge')].tolist()
+            if charges != [1.0, -1.0]:
+                failures.append(f'{parser} gives formal charges {charges} for N1+ and O1-')
+    return failures
+
+# A molblock as RDKit writes an unnamed molecule: an empty title line, then the header
+UNTITLED_MOLBLOCK = """
+     RDKit          3D
+
+  3  2  0  0  0  0  0  0  0  0999 V2000
+    0.0000    0.0000    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0
+    1.5000    0.0000    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0
+    2.2000    1.2000    0.0000 O   0  0  0  0  0  0  0  0  0  0  0  0
+  1  2  1  0
+  2  3  1  0
+M  END
+$$$$
+"""
+
+def check_untitled_molblocks(workdir=None):
+    """
+    Checks that .sdf molblocks with an empty title line (RDKit's default) are read with
+    their header in place.
+
+    Returns:
+        list of str: the readers that misread them.
+    """
+    from electrostatics import read_sdf_charges
+    from pose_screen import read_sdf_poses
+
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(workdir or tmp, 'untitled.sdf')
+        with open(path, 'w') as f:
+            f.write(UNTITLED_MOLBLOCK * 2)
+        for reader, atoms_of in ((read_sdf_poses, lambda pose: len(pose[2])), (read_sdf_charges, lambda molecule: len(molecule[1]))):
+            try:
+                atoms = [atoms_of(item) for item in reader(path)]
+            except ValueError as e:
+                atoms = repr(e)
+            if atoms != [3, 3]:
+                failures.append(f'{reader.__name__} reads {atoms} atoms from two untitled 3 atom molblocks')
+    return failures
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Compares results with a saved baseline.
+
+    A result is a regression when it is slower than the baseline by more than `tolerance`
+    (0.25 = 25 %) and a mismatch when its output digest differs from the baseline's.
+
+    Returns:
+        tuple: (list of regressions, list of mismatches)
+    """
+    regressions, mismatches = [], []
+    for key, result in results.items():
+        base = baseline['results'].get(key)
+        if base is None:
+            continue
+        ratio = result['seconds'] / base['seconds'] if base['seconds'] > 0 else 1.0
+        status = ''
+        if ratio > 1 + tolerance:
+            regressions.append(key)
+            status = 'REGRESSION'
+        if result['digest'] != base['digest']:
+            mismatches.append(key)
+            status += ' MISMATCH'
+        print(f'{key:<50} {base["seconds"]:>10.4f} s -> {result["seconds"]:>10.4f} s  x{ratio:.2f} {status}')
+    return regressions, mismatches
+
+def save_baseline(results, name):
+    """
+    Saves results to benchmarks/baselines/<name>.json together with details about the machine.
+    """
+    BASELINE_DIR.mkdir(exist_ok=True)
+    baseline = {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+        },
+        'results': results,
+    }
+    path = BASELINE_DIR / f'{name}.json'
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=1, sort_keys=True)
+    return path
+
+def load_baseline(name):
+    path = Path(name) if name.endswith('.json') else BASELINE_DIR / f'{name}.json'
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--sizes", type=int, nargs='+', default=[1000, 10000, 100000], help='total atoms of the synthetic complexes; default is 1000 10000 100000')
+    parser.add_argument("-l", "--ligand_sizes", type=int, nargs='+', default=[20, 60], help='ligand atoms of the synthetic complexes; default is 20 60, as in baselines/reference.json')
+    parser.add_argument("--stages", nargs='+', choices=list(STAGES), help='stages to report; default is every stage')
+    parser.add_argument("-r", "--repeat", type=int, default=3, help='timed repeats per stage; default is 3')
+    parser.add_argument("-d", "--distance", type=float, default=3.5, help='binding site distance; default is 3.5Å')
+    parser.add_argument("--voxel_size", type=float, default=0.5, help='voxel size; default is 0.5Å')
+    parser.add_argument("--seed", type=int, default=0, help='random seed of the synthetic complexes; default is 0')
+    parser.add_argument("--max_reference_atoms", type=int, default=50000, help='slow reference stages are skipped above this size when a faster implementation exists')
+    parser.add_argument("--workdir", help='keep the synthetic files in this directory instead of a temporary one')
+    parser.add_argument("--save", metavar='NAME', help='save the results as baselines/NAME.json')
+    parser.add_argument("--compare", metavar='NAME', help='compare the results with baselines/NAME.json (or a path to a .json file)')
+    parser.add_argument("--tolerance", type=float, default=0.25, help='allowed slowdown before a result is a regression; default is 0.25')
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.ligand_sizes, args.stages, args.repeat, args.distance, args.voxel_size,
+                  args.seed, args.max_reference_atoms, args.workdir)
+
+    failed = False
+    mismatches = check(results)
+    for key in mismatches:
+        print(f'** {key} does not match the reference implementation')
+    failed |= bool(mismatches)
+
+    failures = check_formal_charges(args.workdir) + check_untitled_molblocks(args.workdir)
+    for failure in failures:
+        print(f'** {failure}')
+    failed |= bool(failures)
+
+    if args.compare:
+        regressions, mismatches = compare(results, load_baseline(args.compare), args.tolerance)
+        print(f'** {len(regressions)} regressions, {len(mismatches)} mismatches against {args.compare}')
+        failed |= bool(regressions or mismatches)
+
+    if args.save:
+        print('** saved', save_baseline(results, args.save))
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,115 @@
+import numpy as np
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from synthetic_pdb import write_synthetic_pdb
+from run_benchmarks import compare, load_baseline, save_baseline
+
+# Optional or heavy libraries; the ones each command imports are recorded with its time
+HEAVY = ('scipy', 'sklearn', 'rdkit', 'torch', 'dgl', 'tensorflow', 'matplotlib')
+
+# Runs a command in a fresh interpreter and reports the heavy libraries it ended up importing
+_RUNNER = """
+import json, runpy, sys
+sys.argv = {argv!r}
+try:
+    runpy.run_module('bsite', run_name='__main__', alter_sys=True)
+except SystemExit:
+    pass
+finally:
+    loaded = sorted(name for name in {heavy!r} if name in sys.modules)
+    print('BSITE_LOADED ' + json.dumps(loaded), file=sys.stderr)
+"""
+
+def commands(workdir, input_file):
+    """
+    The commands that are timed: {name: arguments of `python3 -m bsite`}.
+    """
+    return {
+        'help': ['--help'],
+        'parse': ['parse', '-i', input_file],
+        'extract': ['extract', '-i', input_file, '-ht', 'LIG', '-b', os.path.join(workdir, 'bs.pdb'), '-l', os.path.join(workdir, 'lig.pdb')],
+        'voxelize': ['voxelize', '-i', os.path.join(workdir, 'bs.pdb'), os.path.join(workdir, 'lig.pdb'), '-o', os.path.join(workdir, 'voxels.npz')],
+    }
+
+def time_command(argv, repeat=5):
+    """
+    Wall time of `python3 -m bsite ARGV` from process start to exit, and the heavy libraries it imported.
+
+    Returns:
+        tuple: (median seconds, list of heavy modules loaded)
+    """
+    code = _RUNNER.format(argv=['bsite'] + argv, heavy=HEAVY)
+    times, loaded = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-c', code], cwd=REPO, capture_output=True, text=True)
+        times.append(time.perf_counter() - start)
+        for line in process.stderr.splitlines():
+            if line.startswith('BSITE_LOADED '):
+                loaded = json.loads(line[len('BSITE_LOADED '):])
+    return float(np.median(times)), loaded
+
+def run(n_atoms=5000, ligand_atoms=30, repeat=5, workdir=None):
+    """
+    Times every command of `commands` on a synthetic complex.
+
+    Results use the keys and fields of run_benchmarks.py ('startup[command]|atoms|ligand_atoms',
+    with 'seconds' and 'digest'), so they can be saved and compared the same way; the
+    digest is a hash of the heavy libraries the command imported, so a command that starts
+    importing a new library shows up as a mismatch.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = workdir or tmp
+        input_file = os.path.join(workdir, f'synthetic_{n_atoms}_{ligand_atoms}_0.pdb')
+        if not os.path.exists(input_file):
+            write_synthetic_pdb(input_file, n_atoms=n_atoms, ligand_atoms=ligand_atoms, seed=0)
+        for name, argv in commands(workdir, input_file).items():
+            seconds, loaded = time_command(argv, repeat)
+            key = f'startup[{name}]|{n_atoms}|{ligand_atoms}'
+            results[key] = {'seconds': seconds, 'peak_mb': 0.0, 'digest': hashlib.sha256(json.dumps(loaded).encode()).hexdigest()[:16], 'loaded': loaded}
+            print(f"{key:<50} {seconds:>10.4f} s  {' '.join(loaded) or '-'}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='startup time of the python3 -m bsite commands')
+    parser.add_argument("-n", "--atoms", type=int, default=5000, help='atoms of the synthetic complex; default is 5000')
+    parser.add_argument("-l", "--ligand_atoms", type=int, default=30, help='ligand atoms of the synthetic complex; default is 30')
+    parser.add_argument("-r", "--repeat", type=int, default=5, help='timed runs per command; default is 5')
+    parser.add_argument("--budget", type=float, default=1.0, help='parse and extract must finish within this many seconds; default is 1')
+    parser.add_argument("--workdir", help='keep the synthetic files in this directory instead of a temporary one')
+    parser.add_argument("--save", metavar='NAME', help='save the results as baselines/NAME.json')
+    parser.add_argument("--compare", metavar='NAME', help='compare the results with baselines/NAME.json (or a path to a .json file)')
+    parser.add_argument("--tolerance", type=float, default=0.25, help='allowed slowdown before a result is a regression; default is 0.25')
+    args = parser.parse_args()
+
+    results = run(args.atoms, args.ligand_atoms, args.repeat, args.workdir)
+
+    failed = False
+    for key, result in results.items():
+        command = key.split('[')[1].split(']')[0]
+        if command in ('parse', 'extract') and result['seconds'] > args.budget:
+            print(f"** {key} took {result['seconds']:.2f} s, over the {args.budget:g} s budget")
+            failed = True
+
+    if args.compare:
+        regressions, mismatches = compare(results, load_baseline(args.compare), args.tolerance)
+        print(f'** {len(regressions)} regressions, {len(mismatches)} mismatches against {args.compare}')
+        failed |= bool(regressions or mismatches)
+
+    if args.save:
+        print('** saved', save_baseline(results, args.save))
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,166 @@
+import numpy as np
+import argparse
+
+# Heavy atom templates; offsets (Å) are relative to the C-alpha of each residue
+RESIDUE_TEMPLATES = {
+    'GLY': [('N', 'N', (-1.2, 0.5, 0.0)), ('CA', 'C', (0.0, 0.0, 0.0)), ('C', 'C', (1.2, 0.6, 0.0)), ('O', 'O', (1.3, 1.8, 0.0))],
+    'ALA': [('CB', 'C', (0.0, -1.0, 1.2))],
+    'SER': [('CB', 'C', (0.0, -1.0, 1.2)), ('OG', 'O', (0.0, -2.3, 1.0))],
+    'VAL': [('CB', 'C', (0.0, -1.0, 1.2)), ('CG1', 'C', (1.2, -1.6, 1.6)), ('CG2', 'C', (-1.2, -1.6, 1.6))],
+    'LEU': [('CB', 'C', (0.0, -1.0, 1.2)), ('CG', 'C', (0.0, -1.6, 2.5)), ('CD1', 'C', (1.2, -2.4, 2.9)), ('CD2', 'C', (-1.2, -2.4, 2.9))],
+    'ASP': [('CB', 'C', (0.0, -1.0, 1.2)), ('CG', 'C', (0.0, -1.8, 2.4)), ('OD1', 'O', (1.0, -2.2, 3.0)), ('OD2', 'O', (-1.0, -2.2, 3.0))],
+    'LYS': [('CB', 'C', (0.0, -1.0, 1.2)), ('CG', 'C', (0.0, -1.6, 2.5)), ('CD', 'C', (0.0, -2.2, 3.8)), ('CE', 'C', (0.0, -3.4, 4.5)), ('NZ', 'N', (0.0, -3.8, 5.8))],
+    'PHE': [('CB', 'C', (0.0, -1.0, 1.2)), ('CG', 'C', (0.0, -1.8, 2.4)), ('CD1', 'C', (1.2, -2.4, 2.9)), ('CD2', 'C', (-1.2, -2.4, 2.9)),
+            ('CE1', 'C', (1.2, -3.2, 4.0)), ('CE2', 'C', (-1.2, -3.2, 4.0)), ('CZ', 'C', (0.0, -3.6, 4.6))],
+    'MET': [('CB', 'C', (0.0, -1.0, 1.2)), ('CG', 'C', (0.0, -1.6, 2.5)), ('SD', 'S', (0.0, -2.4, 4.0)), ('CE', 'C', (0.0, -3.9, 4.4))],
+}
+# Every residue other than glycine carries the backbone too
+RESIDUE_TEMPLATES = {name: (atoms if name == 'GLY' else RESIDUE_TEMPLATES['GLY'] + atoms) for name, atoms in RESIDUE_TEMPLATES.items()}
+
+CHAIN_IDS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+LIGAND_ELEMENTS = ['C', 'C', 'C', 'C', 'N', 'O']
+
+def _random_rotations(rng, n):
+    """
+    Draws `n` random rotation matrices from the QR decomposition of gaussian matrices.
+    """
+    q, r = np.linalg.qr(rng.normal(size=(n, 3, 3)))
+    q *= np.sign(np.diagonal(r, axis1=1, axis2=2))[:, None, :]
+    return q
+
+def synthetic_ligand(n_atoms, rng, bond_length=1.5):
+    """
+    Builds a compact random-walk ligand centered at (0, 0, 0).
+
+    Args:
+        n_atoms (int): number of ligand atoms.
+        rng (numpy.random.Generator): random number generator.
+        bond_length (float): distance between consecutive atoms in Å.
+
+    Returns:
+        tuple: (coordinates (n_atoms, 3), list of element symbols)
+    """
+    coords = np.zeros((n_atoms, 3))
+    for i in range(1, n_atoms):
+        # Steps that fold back onto the ligand are redrawn a few times before being accepted
+        for _ in range(20):
+            step = rng.normal(size=3)
+            candidate = coords[i-1] + bond_length * step / np.linalg.norm(step)
+            if np.min(np.linalg.norm(coords[:i] - candidate, axis=1)) >= 0.9 * bond_length:
+                break
+        coords[i] = candidate
+    coords -= coords.mean(axis=0)
+    elements = [LIGAND_ELEMENTS[i % len(LIGAND_ELEMENTS)] for i in range(n_atoms)]
+    return coords, elements
+
+def synthetic_complex(n_atoms=10000, ligand_atoms=30, ligand_id='LIG', seed=0,
+                      residue_spacing=5.5, cavity=2.8, chain_length=2000):
+    """
+    Generates a synthetic protein-ligand complex of a controlled size.
+
+    Residues are taken from `RESIDUE_TEMPLATES`, randomly rotated and packed on a jittered
+    lattice at roughly protein density. The ligand sits in a cavity carved at the center of
+    the box so that its binding site looks like a real pocket. The same arguments always
+    produce the same structure.
+
+    Args:
+        n_atoms (int): approximate total number of atoms (protein + ligand).
+        ligand_atoms (int): number of ligand atoms.
+        ligand_id (str): HET id of the ligand.
+        seed (int): random seed.
+        residue_spacing (float): lattice spacing between residues in Å.
+        cavity (float): protein residues with an atom closer than this to the ligand are removed.
+        chain_length (int): maximum number of residues per chain.
+
+    Returns:
+        str: the complex in .pdb format.
+    """
+    rng = np.random.default_rng(seed)
+    names = sorted(RESIDUE_TEMPLATES)
+    mean_size = np.mean([len(RESIDUE_TEMPLATES[name]) for name in names])
+
+    ligand_coords, ligand_elements = synthetic_ligand(ligand_atoms, rng)
+
+    # Lattice large enough for the protein plus the residues lost to the cavity
+    n_residues = int(np.ceil((n_atoms - ligand_atoms) / mean_size)) + 1
+    side = int(np.ceil((1.2 * n_residues + 4 * ligand_atoms) ** (1 / 3)))
+    grid = np.stack(np.meshgrid(*[np.arange(side)] * 3, indexing='ij'), axis=-1).reshape(-1, 3)
+    centers = (grid - (side - 1) / 2) * residue_spacing + rng.uniform(-0.5, 0.5, size=grid.shape)
+    # Closest lattice points first, so the structure grows outwards from the ligand
+    centers = centers[np.argsort(np.linalg.norm(centers, axis=1), kind='stable')]
+
+    residue_names = rng.choice(names, size=len(centers))
+    rotations = _random_rotations(rng, len(centers))
+
+    records = []
+    total = ligand_atoms
+    for center, rotation, resname in zip(centers, rotations, residue_names):
+        template = RESIDUE_TEMPLATES[resname]
+        offsets = np.array([atom[2] for atom in template])
+        coords = center + offsets @ rotation.T
+        if ligand_atoms and np.min(np.linalg.norm(coords[:, None, :] - ligand_coords[None, :, :], axis=2)) < cavity:
+            continue
+        records.append((resname, coords))
+        total += len(template)
+        if total >= n_atoms:
+            break
+
+    lines = [
+        'REMARK   1 SYNTHETIC PROTEIN-LIGAND COMPLEX',
+        f'REMARK   1 SEED {seed} ATOMS {total} LIGAND ATOMS {ligand_atoms}',
+    ]
+    serial = 0
+    for i, (resname, coords) in enumerate(records):
+        chain = CHAIN_IDS[(i // chain_length) % len(CHAIN_IDS)]
+        res_seq = i % chain_length + 1
+        for (atom_name, element, _), (x, y, z) in zip(RESIDUE_TEMPLATES[resname], coords):
+            serial += 1
+            lines.append(_atom_line('ATOM', serial, atom_name, resname, chain, res_seq, x, y, z, element))
+        if res_seq == chain_length or i == len(records) - 1:
+            lines.append('TER')
+
+    element_counts = {}
+    for (x, y, z), element in zip(ligand_coords, ligand_elements):
+        serial += 1
+        element_counts[element] = element_counts.get(element, 0) + 1
+        atom_name = f'{element}{element_counts[element]}'
+        lines.append(_atom_line('HETATM', serial, atom_name, ligand_id, 'A', 9001, x, y, z, element))
+    lines.append('END')
+
+    return '\n'.join(lines) + '\n'
+
+def _atom_line(record_name, serial, atom_name, residue, chain, res_seq, x, y, z, element, charge=''):
+    """
+    Formats a single ATOM/HETATM record with the standard PDB column layout.
+    """
+    name_field = atom_name if len(atom_name) == 4 else f' {atom_name:<3}'
+    return (f'{record_name:<6}{serial % 100000:>5} {name_field} {residue:>3} {chain}{res_seq % 10000:>4}    '
+            f'{x:8.3f}{y:8.3f}{z:8.3f}{1.0:6.2f}{20.0:6.2f}          {element:>2}{charge}')
+
+def write_synthetic_pdb(output_file, **kwargs):
+    """
+    Writes a synthetic complex to a .pdb file.
+
+    Args:
+        output_file (str): name of the output file.
+        **kwargs: arguments passed to `synthetic_complex`.
+
+    Returns:
+        str: name of the output file.
+    """
+    with open(output_file, 'w') as f:
+        f.write(synthetic_complex(**kwargs))
+    return output_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--atoms", type=int, default=10000, help='approximate total number of atoms; default is 10000')
+    parser.add_argument("-l", "--ligand_atoms", type=int, default=30, help='number of ligand atoms; default is 30')
+    parser.add_argument("-ht", "--hetatm", default='LIG', help='ligand HET id; default is LIG')
+    parser.add_argument("-s", "--seed", type=int, default=0, help='random seed; default is 0')
+    parser.add_argument("-o", "--output", required=True, help='name for the output .pdb file')
+    args = parser.parse_args()
+
+    write_synthetic_pdb(args.output, n_atoms=args.atoms, ligand_atoms=args.ligand_atoms, ligand_id=args.hetatm, seed=args.seed)
+    print('** wrote', args.output)
@@ -0,0 +1,224 @@
+import numpy as np
+import argparse
+import gzip
+import math
+import time
+
+HET_FIELD = 'Ligand HET ID in PDB'
+PDB_FIELD = 'PDB ID(s) for Ligand-Target Complex'
+AFFINITY_FIELDS = {
+    'ki': 'Ki (nM)',
+    'ic50': 'IC50 (nM)',
+    'kd': 'Kd (nM)',
+    'ec50': 'EC50 (nM)',
+}
+QUALIFIERS = {'<': -1, '=': 0, '>': 1}
+
+_WANTED = {HET_FIELD.encode(), PDB_FIELD.encode(), *[field.encode() for field in AFFINITY_FIELDS.values()]}
+
+def _open(path):
+    return gzip.open(path, 'rb') if str(path).endswith('.gz') else open(path, 'rb')
+
+def _iter_blocks(f, chunk_size=1 << 24):
+    """
+    Splits a stream into SDF records ($$$$ separated) while reading it in large chunks.
+    """
+    tail = b''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        blocks = (tail + chunk).split(b'\n$$$$')
+        tail = blocks.pop()
+        yield from blocks
+    if tail.strip(b'\r\n$'):
+        yield tail
+
+def iter_records(sdf_file, fields=None):
+    """
+    Streams the data fields of every record of a BindingDB SDF file.
+
+    The file is read in fixed size chunks, so memory stays constant whatever the size of
+    the file, and only the data block after 'M  END' of each record is split into fields. A field
+    that is missing or empty in a record is simply absent from it, so values can never be
+    paired with the wrong record.
+
+    Args:
+        sdf_file (str): path to the BindingDB .sdf (or .sdf.gz) file.
+        fields (set of bytes): field names to keep; defaults to the HET id, PDB ids and affinities.
+
+    Yields:
+        dict: {field name (str): value (str)} for each record.
+    """
+    fields = _WANTED if fields is None else fields
+    with _open(sdf_file) as f:
+        for block in _iter_blocks(f):
+            data_start = block.rfind(b'M  END')
+            data = block[data_start:] if data_start != -1 else block
+            if b'\r' in data:
+                data = data.replace(b'\r\n', b'\n')
+            record = {}
+            # Data headers look like '> <Ligand HET ID in PDB>' and the value runs until a blank line.
+            # Affinity values can start with '>' too (i.e. >10000) so only '> <' starts a header.
+            for field in data.split(b'\n> <')[1:]:
+                name_end = field.find(b'>')
+                name = field[:name_end]
+                if name in fields:
+                    value_start = field.find(b'\n', name_end) + 1
+                    value = field[value_start:].split(b'\n\n', 1)[0] if value_start else b''
+                    value = b' '.join(line.strip() for line in value.split(b'\n') if line.strip())
+                    if value:
+                        record[name.decode()] = value.decode('utf-8', 'replace')
+            yield record
+
+def parse_affinity(value):
+    """
+    Parses a BindingDB affinity value such as '250', '>10000' or '<0.1'.
+
+    Returns:
+        tuple: (value in nM as float, qualifier: -1 for '<', 0 for '=', 1 for '>'); (nan, 0) when missing.
+    """
+    value = value.strip() if value else ''
+    if not value:
+        return np.nan, 0
+    qualifier = QUALIFIERS.get(value[0])
+    if qualifier is not None:
+        value = value[1:].strip()
+    try:
+        return float(value), qualifier or 0
+    except ValueError:
+        return np.nan, 0
+
+def parse_pdb_ids(value):
+    """
+    Splits the comma separated PDB ids of a record, dropping empty entries and repeats.
+    """
+    pdb_ids = []
+    for pdb_id in value.replace(' ', ',').split(','):
+        pdb_id = pdb_id.strip().upper()
+        if pdb_id and pdb_id not in pdb_ids:
+            pdb_ids.append(pdb_id)
+    return tuple(pdb_ids)
+
+def build_index(sdf_file, keep_unpaired=False):
+    """
+    Builds a deduplicated ligand–PDB index from a BindingDB SDF file.
+
+    Records with the same HET id, PDB ids and affinities are merged, and the number of
+    merged records is kept in the 'count' column. Memory grows with the number of unique
+    records, not with the size of the file.
+
+    Args:
+        sdf_file (str): path to the BindingDB .sdf (or .sdf.gz) file.
+        keep_unpaired (bool): if True, records with a HET id but no PDB id (or the reverse) are kept.
+
+    Returns:
+        tuple: (index, stats) where index is a dict of columns (see `write_index`) and stats
+        counts the records read, kept and skipped.
+    """
+    unique = {}
+    stats = {'records': 0, 'missing_het': 0, 'missing_pdb': 0, 'duplicates': 0}
+    for record in iter_records(sdf_file):
+        stats['records'] += 1
+        het_id = record.get(HET_FIELD, '').strip().upper()
+        pdb_ids = parse_pdb_ids(record.get(PDB_FIELD, ''))
+        if not het_id:
+            stats['missing_het'] += 1
+        if not pdb_ids:
+            stats['missing_pdb'] += 1
+        if not keep_unpaired and not (het_id and pdb_ids):
+            continue
+        affinities = tuple(parse_affinity(record.get(field)) for field in AFFINITY_FIELDS.values())
+        # nan != nan, so missing values are keyed as None
+        key = (het_id, pdb_ids, tuple((None if math.isnan(v) else v, q) for v, q in affinities))
+        if key in unique:
+            unique[key][1] += 1
+            stats['duplicates'] += 1
+        else:
+            unique[key] = [affinities, 1]
+    stats['unique'] = len(unique)
+    return _to_columns(unique), stats
+
+def _to_columns(unique):
+    n = len(unique)
+    het_ids = []
+    pdb_ids = []
+    pdb_offsets = np.zeros(n + 1, dtype=np.int64)
+    values = np.full((n, len(AFFINITY_FIELDS)), np.nan, dtype=np.float32)
+    qualifiers = np.zeros((n, len(AFFINITY_FIELDS)), dtype=np.int8)
+    counts = np.zeros(n, dtype=np.int32)
+    for i, ((het_id, pdbs, _), (affinities, count)) in enumerate(unique.items()):
+        het_ids.append(het_id)
+        pdb_ids.extend(pdbs)
+        pdb_offsets[i + 1] = pdb_offsets[i] + len(pdbs)
+        values[i] = [v for v, q in affinities]
+        qualifiers[i] = [q for v, q in affinities]
+        counts[i] = count
+
+    index = {
+        # Sized to the longest value, so extended ids (i.e. pdb_00001abc) are not truncated
+        'het_id': np.array(het_ids, dtype=str) if het_ids else np.zeros(0, dtype='U5'),
+        'pdb_ids': np.array(pdb_ids, dtype=str) if pdb_ids else np.zeros(0, dtype='U4'),
+        'pdb_offsets': pdb_offsets,
+        'count': counts,
+    }
+    for j, name in enumerate(AFFINITY_FIELDS):
+        index[name] = values[:, j]
+        index[f'{name}_qualifier'] = qualifiers[:, j]
+    return index
+
+def write_index(index, output_file):
+    """
+    Writes the index as a compressed .npz file of columns:
+        het_id (n,), pdb_offsets (n+1,), pdb_ids (pdb_offsets[-1],), count (n,),
+        ki, ic50, kd, ec50 (n,) in nM with nan when missing, and <name>_qualifier (n,).
+    The PDB ids of record i are pdb_ids[pdb_offsets[i]:pdb_offsets[i+1]].
+    """
+    np.savez_compressed(output_file, **index)
+
+def load_index(index_file):
+    """
+    Loads an index written by `write_index`.
+
+    Returns:
+        dict: {column name: numpy.ndarray}
+    """
+    with np.load(index_file) as data:
+        return {name: data[name] for name in data.files}
+
+def iter_pairs(index):
+    """
+    Yields the (HET id, PDB ids) of every record of an index.
+    """
+    het_ids = index['het_id']
+    pdb_ids = index['pdb_ids']
+    offsets = index['pdb_offsets']
+    for i in range(len(het_ids)):
+        yield str(het_ids[i]), [str(pdb_id) for pdb_id in pdb_ids[offsets[i]:offsets[i + 1]]]
+
+def write_tsv(index, output_file):
+    """
+    Writes 'HET id<TAB>comma separated PDB ids' lines, the same layout as bindingdb_data_grab.sh.
+    """
+    with open(output_file, 'w') as f:
+        for het_id, pdb_ids in iter_pairs(index):
+            f.write(f"{het_id}\t{','.join(pdb_ids)}\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='build a deduplicated ligand-PDB index from a BindingDB SDF file')
+    parser.add_argument("-i", "--input", required=True, help='BindingDB .sdf or .sdf.gz file')
+    parser.add_argument("-o", "--output", required=True, help='name for the .npz index')
+    parser.add_argument("-t", "--tsv", required=False, help='if included, HET id/PDB id lines are also written to this file')
+    parser.add_argument("-k", "--keep_unpaired", action='store_true', help='if included, records missing the HET id or the PDB ids are kept')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    index, stats = build_index(args.input, args.keep_unpaired)
+    write_index(index, args.output)
+    if args.tsv:
+        write_tsv(index, args.tsv)
+
+    print(f"** records: {stats['records']}  unique: {stats['unique']}  duplicates: {stats['duplicates']}")
+    print(f"** missing HET id: {stats['missing_het']}  missing PDB ids: {stats['missing_pdb']}")
+    print(f"** wrote {args.output} in {time.perf_counter() - start:.1f} s")
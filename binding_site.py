@@ -0,0 +1,437 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from metrics import metrics
+from structure import Hierarchy, element_field
+
+
+def center(pdb):
+    """
+    Centers the coordinates of a pdb dataframe to (0, 0, 0).
+
+    Args:
+        pdb (pandas.DataFrame): pdb dataframe from `process_pdb`.
+
+    Returns:
+        pandas.DataFrame: the same dataframe with centered coordinates.
+    """
+    pdb = pdb.copy()
+    pdb['orth_x'] -= pdb['orth_x'].mean()
+    pdb['orth_y'] -= pdb['orth_y'].mean()
+    pdb['orth_z'] -= pdb['orth_z'].mean()
+    return pdb
+
+@metrics.timed('split')
+def split_ligand_protein(pdb, hetatm):
+    """
+    Separates a pdb dataframe into the ligand and the protein it is bound to.
+
+    Only the first chain and the first residue number carrying the ligand are kept,
+    and duplicated atoms from alternate conformations are dropped.
+
+    Args:
+        pdb (pandas.DataFrame): pdb dataframe from `process_pdb`.
+        hetatm (str): ligand HET id in the PDB.
+
+    Returns:
+        tuple: (ligand, protein, primary_chain)
+    """
+    ligand_raw = pdb[pdb['residue'].str.startswith(hetatm)]
+    protein_raw = pdb[~pdb['residue'].str.startswith(hetatm)]
+
+    if ligand_raw.empty:
+        # Alternate locations are read into the residue column i.e. AXYZ or BXYZ
+        hetatm_alt = ('A'+hetatm, 'B'+hetatm)
+        ligand_raw = pdb[pdb['residue'].str.startswith(hetatm_alt)]
+        protein_raw = pdb[~pdb['residue'].str.startswith(hetatm_alt)]
+
+    if ligand_raw.empty:
+        raise ValueError(f"ligand {hetatm} was not found")
+
+    drop_chains = ligand_raw["chain"].unique()[1:]
+
+    protein = protein_raw[~protein_raw['chain'].isin(drop_chains)]
+    ligand = ligand_raw[~ligand_raw['chain'].isin(drop_chains)]
+
+    first_unique_res_seq = ligand['res_seq'].unique()[0]
+    ligand = ligand[ligand['res_seq'] == first_unique_res_seq]
+
+    primary_chain = ligand_raw["chain"].unique()[0]
+
+    # To handle multiple conformations of a protein that are overlapping
+    ligand = ligand.drop_duplicates(subset=['atom_name', 'residue', 'chain', 'res_seq'])
+    protein = protein.drop_duplicates(subset=['atom_name', 'residue', 'chain', 'res_seq'])
+
+    return ligand, protein, primary_chain
+
+def cartesian_distance(x1, y1, z1, x2, y2, z2):
+    """
+    Calculate the Cartesian distance between two points in 3D space.
+
+    Args:
+        x1, y1, z1: Coordinates of the first point.
+        x2, y2, z2: Coordinates of the second point.
+
+    Returns:
+        Distance between the two points.
+    """
+    distance = np.sqrt((x2 - x1)**2 + (y2 - y1)**2 + (z2 - z1)**2)
+    return distance
+
+@metrics.timed('neighbor_search')
+def binding_site_atoms_reference(ligand, protein, distance=3.5):
+    """
+    Finds the protein atoms within `distance` of any ligand atom by testing every pair.
+
+    This is the original O(L·P) loop from find_HETATM_1.2.py and is kept as the
+    reference the faster paths are checked against.
+
+    Args:
+        ligand (pandas.DataFrame): ligand atoms.
+        protein (pandas.DataFrame): protein atoms.
+        distance (float): binding site distance in Å.
+
+    Returns:
+        pandas.DataFrame: protein atoms within the distance, one row per hit (may repeat).
+    """
+    metrics.count('pairs_tested', len(ligand) * len(protein))
+
+    bs_res_rows = []
+    for lrow in ligand.itertuples(index=False):
+        pointA = (lrow.orth_x, lrow.orth_y, lrow.orth_z)
+        for prow in protein.itertuples(index=False):
+            pointB = (prow.orth_x, prow.orth_y, prow.orth_z)
+            if cartesian_distance(*pointA, *pointB) <= distance:
+                bs_res_rows.append(pd.Series(prow._asdict()))
+
+    if not bs_res_rows:
+        return protein.iloc[:0]
+
+    return pd.concat(bs_res_rows, axis=1).T
+
+class StructureIndex:
+    """
+    Spatial index over every atom of a parsed structure.
+
+    The index is built once per structure and reused for every ligand of that structure;
+    the ligand and protein dataframes passed to `binding_site_atoms` must be subsets of
+    the dataframe the index was built from.
+
+    Args:
+        pdb (pandas.DataFrame): pdb dataframe from `process_pdb`.
+    """
+    def __init__(self, pdb):
+        self.pdb = pdb
+        self.tree = cKDTree(pdb[['orth_x', 'orth_y', 'orth_z']].to_numpy(dtype=float))
+
+@metrics.timed('neighbor_search')
+def binding_site_atoms(ligand, protein, distance=3.5, index=None):
+    """
+    Finds the protein atoms within `distance` of any ligand atom with a k-d tree.
+
+    Gives the same atoms as `binding_site_atoms_reference` (each atom once) in
+    O(L·log P) instead of testing every ligand/protein pair.
+
+    Args:
+        ligand (pandas.DataFrame): ligand atoms.
+        protein (pandas.DataFrame): protein atoms.
+        distance (float): binding site distance in Å.
+        index (StructureIndex): index of the structure both dataframes come from;
+            a tree over `protein` is built when not given.
+
+    Returns:
+        pandas.DataFrame: protein atoms within the distance.
+    """
+    ligand_coords = ligand[['orth_x', 'orth_y', 'orth_z']].to_numpy(dtype=float)
+    if index is None:
+        index = StructureIndex(protein)
+
+    hits = index.tree.query_ball_point(ligand_coords, r=distance)
+    positions = np.unique(np.concatenate([np.asarray(hit, dtype=np.int64) for hit in hits])) if len(hits) else np.zeros(0, dtype=np.int64)
+    metrics.count('neighbor_pairs', sum(len(hit) for hit in hits))
+
+    labels = index.pdb.index[positions]
+    return protein[protein.index.isin(labels)]
+
+def residue_columns(df):
+    """
+    The columns that identify a residue: 'residue', 'chain' and 'res_seq', and 'symmetry'
+    when the atoms include symmetry mates (see symmetry.py).
+    """
+    return ['residue', 'chain', 'res_seq'] + (['symmetry'] if 'symmetry' in df.columns else [])
+
+@metrics.timed('neighbor_search')
+def residue_distance_table(ligand, protein, max_distance=6.0, hierarchy=None, pairs=None):
+    """
+    Computes the minimum distance of every protein residue to the ligand, up to `max_distance`.
+
+    The table is computed once at the largest cutoff; the binding site at any smaller
+    cutoff is then the residues with `min_distance <= cutoff` (see `binding_sites_by_cutoff`).
+
+    Args:
+        ligand (pandas.DataFrame): ligand atoms.
+        protein (pandas.DataFrame): protein atoms.
+        max_distance (float): largest cutoff in Å; residues farther than this are left out.
+        hierarchy (structure.Hierarchy): residues of `protein` by its `residue_columns`; if
+            given, the minimum is a per-residue reduction instead of a groupby.
+        pairs (float): if given, the (ligand atom, protein atom) pairs within this distance
+            are returned as well (i.e. for `interactions.detect_interactions`). They come from
+            the same ligand tree, queried only for the protein atoms it found within reach.
+
+    Returns:
+        pandas.DataFrame: the `residue_columns` and 'min_distance' of each residue
+        within `max_distance`, closest first. With `pairs`, a tuple of the table and the
+        (ligand positions, protein positions, distances) arrays of the pairs.
+    """
+    tree = cKDTree(ligand[['orth_x', 'orth_y', 'orth_z']].to_numpy(dtype=float))
+    protein_coords = protein[['orth_x', 'orth_y', 'orth_z']].to_numpy(dtype=float)
+    reach = max_distance if pairs is None else max(max_distance, pairs)
+    # The upper bound is exclusive, the cutoffs are inclusive as in binding_site_atoms_reference
+    distances, _ = tree.query(protein_coords, k=1, distance_upper_bound=np.nextafter(reach, np.inf))
+    candidates = np.flatnonzero(np.isfinite(distances))
+    distances[distances > max_distance] = np.inf
+    within = np.isfinite(distances)
+    metrics.count('residue_table_atoms', int(within.sum()))
+
+    columns = residue_columns(protein)
+    if hierarchy is not None:
+        min_distance = hierarchy.reduce(distances, np.minimum)
+        residues = np.flatnonzero(np.isfinite(min_distance))
+        table = protein[columns].iloc[hierarchy.first_atoms[residues]].reset_index(drop=True)
+        table['min_distance'] = min_distance[residues]
+    else:
+        atoms = protein.loc[within, columns].copy()
+        atoms['min_distance'] = distances[within]
+        table = atoms.groupby(columns, sort=False, as_index=False)['min_distance'].min()
+    table = table.sort_values('min_distance', kind='stable').reset_index(drop=True)
+    if pairs is None:
+        return table
+
+    hits = tree.query_ball_point(protein_coords[candidates], r=pairs)
+    lengths = np.fromiter((len(hit) for hit in hits), dtype=np.int64, count=len(hits))
+    pj = np.repeat(candidates, lengths)
+    li = np.concatenate([np.asarray(hit, dtype=np.int64) for hit in hits]) if lengths.sum() else np.zeros(0, dtype=np.int64)
+    # In the order of `interactions.neighbor_pairs`: by ligand atom, then protein atom
+    order = np.lexsort((pj, li))
+    li, pj = li[order], pj[order]
+    return table, (li, pj, np.linalg.norm(tree.data[li] - protein_coords[pj], axis=1))
+
+def site_pairs(pairs, protein, site):
+    """
+    The pairs of `residue_distance_table` whose protein atom is in `site` (a binding site of
+    `protein`), with the protein atoms as positions in `site`.
+    """
+    columns = residue_columns(protein) + ['atom_name']
+    matched = protein[columns].reset_index(drop=True).reset_index().merge(
+        site[columns].reset_index(drop=True).reset_index().rename(columns={'index': 'site'}), on=columns)
+    lookup = np.full(len(protein), -1, dtype=np.int64)
+    lookup[matched['index'].to_numpy()] = matched['site'].to_numpy()
+    li, pj, distances = pairs
+    sj = lookup[pj]
+    keep = sj >= 0
+    return li[keep], sj[keep], distances[keep]
+
+def binding_sites_by_cutoff(protein, table, cutoffs, hierarchy=None):
+    """
+    Thresholds a residue distance table into one binding site per cutoff.
+
+    Args:
+        protein (pandas.DataFrame): protein atoms the table was computed from.
+        table (pandas.DataFrame): table from `residue_distance_table`.
+        cutoffs (list of float): binding site distances in Å, at most the table's `max_distance`.
+        hierarchy (structure.Hierarchy): residues of `protein`, passed on to `complete_residues`.
+
+    Returns:
+        dict: {cutoff: every atom of the binding site residues}, with an empty dataframe
+        when no residue is within the cutoff.
+    """
+    sites = {}
+    for cutoff in cutoffs:
+        residues = table[table['min_distance'] <= cutoff]
+        sites[cutoff] = complete_residues(protein, residues, hierarchy) if not residues.empty else protein.iloc[:0]
+    return sites
+
+@metrics.timed('complete_residues')
+def complete_residues(protein, bs_atoms, hierarchy=None):
+    """
+    Expands binding site atoms into the complete residues they belong to.
+
+    Args:
+        protein (pandas.DataFrame): protein atoms.
+        bs_atoms (pandas.DataFrame): protein atoms within the binding site distance (or
+            rows of a residue table with the `residue_columns`).
+        hierarchy (structure.Hierarchy): residues of `protein` by its `residue_columns`; if
+            given, the residues are matched against the residue table of the hierarchy and
+            their atoms selected with a mask, instead of merging every atom of `protein`.
+
+    Returns:
+        pandas.DataFrame: every atom of the binding site residues.
+    """
+    columns = residue_columns(protein)
+    bindingsite_unique = bs_atoms[columns].drop_duplicates()
+    bindingsite_unique = bindingsite_unique.astype(protein[columns].dtypes.to_dict())
+    if hierarchy is not None:
+        residues = protein[columns].iloc[hierarchy.first_atoms].reset_index(drop=True).reset_index()
+        selected = np.zeros(len(hierarchy), dtype=bool)
+        selected[residues.merge(bindingsite_unique, on=columns, how='inner')['index'].to_numpy()] = True
+        return protein[selected[hierarchy.atom_residue]].reset_index(drop=True)
+    bindingsite = pd.merge(protein, bindingsite_unique, on=columns, how='inner')
+    return bindingsite
+
+@metrics.timed('write')
+def write_pdb(df, output_file):
+    """
+    Writes the ATOM/HETATM records of a pdb dataframe to a .pdb file.
+
+    Args:
+        df (pandas.DataFrame): pdb dataframe.
+        output_file (str): name of the output file.
+    """
+    with open(output_file, 'w') as f:
+        for i, row in df.iterrows():
+            orth_x_formatted = '{:.3f}'.format(row["orth_x"])
+            orth_y_formatted = '{:.3f}'.format(row["orth_y"])
+            orth_z_formatted = '{:.3f}'.format(row["orth_z"])
+            atom_line = f'{row["record_name"]:<6}{row["serial_number"]:>5}{row["atom_name"]:>5}{row["residue"]:>4}{row["chain"]:>2}{row["res_seq"]:>4}{orth_x_formatted:>12}{orth_y_formatted:>8}{orth_z_formatted:>8}{row["occupancy"]:>6}{row["temp_factor"]:>6}{element_field(row["element_plus_charge"])}'+'\n'
+            f.write(atom_line)
+
+
+class ExtractionError(Exception):
+    """
+    Raised by `extract` when the ligand or its binding site is not found; the message is
+    the one find_HETATM_1.2.py prints before exiting.
+    """
+
+def extract(pdbfile, hetatm, bindingsite_output=None, ligand_output=None, distances=(3.5,), centered=False,
+            distance_table=None, archive=None, symmetry=False, sasa_table=None, min_sasa=None, interactions=None, log=print):
+    """
+    Extracts a ligand and its binding site from a structure file; this is the whole of
+    find_HETATM_1.2.py, so that a resident process (worker_daemon.py) can run it as well.
+
+    Args:
+        pdbfile (str): input PDB file.
+        hetatm (str): ligand HET id in the PDB.
+        bindingsite_output (str): name for the binding site output file.
+        ligand_output (str): name for the ligand output file.
+        distances (list of float): binding site distances in Å; with several, each binding
+            site is written as NAME_{distance}A.pdb.
+        centered (bool): if True, ligand and protein are centered to (0, 0, 0).
+        distance_table (str): if given, the minimum distance of every residue is written to this .tsv file.
+        archive (str): if given, complexes are appended to this .bsa archive instead of written to the output files.
+        symmetry (bool): if True, residues of symmetry mates (from the CRYST1 record) within
+            the distance are part of the binding site as well; see `symmetry.with_symmetry_mates`.
+        sasa_table (str): if given, the unbound, bound and buried SASA of every binding site
+            residue and of the ligand are written to this .tsv file (see sasa.py).
+        min_sasa (float): if given, residues with less unbound SASA (Å²) are trimmed from the binding sites.
+        interactions (str): if given, the interaction fingerprint of every binding site is
+            appended to this JSON lines file (see interactions.py), from the atom pairs of
+            the binding site search instead of a second neighbor search.
+        log (callable): called like `print` with the progress messages.
+
+    Returns:
+        dict: 'chain', 'ligand_atoms', {distance: atoms} of the 'binding_sites' and the 'outputs' written.
+    """
+    import os
+    from process_pdb import process_pdb
+
+    with metrics.file(pdbfile, hetatm=hetatm):
+        log('** file name:',pdbfile)
+        log('** ligand ID:',hetatm)
+
+        pdb = process_pdb(pdbfile) # Waters and glucose are removed here
+
+        # Symmetry mates are generated in the coordinates of the file and centered with the rest
+        shift = pdb[['orth_x', 'orth_y', 'orth_z']].mean().to_numpy() if centered else np.zeros(3)
+        if centered:
+            pdb = center(pdb)
+
+        # here we create separate dataframes for the ligand and protein
+        try:
+            ligand, protein, primary_chain = split_ligand_protein(pdb, hetatm)
+        except ValueError:
+            raise ExtractionError(f"Ligand {hetatm} was not found in {pdbfile}. Exiting program.")
+
+        log('** using Chain',primary_chain)
+
+        distances = sorted(set(distances))
+        multiple = len(distances) > 1
+
+        if symmetry:
+            from symmetry import with_symmetry_mates
+            uncentered = lambda df: df.assign(orth_x=df['orth_x'] + shift[0], orth_y=df['orth_y'] + shift[1], orth_z=df['orth_z'] + shift[2])
+            protein = with_symmetry_mates(pdbfile, uncentered(protein), uncentered(ligand), max(distances), log=log)
+            protein[['orth_x', 'orth_y', 'orth_z']] -= shift
+
+        log('** binding site distance from ligand is:', ', '.join(f'{distance:g}' for distance in distances),'Å')
+
+        # The distance of every residue is computed once, at the largest distance, and thresholded for each;
+        # residues are found once in the hierarchy of the protein
+        hierarchy = Hierarchy.from_dataframe(protein, residue_columns(protein))
+        if interactions:
+            from interactions import ATOM_CUTOFF
+            table, pairs = residue_distance_table(ligand, protein, max(distances), hierarchy, pairs=ATOM_CUTOFF)
+        else:
+            table = residue_distance_table(ligand, protein, max(distances), hierarchy)
+        if distance_table:
+            table.to_csv(distance_table, sep='\t', index=False, float_format='%.3f')
+
+        # Need to create a binding site dataframe with the complete residues, not just the atoms
+        bindingsites = {distance: site for distance, site in binding_sites_by_cutoff(protein, table, distances, hierarchy).items() if not site.empty}
+
+        if bindingsites and (sasa_table or min_sasa is not None):
+            from sasa import complex_sasa, residue_sasa, trim_buried
+            # The largest site holds every other one; the whole protein surrounds it
+            site_atoms, ligand_atoms = complex_sasa(ligand, bindingsites[max(bindingsites)], protein)
+            residues = residue_sasa(pd.concat([site_atoms, ligand_atoms.assign(**({'symmetry': '1_555'} if symmetry else {}))]))
+            log(f"** buried surface upon binding: {residues['sasa_buried'].sum():.1f} Å² (ligand {ligand_atoms['sasa_buried'].sum():.1f} Å²)")
+            if sasa_table:
+                residues.to_csv(sasa_table, sep='\t', index=False, float_format='%.2f')
+            if min_sasa is not None:
+                bindingsites = {distance: trim_buried(site, residues, min_sasa) for distance, site in bindingsites.items()}
+                bindingsites = {distance: site for distance, site in bindingsites.items() if not site.empty}
+
+        if not bindingsites:
+            raise ExtractionError("No binding site residues found within the specified distance. Exiting program. Try increasing binding site distance.")
+        for distance in distances:
+            if distance not in bindingsites:
+                log(f'** no binding site residues within {distance:g} Å; skipped')
+
+        def with_distance(name, distance):
+            root, ext = os.path.splitext(name)
+            return f'{root}_{distance:g}A{ext}' if multiple else name
+
+        outputs = []
+        if interactions:
+            import json
+            from interactions import complex_interactions
+            name = os.path.splitext(os.path.basename(pdbfile))[0]
+            with open(interactions, 'a') as out:
+                for distance, bindingsite in bindingsites.items():
+                    found, fp, _, _ = complex_interactions(ligand.reset_index(drop=True), bindingsite.reset_index(drop=True),
+                                                           pairs=site_pairs(pairs, protein, bindingsite))
+                    out.write(json.dumps({'name': with_distance(f'{name}_{hetatm}', distance), **fp}) + '\n')
+            log('** interactions appended to', interactions)
+            outputs.append(interactions)
+        if archive:
+            from complex_archive import ComplexArchive
+            packed = ComplexArchive(archive, 'a')
+        else:
+            write_pdb(ligand, ligand_output)
+            outputs.append(ligand_output)
+
+        for distance, bindingsite in bindingsites.items():
+            metrics.count('binding_site_atoms', len(bindingsite))
+            if archive:
+                key = with_distance(f"{os.path.splitext(os.path.basename(pdbfile))[0]}_{hetatm}", distance)
+                # The operators of the mates in the site; the archive records have no column for them
+                mates = {'symmetry': sorted(set(bindingsite['symmetry']) - {'1_555'})} if symmetry else {}
+                packed.append(key, bindingsite, ligand, pdb_file=pdbfile, het_id=hetatm, distance=distance, **mates)
+                log('** appended', key, 'to', archive)
+                outputs.append(f'{archive}:{key}')
+            else:
+                write_pdb(bindingsite, with_distance(bindingsite_output, distance))
+                outputs.append(with_distance(bindingsite_output, distance))
+
+    return {'chain': str(primary_chain), 'ligand_atoms': len(ligand),
+            'binding_sites': {distance: len(site) for distance, site in bindingsites.items()}, 'outputs': outputs}
@@ -0,0 +1,83 @@
+"""
+One entry point for the binding site pipeline: `python3 -m bsite {parse,extract,bonds,graph,voxelize}`.
+
+Importing the package loads nothing else. The functions below are resolved from the
+modules of the repository on first use, so a command only pays for the libraries it
+needs (RDKit for bonds, torch and DGL for graphs):
+
+    import bsite
+    pdb = bsite.process_pdb('1abc.pdb')      # imports pandas only
+"""
+import importlib
+import importlib.util
+import os
+import sys
+
+# The pipeline modules live next to the package, at the root of the repository
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _ROOT not in sys.path:
+    sys.path.insert(0, _ROOT)
+
+# {name: module it is defined in}
+_EXPORTS = {
+    'process_pdb': 'process_pdb',
+    'read_pdb': 'structure',
+    'Structure': 'structure',
+    'split_ligand_protein': 'binding_site',
+    'residue_distance_table': 'binding_site',
+    'binding_sites_by_cutoff': 'binding_site',
+    'write_pdb': 'binding_site',
+    'extract': 'binding_site',
+    'ExtractionError': 'binding_site',
+    'read_crystal': 'symmetry',
+    'symmetry_mates': 'symmetry',
+    'element_codes': 'featurizer',
+    'atom_features': 'featurizer',
+    'Voxelizer': 'voxelizer',
+    'as_tensor': 'tensors',
+    'potential_grid': 'electrostatics',
+    'pdb_charges': 'electrostatics',
+    'read_poses': 'pose_screen',
+    'PoseScreen': 'pose_screen',
+    'pocket_tokens': 'pocket_index',
+    'cluster_pockets': 'pocket_index',
+    'atom_sasa': 'sasa',
+    'complex_sasa': 'sasa',
+    'ligand_fingerprints': 'ligand_split',
+    'similar_pairs': 'ligand_split',
+    'bonds_protein_df': 'pdb_pandas',
+    'bonds_ligand_df': 'pdb_pandas',
+    'ProcessedPDB': 'se3_prep',
+    'dgl_graph': 'se3_prep',
+    'residue_nodes': 'coarse_grain',
+    'coarse_dgl_graph': 'coarse_grain',
+    'coarse_batch': 'coarse_grain',
+    'ComplexArchive': 'complex_archive',
+    'metrics': 'metrics',
+}
+
+# Optional libraries each command needs beyond numpy, pandas and scipy
+BACKENDS = {
+    'parse': (),
+    'extract': (),
+    'bonds': ('rdkit',),
+    'graph': ('rdkit', 'torch', 'dgl'),
+    'voxelize': (),
+}
+
+def missing_backends(command):
+    """
+    The libraries `command` needs that are not installed, checked without importing them.
+    """
+    return [name for name in BACKENDS[command] if importlib.util.find_spec(name) is None]
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module 'bsite' has no attribute {name!r}")
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals()) + list(_EXPORTS))
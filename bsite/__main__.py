@@ -0,0 +1,144 @@
+import argparse
+import sys
+
+from bsite import missing_backends
+
+# Every command imports what it needs when it runs, so `--help` and argument errors are instant
+# and `parse`/`extract` never load RDKit, torch, DGL or TensorFlow
+
+
+def parse_command(args):
+    from structure import read_pdb
+
+    structure = read_pdb(args.inputpdb)
+    pdb = structure.all().to_dataframe()
+    hetatms = pdb[pdb['record_name'] == 'HETATM'][['residue', 'chain', 'res_seq']].drop_duplicates()
+    print('** file name:', args.inputpdb)
+    print('** atoms:', len(pdb), ' chains:', ' '.join(pdb['chain'].unique()))
+    print('** HETATM residues:', ' '.join(f'{row.residue}:{row.chain}{row.res_seq}' for row in hetatms.itertuples(index=False)) or 'none')
+    if args.output:
+        if args.output.endswith('.pkl'):
+            pdb.to_pickle(args.output)
+        else:
+            pdb.to_csv(args.output, sep=',' if args.output.endswith('.csv') else '\t', index=False)
+
+def extract_command(args):
+    from binding_site import ExtractionError, extract
+
+    if not args.archive and not (args.bindingsite_output and args.ligand_output):
+        sys.exit('-b and -l are required unless --archive is given')
+    try:
+        extract(args.inputpdb, args.hetatm, args.bindingsite_output, args.ligand_output, args.distance,
+                args.center, args.distance_table, args.archive, args.symmetry, args.sasa, args.min_sasa)
+    except ExtractionError as e:
+        print(e)
+        sys.exit(1)
+
+def bonds_command(args):
+    from pdb_pandas import process_pdb, bonds_protein_df, bonds_ligand_df
+    from se3_prep import ProcessedPDB
+
+    obj = ProcessedPDB(args.inputpdb, process_pdb(args.inputpdb))
+    if args.sdf:
+        df = bonds_ligand_df(obj, args.inputpdb, args.sdf, override_bond_order=True)
+    else:
+        df = bonds_protein_df(obj)
+    df.to_pickle(args.output)
+    print(f"** {len(df)} atoms, {int(df['bond'].map(len).sum())} bonds written to {args.output}")
+
+def graph_command(args):
+    from pathlib import Path
+    import dgl
+    from se3_prep import ProcessedPDB, process_pdb_single, bonds_protein_df, bonds_ligand_df, dgl_graph
+
+    objs = []
+    for pdb_file in args.inputpdb:
+        obj = ProcessedPDB(str(pdb_file), process_pdb_single(pdb_file))
+        if pdb_file.endswith('_ligand.pdb'):
+            # The ideal SDF downloaded next to the ligand (downloader.py -lp)
+            df = bonds_ligand_df(obj, pdb_file, str(Path(pdb_file).with_suffix('.sdf')), override_bond_order=True)
+        else:
+            df = bonds_protein_df(obj)
+        objs.append(ProcessedPDB(obj.filepath, df))
+    graphs = dgl_graph(objs)
+    dgl.save_graphs(args.output, graphs)
+    print(f'** {len(graphs)} graphs written to {args.output}')
+
+def voxelize_command(args):
+    import json
+    import numpy as np
+    from inference import pocket_data
+    from voxelizer import Voxelizer
+
+    datasets = [pocket_data(pdb_file) for pdb_file in args.inputpdb]
+    if args.grid:
+        with open(args.grid) as f:
+            voxelizer = Voxelizer.from_spec(json.load(f))
+    else:
+        voxelizer = Voxelizer(datasets, voxel_size=args.voxel_size)
+    arrays = {'spec': np.array(json.dumps(voxelizer.spec()))}
+    for i, data in enumerate(datasets):
+        arrays[f'indices_{i}'] = voxelizer.index_array(data)
+        arrays[f'values_{i}'] = data[:, 3].astype(np.float32)
+    np.savez_compressed(args.output, files=np.array(args.inputpdb), **arrays)
+    print(f'** {len(datasets)} files on a {voxelizer.x_dim}x{voxelizer.y_dim}x{voxelizer.z_dim} grid written to {args.output}')
+
+COMMANDS = {
+    'parse': parse_command,
+    'extract': extract_command,
+    'bonds': bonds_command,
+    'graph': graph_command,
+    'voxelize': voxelize_command,
+}
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python3 -m bsite', description='binding site pipeline')
+    parser.add_argument("-m", "--metrics", required=False, help='if included, per-stage timings and counts are appended to this .jsonl file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parse = subparsers.add_parser('parse', help='read a .pdb file and list its chains and HETATM residues')
+    parse.add_argument("-i", "--inputpdb", required=True, help='input PDB file in .pdb format')
+    parse.add_argument("-o", "--output", required=False, help='if included, the atoms are written to this .tsv, .csv or .pkl file')
+
+    extract = subparsers.add_parser('extract', help='isolate a ligand and its binding site (find_HETATM_1.2.py)')
+    extract.add_argument("-i", "--inputpdb", required=True, help='input PDB file in .pdb format')
+    extract.add_argument("-ht", "--hetatm", required=True, help='ligand HET id in PDB')
+    extract.add_argument("-b", "--bindingsite_output", required=False, help='name for binding site output file')
+    extract.add_argument("-l", "--ligand_output", required=False, help='name for ligand output file')
+    extract.add_argument("-a", "--archive", required=False, help='if included, the complex is appended to this packed archive (.bsa) instead of written to -b/-l')
+    extract.add_argument("-d", "--distance", type=float, nargs='+', default=[3.5], help='binding site distance(s); default is 3.5Å')
+    extract.add_argument("-t", "--distance_table", required=False, help='if included, the minimum distance of every residue to the ligand is written to this .tsv file')
+    extract.add_argument("-c", "--center", action='store_true', help='if included, ligand and protein will be centered to (0,0,0)')
+    extract.add_argument("-S", "--sasa", required=False, help='if included, the per-residue SASA (unbound, bound, buried) is written to this .tsv file')
+    extract.add_argument("--min_sasa", type=float, default=None, help='if included, residues with less unbound SASA (Å²) are trimmed from the binding site')
+    extract.add_argument("-s", "--symmetry", action='store_true', help='if included, residues of symmetry mates within the distance are part of the binding site')
+
+    bonds = subparsers.add_parser('bonds', help='add bonds and bond orders to a binding site (or a ligand with --sdf)')
+    bonds.add_argument("-i", "--inputpdb", required=True, help='binding site or ligand .pdb file')
+    bonds.add_argument("-s", "--sdf", required=False, help='ideal SDF of the ligand; if included, the input is treated as a ligand')
+    bonds.add_argument("-o", "--output", required=True, help='dataframe with the bonds (.pkl)')
+
+    graph = subparsers.add_parser('graph', help='build DGL graphs of binding site and ligand files')
+    graph.add_argument("-i", "--inputpdb", nargs='+', required=True, help='*_binding_site.pdb and *_ligand.pdb files (ligands need their .sdf next to them)')
+    graph.add_argument("-o", "--output", required=True, help='graphs file (dgl.save_graphs)')
+
+    voxelize = subparsers.add_parser('voxelize', help='voxelize .pdb files on one shared grid')
+    voxelize.add_argument("-i", "--inputpdb", nargs='+', required=True, help='.pdb files')
+    voxelize.add_argument("-v", "--voxel_size", type=float, default=1.0, help='voxel size; default is 1Å')
+    voxelize.add_argument("-g", "--grid", required=False, help='if included, the grid of this spec (Voxelizer.save_spec) is used instead of one spanning the files')
+    voxelize.add_argument("-o", "--output", required=True, help='occupied voxel indices and element codes of every file (.npz)')
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    missing = missing_backends(args.command)
+    if missing:
+        sys.exit(f"** {args.command} needs {', '.join(missing)}, which is not installed")
+    if args.metrics:
+        from metrics import metrics
+        metrics.enable(args.metrics)
+    COMMANDS[args.command](args)
+
+
+if __name__ == "__main__":
+    main()
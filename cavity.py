@@ -0,0 +1,293 @@
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import os
+import time
+from contextlib import nullcontext
+from multiprocessing import Pool
+from scipy import ndimage
+
+from binding_site import residue_distance_table, binding_sites_by_cutoff, write_pdb
+from metrics import metrics
+
+# Rays are cast along the 3 axes and the 4 body diagonals, both ways (14 directions)
+DIRECTIONS = np.array([(1, 0, 0), (0, 1, 0), (0, 0, 1), (1, 1, 1), (1, 1, -1), (1, -1, 1), (-1, 1, 1)])
+DIRECTIONS = np.concatenate([DIRECTIONS, -DIRECTIONS])
+# Residue name of the pocket points written as a pseudo-ligand (as fpocket does)
+POCKET_RESIDUE = 'STP'
+
+
+class Pocket:
+    """
+    A cluster of buried empty grid points.
+
+    Args:
+        rank (int): 1 for the largest pocket of the structure.
+        points (numpy.ndarray): (n, 3) coordinates of the grid points.
+        buriedness (numpy.ndarray): number of the 14 rays of each point that hit the protein.
+        spacing (float): grid spacing in Å.
+    """
+    def __init__(self, rank, points, buriedness, spacing):
+        self.rank = rank
+        self.points = points
+        self.buriedness = buriedness
+        self.volume = len(points) * spacing ** 3
+        self.center = points.mean(axis=0)
+
+    def __len__(self):
+        return len(self.points)
+
+    def __repr__(self):
+        return f'Pocket({self.rank}, {self.volume:.0f} Å³, buriedness={self.buriedness.mean():.1f})'
+
+    def summary(self):
+        return {'rank': self.rank, 'points': len(self), 'volume': self.volume,
+                'buriedness': float(self.buriedness.mean()), 'center': [round(float(value), 3) for value in self.center]}
+
+    def to_dataframe(self):
+        """
+        The pocket points as pseudo-ligand atoms (HETATM, residue 'STP', carbon) with the
+        columns of `process_pdb`, so they go through the same binding site, writing and
+        voxelization code as a ligand.
+        """
+        n = len(self)
+        df = pd.DataFrame({
+            'record_name': ['HETATM'] * n,
+            'serial_number': np.arange(1, n + 1),
+            'atom_name': ['C'] * n,
+            'residue': [POCKET_RESIDUE] * n,
+            'chain': ['X'] * n,
+            'res_seq': [self.rank] * n,
+        })
+        coords = np.round(self.points, 3)
+        df['orth_x'], df['orth_y'], df['orth_z'] = coords[:, 0], coords[:, 1], coords[:, 2]
+        df['occupancy'] = '1.00'
+        df['temp_factor'] = [f'{value:.2f}' for value in self.buriedness]
+        df['element_plus_charge'] = 'C'
+        return df
+
+
+def protein_atoms(pdb, keep_hetatm=False):
+    """
+    The atoms that make up the protein surface: ATOM records, and HETATM records (cofactors,
+    ions, bound ligands) only with `keep_hetatm`, so that a holo structure shows its pockets empty.
+    """
+    if keep_hetatm:
+        return pdb
+    return pdb[pdb['record_name'] == 'ATOM']
+
+@metrics.timed('pocket_grid')
+def protein_grid(coords, spacing=1.0, clearance=3.0):
+    """
+    Voxelizes a protein into solid and empty grid points.
+
+    Atoms are binned into the grid and one Euclidean distance transform gives the distance
+    of every grid point to the nearest occupied voxel; points closer than `clearance` are
+    solid. Distances are measured to voxel centers, so they are within spacing·√3/2 of the
+    distance to the atom.
+
+    Args:
+        coords (numpy.ndarray): (n, 3) atom coordinates.
+        spacing (float): grid spacing in Å.
+        clearance (float): empty points are at least this far (in Å) from every atom.
+
+    Returns:
+        tuple: (solid boolean grid, origin) where grid point (i, j, k) is at origin + (i, j, k)·spacing.
+    """
+    padding = clearance + 2 * spacing
+    origin = coords.min(axis=0) - padding
+    shape = np.ceil((coords.max(axis=0) + padding - origin) / spacing).astype(int) + 1
+    index = np.floor((coords - origin) / spacing + 0.5).astype(int)
+
+    occupied = np.zeros(shape, dtype=bool)
+    occupied[index[:, 0], index[:, 1], index[:, 2]] = True
+    distance = ndimage.distance_transform_edt(~occupied, sampling=spacing)
+    return distance < clearance, origin
+
+def _shifted(grid, offset):
+    # grid[p + offset] at every p (False outside the grid), as slice assignments only
+    out = np.zeros_like(grid)
+    target, source = [], []
+    for o, n in zip(offset, grid.shape):
+        if abs(o) >= n:
+            return out
+        target.append(slice(max(-o, 0), n - max(o, 0)))
+        source.append(slice(max(o, 0), n + min(o, 0)))
+    out[tuple(target)] = grid[tuple(source)]
+    return out
+
+@metrics.timed('pocket_buriedness')
+def buriedness(solid, spacing=1.0, ray_length=10.0):
+    """
+    Counts, for every grid point, how many of the 14 `DIRECTIONS` hit a solid point within `ray_length`.
+
+    Each ray is cast for the whole grid at once: the solid grid is shifted one step at a
+    time along the direction and OR-ed into the hits of that direction, so the cost is
+    14 × steps array operations whatever the number of points.
+
+    Args:
+        solid (numpy.ndarray): solid boolean grid from `protein_grid`.
+        spacing (float): grid spacing in Å.
+        ray_length (float): rays longer than this (in Å) count as open.
+
+    Returns:
+        numpy.ndarray: uint8 grid of counts from 0 (exposed) to 14 (enclosed).
+    """
+    counts = np.zeros(solid.shape, dtype=np.uint8)
+    for direction in DIRECTIONS:
+        steps = int(ray_length / (spacing * np.linalg.norm(direction)))
+        hit = np.zeros_like(solid)
+        for step in range(1, steps + 1):
+            hit |= _shifted(solid, direction * step)
+        counts += hit
+    return counts
+
+@metrics.timed('pockets')
+def detect_pockets(coords, spacing=1.0, clearance=3.0, ray_length=10.0, min_buriedness=10, min_volume=30.0):
+    """
+    Finds the pockets of a protein without a ligand.
+
+    The protein is voxelized (`protein_grid`), the empty points whose rays hit the protein
+    in at least `min_buriedness` of the 14 directions are kept (`buriedness`), and these
+    are clustered into pockets by face, edge and corner adjacency with `scipy.ndimage.label`.
+
+    Args:
+        coords (numpy.ndarray): (n, 3) protein atom coordinates.
+        spacing (float): grid spacing in Å.
+        clearance (float): distance from every atom of the empty points in Å.
+        ray_length (float): ray length in Å.
+        min_buriedness (int): rays (of 14) that must hit the protein.
+        min_volume (float): smaller clusters (in Å³) are dropped.
+
+    Returns:
+        list of Pocket: largest first.
+    """
+    solid, origin = protein_grid(coords, spacing, clearance)
+    counts = buriedness(solid, spacing, ray_length)
+    buried = ~solid & (counts >= min_buriedness)
+
+    labels, n_clusters = ndimage.label(buried, structure=ndimage.generate_binary_structure(3, 3))
+    metrics.count('pocket_points', int(buried.sum()))
+    if not n_clusters:
+        return []
+
+    sizes = np.bincount(labels.ravel())[1:]
+    keep = np.flatnonzero(sizes * spacing ** 3 >= min_volume) + 1
+    keep = keep[np.argsort(-sizes[keep - 1], kind='stable')]
+    points = np.argwhere(labels > 0)
+    point_labels = labels[points[:, 0], points[:, 1], points[:, 2]]
+    point_counts = counts[points[:, 0], points[:, 1], points[:, 2]]
+    order = np.argsort(point_labels, kind='stable')
+    bounds = np.searchsorted(point_labels[order], np.arange(n_clusters + 2))
+
+    pockets = []
+    for rank, label in enumerate(keep, start=1):
+        members = order[bounds[label]:bounds[label + 1]]
+        pockets.append(Pocket(rank, origin + points[members] * spacing, point_counts[members], spacing))
+    return pockets
+
+def pocket_binding_site(protein, pocket, distance=4.0):
+    """
+    The complete residues lining a pocket: residues with an atom within `distance` of a
+    pocket point, found as for a ligand (`residue_distance_table`).
+    """
+    table = residue_distance_table(pocket.to_dataframe(), protein, distance)
+    return binding_sites_by_cutoff(protein, table, [distance])[distance]
+
+def screen(pdb_file, output_dir=None, archive=None, top=3, distance=4.0, keep_hetatm=False, **kwargs):
+    """
+    Detects the pockets of a structure and writes the `top` largest like ligand binding sites.
+
+    Each pocket is written as {name}_pocket{rank}_binding_site.pdb and {name}_pocket{rank}_ligand.pdb
+    (the pocket points, see `Pocket.to_dataframe`) in `output_dir`, or appended to `archive`
+    as {name}_pocket{rank}.
+
+    Args:
+        pdb_file (str): input structure.
+        output_dir (str): directory for the output files.
+        archive (str): if given, pockets go to this .bsa archive instead of .pdb files.
+        top (int): number of pockets written.
+        distance (float): binding site distance from the pocket points in Å.
+        keep_hetatm (bool): if True, HETATM records are part of the protein.
+        **kwargs: `detect_pockets` parameters.
+
+    Returns:
+        dict: 'file', 'pockets' (summaries of the pockets written), 'seconds', or 'error'.
+    """
+    from structure import read_pdb
+
+    start = time.perf_counter()
+    name = os.path.splitext(os.path.basename(pdb_file))[0]
+    result = {'file': pdb_file, 'pockets': []}
+    with metrics.file(pdb_file):
+        try:
+            pdb = read_pdb(pdb_file).all().to_dataframe()
+            protein = protein_atoms(pdb, keep_hetatm)
+            pockets = detect_pockets(protein[['orth_x', 'orth_y', 'orth_z']].to_numpy(dtype=float), **kwargs)[:top]
+            packed = None
+            if archive:
+                from complex_archive import ComplexArchive
+                packed = ComplexArchive(archive, 'a')
+            for pocket in pockets:
+                site = pocket_binding_site(protein, pocket, distance)
+                summary = dict(pocket.summary(), residues=int(site[['residue', 'chain', 'res_seq']].drop_duplicates().shape[0]))
+                key = f'{name}_pocket{pocket.rank}'
+                if packed is not None:
+                    packed.append(key, site, pocket.to_dataframe(), pdb_file=pdb_file, distance=distance, **pocket.summary())
+                else:
+                    write_pdb(site, os.path.join(output_dir, f'{key}_binding_site.pdb'))
+                    write_pdb(pocket.to_dataframe(), os.path.join(output_dir, f'{key}_ligand.pdb'))
+                result['pockets'].append(summary)
+        except Exception as e:
+            result['error'] = f'{type(e).__name__}: {e}'
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def _screen(args):
+    pdb_file, kwargs = args
+    return screen(pdb_file, **kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ligand-free pocket detection for apo structures and predicted models')
+    parser.add_argument("-i", "--inputpdb", nargs='+', required=True, help='input PDB file(s) in .pdb format')
+    parser.add_argument("-o", "--output_dir", default='.', help='directory for the pocket binding site and ligand files; default is the current directory')
+    parser.add_argument("-a", "--archive", required=False, help='if included, pockets are appended to this packed archive (.bsa) instead of written as .pdb files')
+    parser.add_argument("-n", "--top", type=int, default=3, help='number of pockets written per structure, largest first; default is 3')
+    parser.add_argument("-d", "--distance", type=float, default=4.0, help='binding site distance from the pocket points; default is 4Å')
+    parser.add_argument("-s", "--spacing", type=float, default=1.0, help='grid spacing; default is 1Å')
+    parser.add_argument("-b", "--min_buriedness", type=int, default=10, help='rays (of 14) that must hit the protein; default is 10')
+    parser.add_argument("-v", "--min_volume", type=float, default=30.0, help='smallest pocket volume; default is 30Å³')
+    parser.add_argument("--keep_hetatm", action='store_true', help='if included, HETATM records (cofactors, ions, ligands) are part of the protein')
+    parser.add_argument("-w", "--workers", type=int, default=1, help='number of worker processes; default is 1')
+    parser.add_argument("-r", "--report", required=False, help='if included, the pockets of every structure are appended to this .jsonl file')
+    parser.add_argument("-m", "--metrics", required=False, help='if included, per-stage timings are appended to this .jsonl file')
+    args = parser.parse_args()
+
+    if args.metrics:
+        metrics.enable(args.metrics)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    kwargs = dict(output_dir=args.output_dir, archive=args.archive, top=args.top, distance=args.distance, keep_hetatm=args.keep_hetatm,
+                  spacing=args.spacing, min_buriedness=args.min_buriedness, min_volume=args.min_volume)
+    tasks = [(pdb_file, kwargs) for pdb_file in args.inputpdb]
+    report = open(args.report, 'a') if args.report else None
+    start = time.perf_counter()
+    n_pockets = 0
+    with Pool(args.workers) if args.workers > 1 else nullcontext() as pool:
+        results = pool.imap_unordered(_screen, tasks, chunksize=4) if pool else map(_screen, tasks)
+        for result in results:
+            if 'error' in result:
+                print('** failed:', result['file'], result['error'])
+            else:
+                n_pockets += len(result['pockets'])
+                if len(tasks) == 1:
+                    for pocket in result['pockets']:
+                        print(f"** pocket {pocket['rank']}: {pocket['volume']:.0f} Å³, buriedness {pocket['buriedness']:.1f}, {pocket['residues']} residues, center {pocket['center']}")
+            if report:
+                report.write(json.dumps(result) + '\n')
+    if report:
+        report.close()
+    elapsed = time.perf_counter() - start
+    print(f'** {len(tasks)} structures, {n_pockets} pockets in {elapsed:.1f} s ({len(tasks) / elapsed * 3600:.0f} structures per hour)')
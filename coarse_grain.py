@@ -0,0 +1,209 @@
+import numpy as np
+import argparse
+import json
+import time
+from scipy.spatial import cKDTree
+
+from binding_site import residue_columns
+from featurizer import AMINO_ACIDS, ELEMENTS_HASH, _lookup, element_codes
+from metrics import metrics
+from structure import Hierarchy
+from tensors import aligned_zeros
+
+BACKBONE_ATOMS = ('N', 'CA', 'C', 'O', 'OXT')
+# Residue types: the amino acids, then anything else (cofactors, modified residues, ions)
+RESIDUE_TYPES = {residue: i for i, residue in enumerate(AMINO_ACIDS)}
+OTHER_TYPE = len(AMINO_ACIDS)
+# Channels of the coarse grid
+RESIDUE_CLASSES = {
+    'hydrophobic': ('ALA', 'VAL', 'LEU', 'ILE', 'MET', 'PRO', 'GLY'),
+    'aromatic': ('PHE', 'TYR', 'TRP', 'HIS'),
+    'polar': ('SER', 'THR', 'ASN', 'GLN', 'CYS'),
+    'positive': ('LYS', 'ARG'),
+    'negative': ('ASP', 'GLU'),
+    'other': (),
+}
+CLASS_OF_TYPE = np.array([next((i for i, members in enumerate(RESIDUE_CLASSES.values()) if residue in members), len(RESIDUE_CLASSES) - 1)
+                          for residue in AMINO_ACIDS] + [len(RESIDUE_CLASSES) - 1], dtype=np.int64)
+CONTACT_CUTOFF = 8.0
+COARSE_VOXEL_SIZE = 4.0
+
+
+def residue_type(residue):
+    # Alternate locations are read into the residue column i.e. AARG or BARG
+    if len(residue) == 4 and residue[0] in 'AB':
+        residue = residue[1:]
+    return RESIDUE_TYPES.get(residue, OTHER_TYPE)
+
+@metrics.timed('coarse_grain')
+def residue_nodes(site):
+    """
+    One node per residue of a binding site, from group reductions over its atoms.
+
+    Residues are found once with a `structure.Hierarchy` and every per-residue value is a
+    reduction over its atom ranges; hydrogens are left out of the centroids.
+
+    Args:
+        site (pandas.DataFrame): binding site atoms (`process_pdb` columns).
+
+    Returns:
+        dict: per residue, in order of first appearance: the `residue_columns` values,
+        'type' (code of `RESIDUE_TYPES`), 'atoms' (heavy atoms), 'centroid', 'side_chain'
+        (centroid of the heavy atoms that are not in BACKBONE_ATOMS; the Cα for glycine) and
+        'ca' (the Cα; the centroid for residues without one), as (n, 3) arrays.
+    """
+    columns = residue_columns(site)
+    hierarchy = Hierarchy.from_dataframe(site, columns)
+    coords = site[['orth_x', 'orth_y', 'orth_z']].to_numpy(dtype=float)
+    names = site['atom_name'].astype(str).str.strip().to_numpy()
+    heavy = element_codes(site['element_plus_charge']) != ELEMENTS_HASH['H']
+
+    atoms = hierarchy.reduce(heavy.astype(np.int64))
+    centroid = hierarchy.reduce(coords * heavy[:, None]) / np.maximum(atoms, 1)[:, None]
+
+    ca = centroid.copy()
+    positions = np.flatnonzero(names == 'CA')[::-1]
+    # Reversed, so the first Cα of a residue is the one written last
+    ca[hierarchy.atom_residue[positions]] = coords[positions]
+
+    side = heavy & ~np.isin(names, BACKBONE_ATOMS)
+    side_atoms = hierarchy.reduce(side.astype(np.int64))
+    side_chain = np.where(side_atoms[:, None] > 0, hierarchy.reduce(coords * side[:, None]) / np.maximum(side_atoms, 1)[:, None], ca)
+
+    nodes = {column: site[column].to_numpy()[hierarchy.first_atoms] for column in columns}
+    nodes.update({'type': _lookup(nodes['residue'], residue_type, np.int64), 'atoms': atoms,
+                  'centroid': centroid, 'side_chain': side_chain, 'ca': ca})
+    metrics.count('coarse_residues', len(hierarchy))
+    return nodes
+
+def residue_edges(nodes, cutoff=CONTACT_CUTOFF):
+    """
+    Contacts between residues: pairs whose Cα (or centroid, for residues without one) are
+    within `cutoff` Å, in both directions like the 'bond' column of the atom graphs.
+
+    Returns:
+        tuple: (src, dst) int64 arrays and the (m,) Cα distances.
+    """
+    pairs = cKDTree(nodes['ca']).query_pairs(cutoff, output_type='ndarray').astype(np.int64)
+    src = np.r_[pairs[:, 0], pairs[:, 1]]
+    dst = np.r_[pairs[:, 1], pairs[:, 0]]
+    return src, dst, np.linalg.norm(nodes['ca'][src] - nodes['ca'][dst], axis=1)
+
+def node_features(nodes):
+    """
+    (n, len(AMINO_ACIDS) + 1) float32 one-hot residue types.
+    """
+    features = np.zeros((len(nodes['type']), OTHER_TYPE + 1), dtype=np.float32)
+    features[np.arange(len(features)), nodes['type']] = 1
+    return features
+
+@metrics.timed('graph')
+def coarse_dgl_graph(sites, cutoff=CONTACT_CUTOFF):
+    """
+    The residue graph of each binding site, the coarse counterpart of `se3_prep.dgl_graph`.
+
+    Nodes have 'type' (one-hot residue type), 'coords' (centroid), 'ca' and 'side_chain';
+    edges have 'distance' (between the Cα). Columns are wrapped with `torch.from_numpy`.
+
+    Args:
+        sites (list of pandas.DataFrame): binding site atoms.
+        cutoff (float): Cα contact distance of the edges in Å.
+
+    Returns:
+        list: DGL graphs.
+    """
+    import torch
+    import dgl
+
+    graphs = []
+    for site in sites:
+        nodes = residue_nodes(site)
+        src, dst, distance = residue_edges(nodes, cutoff)
+        g = dgl.graph((torch.from_numpy(src), torch.from_numpy(dst)), num_nodes=len(nodes['type']))
+        g.ndata['type'] = torch.from_numpy(node_features(nodes))
+        for name, key in (('coords', 'centroid'), ('ca', 'ca'), ('side_chain', 'side_chain')):
+            g.ndata[name] = torch.from_numpy(nodes[key].astype(np.float32))
+        g.edata['distance'] = torch.from_numpy(distance.astype(np.float32))
+        graphs.append(g)
+        metrics.count('graph_edges', g.num_edges())
+    return graphs
+
+def coarse_points(nodes):
+    """
+    (n, 4) rows of side-chain centroid and residue class, the input of `Voxelizer` for the coarse grid.
+    """
+    return np.column_stack([nodes['side_chain'], CLASS_OF_TYPE[nodes['type']]])
+
+@metrics.timed('voxelize')
+def coarse_batch(points, voxelizer, channels='last'):
+    """
+    Coarse grids of binding sites: one channel per RESIDUE_CLASSES entry, holding the
+    number of residues of that class whose side chain is in the voxel.
+
+    The residues of all the sites are binned with one `np.bincount` into an aligned batch
+    (see `Voxelizer.batch`); with a COARSE_VOXEL_SIZE grid this is about a tenth of the
+    values of a one-channel 1 Å atom grid of the same box.
+
+    Args:
+        points (list of numpy.ndarray): `coarse_points` of each site.
+        voxelizer (Voxelizer): the coarse grid.
+        channels (str): 'last' or 'first'.
+
+    Returns:
+        numpy.ndarray: (n, x, y, z, classes) or (n, classes, x, y, z) float32 batch.
+    """
+    shape = voxelizer.batch_shape(len(points), channels, len(RESIDUE_CLASSES))
+    batch = aligned_zeros(shape, np.float32)
+    data = np.concatenate(points) if len(points) else np.zeros((0, 4))
+    owner = np.repeat(np.arange(len(points)), [len(p) for p in points])
+    indices = voxelizer.index_array(data)
+    classes = data[:, 3].astype(np.int64)
+    if channels == 'first':
+        flat = np.ravel_multi_index((owner, classes, indices[:, 0], indices[:, 1], indices[:, 2]), shape)
+    else:
+        flat = np.ravel_multi_index((owner, indices[:, 0], indices[:, 1], indices[:, 2], classes), shape)
+    batch.reshape(-1)[...] = np.bincount(flat, minlength=batch.size)
+    return batch
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='residue-level graphs and coarse grids of binding sites')
+    parser.add_argument("source", help='.bsa archive or directory of _binding_site.pdb/_ligand.pdb pairs')
+    parser.add_argument("-o", "--output", required=True, help='.npz file with the nodes, edges and (with -v or -g) the coarse grids')
+    parser.add_argument("-c", "--cutoff", type=float, default=CONTACT_CUTOFF, help=f'Cα contact distance of the edges; default is {CONTACT_CUTOFF}Å')
+    parser.add_argument("-v", "--voxel_size", type=float, default=None, help=f'if included, coarse grids of this voxel size (i.e. {COARSE_VOXEL_SIZE}Å) spanning every site are saved as well')
+    parser.add_argument("-g", "--grid", required=False, help='if included, the coarse grids use this grid (Voxelizer.save_spec)')
+    args = parser.parse_args()
+
+    from interactions import iter_complexes
+    from voxelizer import Voxelizer
+
+    start = time.perf_counter()
+    arrays, names, points = {}, [], []
+    n_atoms = n_residues = n_edges = 0
+    for name, _, site in iter_complexes(args.source):
+        with metrics.file(name):
+            nodes = residue_nodes(site)
+            src, dst, distance = residue_edges(nodes, args.cutoff)
+        arrays[f'{name}/features'] = node_features(nodes)
+        arrays[f'{name}/coords'] = np.stack([nodes['centroid'], nodes['ca'], nodes['side_chain']], axis=1).astype(np.float32)
+        arrays[f'{name}/edges'] = np.stack([src, dst]).astype(np.int32)
+        arrays[f'{name}/distance'] = distance.astype(np.float32)
+        names.append(name)
+        points.append(coarse_points(nodes))
+        n_atoms += len(site)
+        n_residues += len(nodes['type'])
+        n_edges += len(src)
+
+    if args.grid or args.voxel_size:
+        if args.grid:
+            with open(args.grid) as f:
+                voxelizer = Voxelizer.from_spec(json.load(f))
+        else:
+            voxelizer = Voxelizer(points, voxel_size=args.voxel_size)
+        arrays['grids'] = coarse_batch(points, voxelizer)
+        arrays['spec'] = np.array(json.dumps(voxelizer.spec()))
+        print(f"** coarse grids {'x'.join(str(n) for n in arrays['grids'].shape[1:])}")
+    np.savez_compressed(args.output, names=np.array(names), **arrays)
+    print(f'** {len(names)} binding sites: {n_atoms} atoms as {n_residues} residues ({n_atoms / max(n_residues, 1):.1f} atoms per node), '
+          f'{n_edges} contacts, in {time.perf_counter() - start:.1f} s')
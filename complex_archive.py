@@ -0,0 +1,281 @@
+import numpy as np
+import pandas as pd
+import argparse
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+from structure import element_field
+
+# One fixed size record per atom; 48 bytes instead of an 81 byte .pdb line
+ATOM_DTYPE = np.dtype([
+    ('record_name', 'S6'),
+    ('serial_number', '<i4'),
+    ('atom_name', 'S4'),
+    ('residue', 'S4'),
+    ('chain', 'S2'),
+    ('res_seq', '<i4'),
+    ('orth_x', '<f4'),
+    ('orth_y', '<f4'),
+    ('orth_z', '<f4'),
+    ('occupancy', '<f4'),
+    ('temp_factor', '<f4'),
+    ('element_plus_charge', 'S4'),
+])
+FORMAT_VERSION = 1
+PARTS = ('binding_site', 'ligand', 'combo')
+
+def to_records(df):
+    """
+    Converts a pdb dataframe (`process_pdb` layout) into an array of ATOM_DTYPE records.
+    """
+    records = np.zeros(len(df), dtype=ATOM_DTYPE)
+    for name in ('record_name', 'atom_name', 'residue', 'chain', 'element_plus_charge'):
+        records[name] = df[name].astype(str).str.encode('ascii').to_numpy()
+    for name in ('serial_number', 'res_seq'):
+        records[name] = pd.to_numeric(df[name]).to_numpy()
+    for name in ('orth_x', 'orth_y', 'orth_z'):
+        records[name] = df[name].to_numpy(dtype=float)
+    for name in ('occupancy', 'temp_factor'):
+        records[name] = pd.to_numeric(df[name], errors='coerce').fillna(0).to_numpy()
+    return records
+
+def to_dataframe(records):
+    """
+    Converts ATOM_DTYPE records into a pdb dataframe with the same columns as `process_pdb`.
+    """
+    df = pd.DataFrame({name: records[name] for name in ATOM_DTYPE.names})
+    for name in ('record_name', 'atom_name', 'residue', 'chain', 'element_plus_charge'):
+        df[name] = df[name].str.decode('ascii')
+    for name in ('orth_x', 'orth_y', 'orth_z'):
+        # Coordinates are stored as float32; rounding restores the 3 decimals of the .pdb
+        df[name] = np.round(df[name].astype(float), 3)
+    for name in ('occupancy', 'temp_factor'):
+        df[name] = df[name].map('{:.2f}'.format)
+    return df
+
+def to_pdb(records):
+    """
+    Formats ATOM_DTYPE records as .pdb text, in the same layout as `binding_site.write_pdb`.
+    """
+    lines = []
+    for row in records:
+        atom_line = f'{row["record_name"].decode():<6}{row["serial_number"]:>5}{row["atom_name"].decode():>5}{row["residue"].decode():>4}{row["chain"].decode():>2}{row["res_seq"]:>4}{row["orth_x"]:>12.3f}{row["orth_y"]:>8.3f}{row["orth_z"]:>8.3f}{row["occupancy"]:>6.2f}{row["temp_factor"]:>6.2f}{element_field(row["element_plus_charge"].decode())}'
+        lines.append(atom_line + '\n')
+    return ''.join(lines)
+
+
+class ComplexView:
+    """
+    A complex stored in the archive. `binding_site`, `ligand` and `combo` are views into
+    the memory-mapped archive; nothing is copied until they are converted.
+    """
+    def __init__(self, key, records, entry):
+        self.key = key
+        self.entry = entry
+        self.meta = entry.get('meta', {})
+        n_site = entry['n_site']
+        self.combo = records
+        self.binding_site = records[:n_site]
+        self.ligand = records[n_site:]
+
+    def __len__(self):
+        return len(self.combo)
+
+    def __repr__(self):
+        return f'ComplexView({self.key!r}, binding_site={len(self.binding_site)}, ligand={len(self.ligand)})'
+
+    def coords(self, part='combo'):
+        """
+        Returns the (n, 3) float32 coordinates of a part.
+        """
+        records = getattr(self, part)
+        return np.stack([records['orth_x'], records['orth_y'], records['orth_z']], axis=1)
+
+    def to_dataframe(self, part='combo'):
+        return to_dataframe(getattr(self, part))
+
+    def to_pdb(self, part='combo'):
+        return to_pdb(getattr(self, part))
+
+
+class ComplexArchive:
+    """
+    Packed archive of binding site/ligand complexes.
+
+    An archive is two files:
+        NAME.bsa      the atoms of every complex as contiguous ATOM_DTYPE records,
+                      binding site atoms first then ligand atoms.
+        NAME.bsa.idx  JSON lines; a header line then one line per complex with its
+                      'key', first record 'start', 'n_site', 'n_ligand' and 'meta'.
+
+    Appends take an exclusive lock on the index, so several processes can write to the
+    same archive. Reads memory-map the atoms file, and the combo of a complex is the
+    slice covering both parts, so no combo files are ever written.
+
+    Args:
+        path (str): path of the .bsa file.
+        mode (str): 'r' to read, 'a' to read and append (the archive is created if needed).
+    """
+    def __init__(self, path, mode='r'):
+        self.path = str(path)
+        self.index_path = self.path + '.idx'
+        self.mode = mode
+        self.entries = {}
+        self._records = None
+        self._index_offset = 0
+
+        if mode == 'a' and not os.path.exists(self.index_path):
+            with self._locked():
+                if not os.path.exists(self.index_path) or os.path.getsize(self.index_path) == 0:
+                    open(self.path, 'ab').close()
+                    with open(self.index_path, 'w') as f:
+                        f.write(json.dumps({'format': 'bsa', 'version': FORMAT_VERSION, 'dtype': ATOM_DTYPE.descr}) + '\n')
+        elif mode not in ('r', 'a'):
+            raise ValueError(f"mode must be 'r' or 'a', not {mode!r}")
+        self.refresh()
+
+    @contextmanager
+    def _locked(self):
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def refresh(self):
+        """
+        Reads index lines added since the last refresh (i.e. by another process).
+        """
+        with open(self.index_path) as f:
+            f.seek(self._index_offset)
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # an append in progress
+                self._index_offset += len(line.encode())
+                entry = json.loads(line)
+                if 'format' in entry:
+                    if entry['version'] != FORMAT_VERSION:
+                        raise ValueError(f"{self.path} is version {entry['version']}, expected {FORMAT_VERSION}")
+                    continue
+                self.entries[entry['key']] = entry
+        self._records = None
+
+    @property
+    def records(self):
+        """
+        Every atom of the archive, memory-mapped.
+        """
+        if self._records is None:
+            n = os.path.getsize(self.path) // ATOM_DTYPE.itemsize
+            self._records = np.memmap(self.path, dtype=ATOM_DTYPE, mode='r', shape=(n,)) if n else np.zeros(0, dtype=ATOM_DTYPE)
+        return self._records
+
+    def append(self, key, binding_site, ligand, **meta):
+        """
+        Appends a complex to the archive.
+
+        Args:
+            key (str): name of the complex, i.e. '1abc_LIG'. A later append with the same key replaces it.
+            binding_site (pandas.DataFrame or numpy.ndarray): binding site atoms (dataframe or ATOM_DTYPE records).
+            ligand (pandas.DataFrame or numpy.ndarray): ligand atoms.
+            **meta: JSON serializable information stored with the complex.
+        """
+        if self.mode != 'a':
+            raise ValueError('archive is opened read-only')
+        site = binding_site if isinstance(binding_site, np.ndarray) else to_records(binding_site)
+        lig = ligand if isinstance(ligand, np.ndarray) else to_records(ligand)
+        data = np.concatenate([site, lig]).astype(ATOM_DTYPE, copy=False)
+
+        with self._locked():
+            with open(self.path, 'ab') as f:
+                start = f.tell() // ATOM_DTYPE.itemsize
+                f.write(data.tobytes())
+            entry = {'key': key, 'start': int(start), 'n_site': len(site), 'n_ligand': len(lig), 'meta': meta}
+            with open(self.index_path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+        self.entries[key] = entry
+        self._records = None
+        return entry
+
+    def __getitem__(self, key):
+        entry = self.entries[key]
+        stop = entry['start'] + entry['n_site'] + entry['n_ligand']
+        if stop > len(self.records):
+            self.refresh()
+        return ComplexView(key, self.records[entry['start']:stop], entry)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def items(self):
+        for key in self.entries:
+            yield key, self[key]
+
+
+def pack_directory(directory, archive_path):
+    """
+    Packs every {name}_binding_site.pdb/{name}_ligand.pdb pair of a directory into an archive.
+
+    Returns:
+        int: number of complexes packed.
+    """
+    from process_pdb import process_pdb
+
+    archive = ComplexArchive(archive_path, 'a')
+    n = 0
+    for site_file in sorted(Path(directory).glob('*_binding_site.pdb')):
+        if site_file.name.startswith('._'):
+            continue
+        key = site_file.name[:-len('_binding_site.pdb')]
+        ligand_file = site_file.with_name(f'{key}_ligand.pdb')
+        if not ligand_file.exists():
+            print(f'** skipping {key}: no {ligand_file.name}')
+            continue
+        archive.append(key, process_pdb(str(site_file)), process_pdb(str(ligand_file)), source=str(site_file.parent))
+        n += 1
+    return n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='packed archive of binding site/ligand complexes')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    pack = subparsers.add_parser('pack', help='pack the _binding_site.pdb/_ligand.pdb pairs of a directory')
+    pack.add_argument("directory")
+    pack.add_argument("archive", help='.bsa archive (created or appended to)')
+
+    listing = subparsers.add_parser('list', help='list the complexes of an archive')
+    listing.add_argument("archive")
+
+    extract = subparsers.add_parser('extract', help='write a complex as a .pdb file')
+    extract.add_argument("archive")
+    extract.add_argument("key")
+    extract.add_argument("-p", "--part", choices=PARTS, default='combo', help='default is combo')
+    extract.add_argument("-o", "--output", required=True)
+
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        print(f'** packed {pack_directory(args.directory, args.archive)} complexes into {args.archive}')
+    elif args.command == 'list':
+        archive = ComplexArchive(args.archive)
+        for key, entry in archive.entries.items():
+            print(f"{key}\t{entry['n_site']}\t{entry['n_ligand']}")
+        print(f'** {len(archive)} complexes, {len(archive.records)} atoms')
+    elif args.command == 'extract':
+        archive = ComplexArchive(args.archive)
+        with open(args.output, 'w') as f:
+            f.write(archive[args.key].to_pdb(args.part))
@@ -1,9 +1,6 @@
 #!/bin/bash
 
-for FILE in *_ligand.pdb
-do
-    f=$(basename $FILE .pdb)
-    LIGAND=$(head -1 $FILE | awk '{print $4}')
-    URL="https://files.rcsb.org/ligands/download/${LIGAND}_ideal.sdf"
-    wget -O $f.sdf $URL
-done 
\ No newline at end of file
+# Downloads the ideal SDF of the ligand of every *_ligand.pdb file (saved as *_ligand.sdf),
+# several at a time over kept-alive connections; files already downloaded are skipped
+SCRIPT_DIR=$(dirname "$0")
+python3 "$SCRIPT_DIR/downloader.py" -lp *_ligand.pdb "$@"
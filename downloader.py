@@ -0,0 +1,334 @@
+import argparse
+import asyncio
+import http.client
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlsplit, urljoin
+
+from metrics import metrics
+
+RCSB_FILES = 'https://files.rcsb.org'
+# {id} is upper case for both; the ligand templates are the ones used by bonds_protein_df
+URL_TEMPLATES = {
+    'pdb': '{base}/download/{id}.pdb',
+    'cif': '{base}/download/{id}.cif',
+    'sdf': '{base}/ligands/download/{id}_ideal.sdf',
+}
+RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+class DownloadError(Exception):
+    """
+    Raised when a file could not be downloaded; `retry` is False for errors such as 404 that retrying cannot fix.
+    """
+    def __init__(self, message, status=None, retry=True):
+        super().__init__(message)
+        self.status = status
+        self.retry = retry
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP(S) connections, kept per host and reused across downloads.
+
+    Args:
+        size (int): idle connections kept per host.
+        timeout (float): socket timeout in seconds.
+    """
+    def __init__(self, size=8, timeout=60.0):
+        self.size = size
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        with self.lock:
+            idle = self.idle.setdefault((scheme, netloc), queue.LifoQueue())
+        try:
+            return idle.get_nowait()
+        except queue.Empty:
+            return self.new(scheme, netloc)
+
+    def new(self, scheme, netloc):
+        metrics.count('http_connections')
+        connection = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return connection(netloc, timeout=self.timeout)
+
+    def put(self, scheme, netloc, conn):
+        with self.lock:
+            idle = self.idle.setdefault((scheme, netloc), queue.LifoQueue())
+            if idle.qsize() < self.size:
+                idle.put(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                while not idle.empty():
+                    idle.get_nowait().close()
+            self.idle.clear()
+
+
+def _request(pool, url, offset, max_redirects=5):
+    """
+    Sends a GET for `url` (from byte `offset`) and returns (response, scheme, netloc, conn) after redirects.
+    """
+    for _ in range(max_redirects + 1):
+        parts = urlsplit(url)
+        path = parts.path + (f'?{parts.query}' if parts.query else '')
+        conn = pool.get(parts.scheme, parts.netloc)
+        headers = {'Accept-Encoding': 'identity', 'User-Agent': 'bindingsite_cnn-downloader'}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+        except (OSError, http.client.HTTPException):
+            # A kept-alive connection may have been closed by the server; a fresh one is tried once
+            conn.close()
+            conn = pool.new(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+            except BaseException:
+                conn.close()
+                raise
+        if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+            response.read()
+            pool.put(parts.scheme, parts.netloc, conn)
+            url = urljoin(url, response.getheader('Location'))
+            continue
+        return response, parts.scheme, parts.netloc, conn
+    raise DownloadError(f'too many redirects for {url}', retry=False)
+
+def _range_length(response):
+    # The file length of a 416 answer, from its Content-Range: bytes */N
+    total = (response.getheader('Content-Range') or '').rpartition('/')[2].strip()
+    return int(total) if total.isdigit() else None
+
+def fetch(url, dest, pool, retries=4, backoff=1.0, chunk_size=1 << 16):
+    """
+    Downloads `url` to `dest`, resuming a partial download and retrying transient errors.
+
+    The file is written to DEST.part and renamed when complete, so `dest` only ever
+    exists complete. A DEST.part left by an interrupted run is resumed with a Range
+    request (the server may answer with the whole file instead); a 416 answer completes
+    it only when its Content-Range gives the length of DEST.part, and otherwise DEST.part
+    is deleted and downloaded again.
+
+    Args:
+        url (str): file URL.
+        dest (str): output file; nothing is downloaded if it exists and is not empty.
+        pool (ConnectionPool): connections to reuse.
+        retries (int): retries of transient errors (connection errors, 429 and 5xx).
+        backoff (float): first retry delay in seconds; doubled (with jitter) at each retry.
+
+    Returns:
+        str: 'cached', 'downloaded' or 'resumed'.
+    """
+    if os.path.isfile(dest) and os.path.getsize(dest) > 0:
+        metrics.cache('download', True)
+        return 'cached'
+    metrics.cache('download', False)
+    part = f'{dest}.part'
+    resumed = False
+
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        conn = None
+        try:
+            response, scheme, netloc, conn = _request(pool, url, offset)
+            if response.status == 416 and offset:
+                response.read()
+                # The partial file is complete only if it is as long as the file; otherwise it
+                # is not a prefix of it (i.e. the file changed) and is downloaded again from 0
+                if _range_length(response) != offset:
+                    os.remove(part)
+                    raise DownloadError(f'{url}: {part} does not match the file length', 416, retry=True)
+            elif response.status in (200, 206):
+                mode = 'ab' if response.status == 206 else 'wb'
+                resumed = resumed or response.status == 206
+                with open(part, mode) as f:
+                    while True:
+                        chunk = response.read(chunk_size)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        metrics.count('bytes_downloaded', len(chunk))
+                expected = response.getheader('Content-Length')
+                if expected is not None and response.status == 200 and os.path.getsize(part) != int(expected):
+                    raise DownloadError(f'{url}: incomplete body', retry=True)
+            else:
+                response.read()
+                raise DownloadError(f'{url}: HTTP {response.status} {response.reason}', response.status, retry=response.status in RETRY_STATUS)
+
+            if response.will_close:
+                conn.close()
+            else:
+                pool.put(scheme, netloc, conn)
+            os.replace(part, dest)
+            return 'resumed' if resumed else 'downloaded'
+
+        except (OSError, http.client.HTTPException, DownloadError) as e:
+            if conn is not None:
+                conn.close()
+            if isinstance(e, DownloadError) and not e.retry or attempt == retries:
+                if isinstance(e, DownloadError):
+                    raise
+                raise DownloadError(f'{url}: {type(e).__name__}: {e}') from e
+            metrics.count('download_retries')
+            time.sleep(backoff * 2 ** attempt * (0.5 + random.random()))
+
+async def download_all(tasks, concurrency=8, retries=4, backoff=1.0, progress=True):
+    """
+    Downloads (url, dest) pairs concurrently over a shared pool of keep-alive connections.
+
+    At most `concurrency` downloads run at once; each runs in a worker thread so that the
+    event loop only schedules them.
+
+    Args:
+        tasks (iterable): (url, dest) pairs.
+        concurrency (int): downloads in flight.
+        retries (int): retries per file.
+        backoff (float): first retry delay in seconds.
+        progress (bool): if True, a line is printed every 100 files.
+
+    Returns:
+        dict: {dest: 'cached', 'downloaded', 'resumed' or the error message}
+    """
+    tasks = list(dict.fromkeys(tasks))
+    pool = ConnectionPool(size=concurrency)
+    results = {}
+    loop = asyncio.get_running_loop()
+    limit = asyncio.Semaphore(concurrency)
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        async def one(url, dest):
+            async with limit:
+                try:
+                    results[dest] = await loop.run_in_executor(executor, fetch, url, dest, pool, retries, backoff)
+                except DownloadError as e:
+                    results[dest] = str(e)
+                if progress and len(results) % 100 == 0:
+                    print(f'** {len(results)}/{len(tasks)} files in {time.perf_counter() - start:.1f} s', file=sys.stderr)
+
+        with metrics.stage('download'):
+            await asyncio.gather(*(one(url, dest) for url, dest in tasks))
+    pool.close()
+    return results
+
+def download(tasks, concurrency=8, retries=4, backoff=1.0, progress=True):
+    """
+    Blocking version of `download_all`.
+    """
+    return asyncio.run(download_all(tasks, concurrency, retries, backoff, progress))
+
+_default_pool = None
+
+def fetch_one(url, dest, retries=4, backoff=1.0):
+    """
+    Downloads a single file over the module's shared connection pool (i.e. from bonds_protein_df).
+    """
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = ConnectionPool(size=2)
+    return fetch(url, dest, _default_pool, retries, backoff)
+
+def file_url(kind, id_, base=RCSB_FILES):
+    return URL_TEMPLATES[kind].format(base=base.rstrip('/'), id=id_.upper())
+
+def tasks_for_ids(ids, kind, output_dir, base=RCSB_FILES):
+    """
+    (url, dest) pairs for PDB ids (kind 'pdb' or 'cif', saved as 1abc.pdb) or HET ids (kind 'sdf', saved as LIG_ideal.sdf).
+    """
+    tasks = []
+    for id_ in ids:
+        id_ = id_.strip()
+        if not id_:
+            continue
+        name = f'{id_.upper()}_ideal.sdf' if kind == 'sdf' else f'{id_.lower()}.{kind}'
+        tasks.append((file_url(kind, id_, base), os.path.join(output_dir, name)))
+    return tasks
+
+def ids_from_manifest(manifest_file, kind):
+    """
+    PDB ids (kind 'pdb'/'cif') or ligand HET ids (kind 'sdf') of a job manifest from job_planner.py.
+    """
+    from job_planner import read_manifest
+    ids = []
+    for job in read_manifest(manifest_file):
+        ids.extend(job['ligands'] if kind == 'sdf' else [job['pdb_id']])
+    return list(dict.fromkeys(ids))
+
+def ids_from_txt(path):
+    """
+    Ids of a bindingDB_pdbs.txt (comma separated per line) or bindingDB_ligands.txt file.
+    """
+    ids = []
+    with open(path) as f:
+        for line in f:
+            ids.extend(id_.strip() for id_ in line.split(','))
+    return list(dict.fromkeys(id_ for id_ in ids if id_))
+
+def tasks_for_ligand_files(ligand_files, base=RCSB_FILES):
+    """
+    (url, dest) pairs for the ideal SDF of each {name}_ligand.pdb, saved as {name}_ligand.sdf
+    next to it (what download_BondOrder.sh did).
+    """
+    tasks = []
+    for ligand_file in ligand_files:
+        with open(ligand_file) as f:
+            fields = f.readline().split()
+        if len(fields) > 3:
+            tasks.append((file_url('sdf', fields[3], base), str(Path(ligand_file).with_suffix('.sdf'))))
+    return tasks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='concurrent downloader for structures and ligand templates')
+    parser.add_argument("-j", "--jobs", required=False, help='download the structures (or ligand SDFs with -k sdf) of a job manifest')
+    parser.add_argument("-pf", "--ids_file", required=False, help='ids file i.e. bindingDB_parsing/bindingDB_pdbs.txt (comma separated per line)')
+    parser.add_argument("-id", "--ids", nargs='+', required=False, help='PDB or HET ids')
+    parser.add_argument("-lp", "--ligand_pdbs", nargs='+', required=False, help='*_ligand.pdb files; the ideal SDF of each is saved next to it')
+    parser.add_argument("-k", "--kind", choices=sorted(URL_TEMPLATES), default='pdb', help='default is pdb')
+    parser.add_argument("-o", "--output_dir", default='.', help='default is the current directory')
+    parser.add_argument("-n", "--concurrency", type=int, default=8, help='downloads in flight; default is 8')
+    parser.add_argument("-r", "--retries", type=int, default=4, help='retries per file; default is 4')
+    parser.add_argument("--base_url", default=RCSB_FILES, help=f'default is {RCSB_FILES}')
+    parser.add_argument("-m", "--metrics", required=False, help='if included, timings and counts are appended to this .jsonl file')
+    args = parser.parse_args()
+
+    if args.metrics:
+        metrics.enable(args.metrics)
+
+    if args.ligand_pdbs:
+        tasks = tasks_for_ligand_files(args.ligand_pdbs, args.base_url)
+    else:
+        if args.jobs:
+            ids = ids_from_manifest(args.jobs, args.kind)
+        elif args.ids_file:
+            ids = ids_from_txt(args.ids_file)
+        elif args.ids:
+            ids = args.ids
+        else:
+            parser.error('one of --jobs, --ids_file, --ids or --ligand_pdbs is required')
+        os.makedirs(args.output_dir, exist_ok=True)
+        tasks = tasks_for_ids(ids, args.kind, args.output_dir, args.base_url)
+
+    start = time.perf_counter()
+    results = download(tasks, args.concurrency, args.retries)
+    outcomes = {}
+    for dest, result in results.items():
+        if result not in ('cached', 'downloaded', 'resumed'):
+            print('** failed:', result)
+            result = 'failed'
+        outcomes[result] = outcomes.get(result, 0) + 1
+    print(f"** {len(results)} files in {time.perf_counter() - start:.1f} s: " + '  '.join(f'{name}: {n}' for name, n in sorted(outcomes.items())))
@@ -0,0 +1,235 @@
+import numpy as np
+import argparse
+import json
+import time
+from pathlib import Path
+
+from featurizer import _lookup, parse_element
+from metrics import metrics
+from molblocks import read_molblocks
+from voxelizer import Voxelizer
+
+# Coulomb constant in kcal·Å/(mol·e²); potentials are in kcal/(mol·e)
+COULOMB = 332.0636
+# Dielectric ε(r) = DIELECTRIC * r, in Å⁻¹
+DIELECTRIC = 4.0
+# Potentials are truncated (and shifted to zero) at CUTOFF Å; distances below MIN_DISTANCE
+# Å are raised to it, so a voxel on top of an atom stays finite
+CUTOFF = 10.0
+MIN_DISTANCE = 1.0
+# Atoms whose stencils are evaluated together; bounds the memory of one step
+CHUNK = 256
+
+# United-atom partial charges of the residue templates, {residue: {atom name: charge}}: the
+# charge of a hydrogen is folded into its heavy atom, so they apply to files without
+# hydrogens, and atoms that are not listed (hydrogens included) are neutral. The backbone
+# carries a C=O dipole; charged side chains sum to their formal charge. Termini are neutral:
+# the N-terminus cannot be told from atom names, so OXT is left out rather than charging
+# only the C-terminus.
+BACKBONE_CHARGES = {'C': 0.45, 'O': -0.45}
+RESIDUE_CHARGES = {
+    'ASP': {'CG': 0.27, 'OD1': -0.635, 'OD2': -0.635},
+    'GLU': {'CD': 0.27, 'OE1': -0.635, 'OE2': -0.635},
+    'LYS': {'CE': 0.25, 'NZ': 0.75},
+    'ARG': {'CZ': 0.34, 'NH1': 0.33, 'NH2': 0.33},
+    'HIS': {'ND1': 0.05, 'NE2': -0.05},
+    'SER': {'CB': 0.15, 'OG': -0.15},
+    'THR': {'CB': 0.15, 'OG1': -0.15},
+    'TYR': {'CZ': 0.15, 'OH': -0.15},
+    'ASN': {'CG': 0.45, 'OD1': -0.45},
+    'GLN': {'CD': 0.45, 'OE1': -0.45},
+    'TRP': {'NE1': -0.1, 'CD1': 0.1},
+}
+AMINO_ACID_NAMES = ('ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'GLN', 'GLU', 'GLY', 'HIS', 'ILE',
+                    'LEU', 'LYS', 'MET', 'PHE', 'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL')
+# Charges of single-atom ion residues, by residue name (i.e. IOD has the atom I)
+ION_CHARGES = {'NA': 1.0, 'K': 1.0, 'MG': 2.0, 'CA': 2.0, 'MN': 2.0, 'ZN': 2.0, 'FE': 2.0,
+               'CO': 2.0, 'NI': 2.0, 'CU': 2.0, 'CD': 2.0, 'CL': -1.0, 'BR': -1.0, 'IOD': -1.0}
+# SD properties holding per-atom partial charges (space-separated, in atom order), as
+# RDKit (atom.dprop.PartialCharge), OpenBabel and docking tools write them
+PARTIAL_CHARGE_PROPERTIES = ('atom.dprop.PartialCharge', 'PartialCharges', 'partial_charges', 'atom.dprop._GasteigerCharge')
+
+
+def template_charge(key):
+    """
+    The template charge of an atom from its 'residue:atom name' key; anything that is not an
+    amino acid or an ion (ligands, cofactors) gets its formal charge elsewhere.
+    """
+    residue, name = key.split(':', 1)
+    # Alternate locations are read into the residue column i.e. AARG or BARG
+    if len(residue) == 4 and residue[0] in 'AB':
+        residue = residue[1:]
+    if residue in AMINO_ACID_NAMES:
+        return RESIDUE_CHARGES.get(residue, {}).get(name, BACKBONE_CHARGES.get(name, 0.0))
+    return ION_CHARGES.get(residue, 0.0)
+
+def pdb_charges(df):
+    """
+    Partial charges of the atoms of a pdb dataframe: residue templates for amino acids and
+    ions, and the formal charge of the element column (i.e. N1+) for everything else.
+
+    Both tables are built once over the distinct values and applied with one take (see
+    `featurizer._lookup`).
+
+    Returns:
+        numpy.ndarray: (n_atoms,) float charges.
+    """
+    keys = (df['residue'].astype(str).str.strip() + ':' + df['atom_name'].astype(str).str.strip()).to_numpy()
+    charges = _lookup(keys, template_charge, float)
+    formal = _lookup(df['element_plus_charge'].to_numpy(), lambda value: parse_element(value)[1], float)
+    return np.where(charges != 0, charges, formal)
+
+def read_sdf_charges(path):
+    """
+    Atoms and charges of every molblock of an .sdf file (V2000 or V3000).
+
+    Charges are the partial charges of the first PARTIAL_CHARGE_PROPERTIES property the
+    molblock has and otherwise its formal charges (M  CHG lines, CHG= or the V2000 atom
+    block charge field).
+
+    Returns:
+        list: (name, (n_atoms, 3) coordinates, (n_atoms,) charges) per molblock.
+    """
+    stem = Path(path).stem
+    molecules = []
+    for i, molblock in enumerate(read_molblocks(path), 1):
+        charges = molblock['charges']
+        for name in PARTIAL_CHARGE_PROPERTIES:
+            values = ' '.join(molblock['properties'].get(name, [])).split()
+            if values and len(values) == len(charges):
+                charges = np.asarray(values, dtype=float)
+                break
+        molecules.append((f'{stem}:{i}', molblock['coords'], charges))
+    return molecules
+
+def _stencil(voxel_size, cutoff):
+    # Voxel offsets from the voxel of an atom that can hold a voxel center within `cutoff`
+    # of it, wherever the atom is in its voxel
+    reach = int(np.ceil(cutoff / voxel_size + 0.5))
+    axis = np.arange(-reach, reach + 1)
+    offsets = np.stack(np.meshgrid(axis, axis, axis, indexing='ij'), axis=-1).reshape(-1, 3)
+    nearest = np.maximum(np.abs(offsets) - 0.5, 0) * voxel_size
+    return offsets[(nearest ** 2).sum(axis=1) < cutoff ** 2]
+
+@metrics.timed('electrostatics')
+def potential_grid(voxelizer, coords, charges, cutoff=CUTOFF, out=None):
+    """
+    Electrostatic potential of point charges at the voxel centers of a grid.
+
+    The potential of a charge q at distance r is COULOMB * q / (DIELECTRIC * r²) (a
+    distance-dependent dielectric ε = DIELECTRIC·r), shifted by its value at `cutoff` so it
+    falls to zero there and truncated beyond. The grid doubles as the cell list: every atom
+    is binned into its voxel and only visits the voxels of a precomputed stencil around it,
+    so the cost is atoms × voxels within `cutoff` instead of atoms × grid. Atoms outside the
+    grid still contribute to the voxels within `cutoff` of them, and neutral atoms are skipped.
+
+    Args:
+        voxelizer (Voxelizer): the grid.
+        coords (numpy.ndarray): (n_atoms, 3) coordinates.
+        charges (numpy.ndarray): (n_atoms,) charges in e.
+        cutoff (float): truncation distance in Å.
+        out (numpy.ndarray): if given, an (x, y, z) array the potential is added to
+            (i.e. a channel of a `Voxelizer.batch`, or a cached protein potential).
+
+    Returns:
+        numpy.ndarray: (x, y, z) float32 potential in kcal/(mol·e).
+    """
+    shape = np.array([voxelizer.x_dim, voxelizer.y_dim, voxelizer.z_dim])
+    if out is None:
+        out = np.zeros(tuple(shape), dtype=np.float32)
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+    charges = np.asarray(charges, dtype=float).reshape(-1)
+    size = voxelizer.voxel_size
+    low = np.asarray(voxelizer.global_min, dtype=float)
+    # Only charged atoms within `cutoff` of the grid box
+    keep = (charges != 0) & np.all((coords > low - cutoff) & (coords < low + shape * size + cutoff), axis=1)
+    coords, charges = coords[keep], charges[keep]
+    metrics.count('charged_atoms', len(charges))
+
+    stencil = _stencil(size, cutoff)
+    cells = np.floor((coords - low) / size).astype(np.int64)
+    shift = 1 / cutoff ** 2
+    potential = np.zeros(out.size)
+    for start in range(0, len(charges), CHUNK):
+        voxels = cells[start:start + CHUNK, None, :] + stencil
+        inside = np.all((voxels >= 0) & (voxels < shape), axis=2)
+        atom, offset = np.nonzero(inside)
+        voxels = voxels[atom, offset]
+        r2 = (((voxels + 0.5) * size + low - coords[start + atom]) ** 2).sum(axis=1)
+        near = r2 < cutoff ** 2
+        values = charges[start + atom[near]] * (1 / np.maximum(r2[near], MIN_DISTANCE ** 2) - shift)
+        flat = np.ravel_multi_index(voxels[near].T, tuple(shape))
+        potential += np.bincount(flat, weights=values, minlength=out.size)
+    out += (COULOMB / DIELECTRIC * potential).reshape(out.shape).astype(np.float32)
+    return out
+
+def pocket_potential_stage(pocket_file, spec, cutoff):
+    # Stage function of StageCache, so only its inputs and parameters are used
+    from process_pdb import process_pdb
+    df = process_pdb(str(pocket_file))
+    return potential_grid(Voxelizer.from_spec(spec), df[['orth_x', 'orth_y', 'orth_z']].to_numpy(dtype=float), pdb_charges(df), cutoff)
+
+def pocket_potential(pocket_file, spec, cutoff=CUTOFF, cache=None):
+    """
+    The potential of a binding site .pdb file on a grid, computed once per pocket file, grid
+    and cutoff when `cache` (a StageCache directory) is given.
+
+    Returns:
+        tuple: ((x, y, z) float32 potential, True if it was read from the cache).
+    """
+    if cache:
+        from stage_cache import StageCache
+        artifact = StageCache(cache).run('pocket_potential', pocket_potential_stage, [pocket_file], {'spec': spec, 'cutoff': cutoff})
+        return artifact.value, artifact.hit
+    return pocket_potential_stage(pocket_file, spec, cutoff), False
+
+def ligand_charges(path):
+    """
+    (name, coordinates, charges) of the ligands of an .sdf file (see `read_sdf_charges`) or
+    of a ligand .pdb file (formal charges of its element column).
+    """
+    if str(path).lower().endswith(('.sdf', '.sd', '.mol')):
+        return read_sdf_charges(path)
+    from process_pdb import process_pdb
+    df = process_pdb(str(path))
+    return [(Path(path).stem, df[['orth_x', 'orth_y', 'orth_z']].to_numpy(dtype=float), pdb_charges(df))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='electrostatic potential grids of a binding site and its ligands')
+    parser.add_argument("-p", "--pocket", required=True, help='binding site .pdb file')
+    parser.add_argument("-l", "--ligands", nargs='*', default=[], help='if included, ligand .sdf or .pdb files whose potential is added to the pocket, one grid per ligand')
+    parser.add_argument("-o", "--output", required=True, help='.npy file with the (n, x, y, z) potentials, in kcal/(mol·e)')
+    parser.add_argument("-g", "--grid", required=False, help='grid (Voxelizer.save_spec); default is the pocket box plus --margin')
+    parser.add_argument("-v", "--voxel_size", type=float, default=1.0, help='voxel size when no grid is given; default is 1Å')
+    parser.add_argument("--margin", type=float, default=4.0, help='space around the pocket when no grid is given; default is 4Å')
+    parser.add_argument("-c", "--cutoff", type=float, default=CUTOFF, help=f'truncation distance of the potential; default is {CUTOFF}Å')
+    parser.add_argument("-C", "--cache", required=False, help='if included, the pocket potential is kept in this StageCache directory')
+    parser.add_argument("-m", "--metrics", required=False, help='if included, timings are appended to this .jsonl file')
+    args = parser.parse_args()
+
+    if args.metrics:
+        metrics.enable(args.metrics)
+
+    if args.grid:
+        with open(args.grid) as f:
+            spec = json.load(f)
+    else:
+        from inference import pocket_data
+        from pose_screen import pocket_spec
+        spec = pocket_spec(pocket_data(args.pocket), args.voxel_size, args.margin)
+    voxelizer = Voxelizer.from_spec(spec)
+
+    start = time.perf_counter()
+    pocket, cached = pocket_potential(args.pocket, spec, args.cutoff, args.cache)
+    print(f"** pocket potential {'x'.join(str(n) for n in pocket.shape)} {'read from the cache' if cached else 'computed'} in {time.perf_counter() - start:.2f} s")
+
+    start = time.perf_counter()
+    grids = [pocket]
+    for path in args.ligands:
+        for name, coords, charges in ligand_charges(path):
+            grids.append(potential_grid(voxelizer, coords, charges, args.cutoff, out=pocket.copy()))
+    if args.ligands:
+        print(f'** {len(grids) - 1} ligand potentials in {time.perf_counter() - start:.2f} s')
+    np.save(args.output, np.stack(grids[1:] if args.ligands else grids))
+    print(f'** potential from {float(pocket.min()):.1f} to {float(pocket.max()):.1f} kcal/(mol·e) in the pocket, saved to {args.output}')
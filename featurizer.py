@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+
+# Element codes shared by the graph (se3_prep.py) and voxel (TEMP_voxelizer+keras.py) pipelines;
+# elements that are not in the table get OTHER
+ELEMENTS_HASH = {'H': 1, 'C': 2, 'O': 3, 'N': 4, 'P': 5, 'S': 6}
+OTHER = 7
+
+FEATURES = ('element', 'hybridization', 'aromatic', 'donor', 'acceptor', 'formal_charge')
+# Hybridization codes
+UNKNOWN, SP, SP2, SP3 = 0, 1, 2, 3
+
+# (hybridization, aromatic, donor, acceptor, formal charge) of the heavy atoms of the standard
+# residues; atoms that are not listed are sp3 carbons or hydrogens (see `_element_defaults`)
+_BACKBONE = {
+    'N': (SP2, 0, 1, 0, 0),
+    'C': (SP2, 0, 0, 0, 0),
+    'O': (SP2, 0, 0, 1, 0),
+    'OXT': (SP2, 0, 0, 1, 0),
+}
+_AROMATIC = (SP2, 1, 0, 0, 0)
+_SIDE_CHAINS = {
+    'PHE': {name: _AROMATIC for name in ('CG', 'CD1', 'CD2', 'CE1', 'CE2', 'CZ')},
+    'TYR': {**{name: _AROMATIC for name in ('CG', 'CD1', 'CD2', 'CE1', 'CE2', 'CZ')}, 'OH': (SP2, 0, 1, 1, 0)},
+    'TRP': {**{name: _AROMATIC for name in ('CG', 'CD1', 'CD2', 'CE2', 'CE3', 'CZ2', 'CZ3', 'CH2')}, 'NE1': (SP2, 1, 1, 0, 0)},
+    'HIS': {**{name: _AROMATIC for name in ('CG', 'CD2', 'CE1')}, 'ND1': (SP2, 1, 1, 1, 0), 'NE2': (SP2, 1, 1, 1, 0)},
+    'ASP': {'CG': (SP2, 0, 0, 0, 0), 'OD1': (SP2, 0, 0, 1, 0), 'OD2': (SP2, 0, 0, 1, -1)},
+    'GLU': {'CD': (SP2, 0, 0, 0, 0), 'OE1': (SP2, 0, 0, 1, 0), 'OE2': (SP2, 0, 0, 1, -1)},
+    'ASN': {'CG': (SP2, 0, 0, 0, 0), 'OD1': (SP2, 0, 0, 1, 0), 'ND2': (SP2, 0, 1, 0, 0)},
+    'GLN': {'CD': (SP2, 0, 0, 0, 0), 'OE1': (SP2, 0, 0, 1, 0), 'NE2': (SP2, 0, 1, 0, 0)},
+    'LYS': {'NZ': (SP3, 0, 1, 0, 1)},
+    'ARG': {'NE': (SP2, 0, 1, 0, 0), 'CZ': (SP2, 0, 0, 0, 0), 'NH1': (SP2, 0, 1, 0, 0), 'NH2': (SP2, 0, 1, 0, 1)},
+    'SER': {'OG': (SP3, 0, 1, 1, 0)},
+    'THR': {'OG1': (SP3, 0, 1, 1, 0)},
+    'CYS': {'SG': (SP3, 0, 0, 0, 0)},
+    'MET': {'SD': (SP3, 0, 0, 0, 0)},
+    'PRO': {'N': (SP2, 0, 0, 0, 0)},
+}
+AMINO_ACIDS = ('ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'GLN', 'GLU', 'GLY', 'HIS', 'ILE',
+               'LEU', 'LYS', 'MET', 'PHE', 'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL')
+
+def parse_element(element_plus_charge):
+    """
+    Splits the element column of a .pdb (i.e. 'C', 'N1+', 'FE2+', 'O1-') into (element, formal charge).
+    """
+    value = element_plus_charge.strip().upper()
+    charge = 0
+    if len(value) >= 2 and value[-1] in '+-' and value[-2].isdigit():
+        charge = int(value[-2]) * (1 if value[-1] == '+' else -1)
+        value = value[:-2]
+    elif value and value[-1] in '+-':
+        charge = 1 if value[-1] == '+' else -1
+        value = value[:-1]
+    # Anything before the element (i.e. a segment id spilling into the column) is dropped
+    parts = value.split()
+    return (parts[-1] if parts else ''), charge
+
+def _lookup(values, fn, dtype):
+    """
+    Evaluates `fn` once per distinct value and maps the results back with one take.
+    """
+    if len(values) == 0:
+        return np.zeros(0, dtype=dtype)
+    inverse, uniques = pd.factorize(np.asarray(values, dtype=object))
+    table = np.array([fn(str(value)) for value in uniques], dtype=dtype)
+    return table[inverse]
+
+def element_codes(element_plus_charge, hashing=ELEMENTS_HASH, default=OTHER):
+    """
+    Maps the element column of a pdb dataframe to element codes.
+
+    The table is built once over the distinct values of the column and applied with a
+    single take, instead of one dictionary lookup per atom. Charges are stripped first,
+    so 'N1+' gets the code of 'N'.
+
+    Args:
+        element_plus_charge (array-like): the 'element_plus_charge' column.
+        hashing (dict): {element: code}; defaults to `ELEMENTS_HASH`.
+        default (int): code of the elements not in `hashing`.
+
+    Returns:
+        numpy.ndarray: int64 codes.
+    """
+    return _lookup(element_plus_charge, lambda value: hashing.get(parse_element(value)[0], default), np.int64)
+
+def element_lookup_table(pool, hashing=ELEMENTS_HASH, default=OTHER):
+    """
+    Element codes of every string of a `structure.StringPool`, so that the codes of a
+    `Structure` are `table[structure['element_plus_charge']]`.
+    """
+    return np.array([hashing.get(parse_element(value)[0], default) for value in pool.strings], dtype=np.int64)
+
+def _element_defaults(element, charge):
+    # Atoms that are not in the residue templates (ligands, ions, hydrogens)
+    if element == 'O':
+        return (SP3, 0, 0, 1, charge)
+    if element in ('C', 'N', 'S', 'P'):
+        return (SP3, 0, 0, 0, charge)
+    return (UNKNOWN, 0, 0, 0, charge)
+
+def _template_features(key):
+    residue, atom_name, element_plus_charge = key.split('|')
+    element, charge = parse_element(element_plus_charge)
+    template = _SIDE_CHAINS.get(residue, {}).get(atom_name)
+    if template is None and residue in AMINO_ACIDS:
+        template = _BACKBONE.get(atom_name)
+    if template is None:
+        return _element_defaults(element, charge)
+    hybridization, aromatic, donor, acceptor, template_charge = template
+    # A charge written in the file wins over the template
+    return (hybridization, aromatic, donor, acceptor, charge or template_charge)
+
+def atom_features(df, hashing=ELEMENTS_HASH, default=OTHER):
+    """
+    Per-atom features of a pdb dataframe, computed for every atom at once.
+
+    Columns are `FEATURES`: element code, hybridization (0 unknown, 1 sp, 2 sp2, 3 sp3),
+    aromatic, H-bond donor, H-bond acceptor and formal charge. Protein atoms get them
+    from residue templates; other atoms from their element and the charge written in the
+    file. For ligands with bond orders, `mol_features` gives the same columns from RDKit.
+
+    Args:
+        df (pandas.DataFrame): pdb dataframe from `process_pdb`.
+        hashing (dict): element codes.
+        default (int): code of the elements not in `hashing`.
+
+    Returns:
+        numpy.ndarray: (n, 6) float32 array.
+    """
+    features = np.zeros((len(df), len(FEATURES)), dtype=np.float32)
+    features[:, 0] = element_codes(df['element_plus_charge'], hashing, default)
+    keys = (df['residue'].astype(str) + '|' + df['atom_name'].astype(str) + '|' + df['element_plus_charge'].astype(str)).to_numpy()
+    features[:, 1:] = _lookup(keys, _template_features, np.dtype((np.float32, 5)))
+    return features
+
+def mol_features(mol, hashing=ELEMENTS_HASH, default=OTHER):
+    """
+    `atom_features` columns for the atoms of an RDKit molecule (i.e. a ligand with its bond orders).
+    """
+    from rdkit import Chem
+    hybridizations = {Chem.HybridizationType.SP: SP, Chem.HybridizationType.SP2: SP2, Chem.HybridizationType.SP3: SP3}
+    features = np.zeros((mol.GetNumAtoms(), len(FEATURES)), dtype=np.float32)
+    for atom in mol.GetAtoms():
+        symbol = atom.GetSymbol().upper()
+        hydrogens = atom.GetTotalNumHs()
+        features[atom.GetIdx()] = (
+            hashing.get(symbol, default),
+            hybridizations.get(atom.GetHybridization(), UNKNOWN),
+            atom.GetIsAromatic(),
+            symbol in ('N', 'O') and hydrogens > 0,
+            symbol == 'O' or (symbol == 'N' and not atom.GetIsAromatic() and atom.GetFormalCharge() <= 0 and atom.GetDegree() + hydrogens < 4 and hydrogens == 0),
+            atom.GetFormalCharge(),
+        )
+    return features
+
+def features_dataframe(df, **kwargs):
+    """
+    `atom_features` as a dataframe with the `FEATURES` column names and the index of `df`.
+    """
+    return pd.DataFrame(atom_features(df, **kwargs), columns=FEATURES, index=df.index)
@@ -43,6 +43,11 @@ if [ "$#" -eq 0 ]; then
         eval "$command"
         echo ""
     done
+
+	# Summary of the per-stage timings when instrumentation is on (BSITE_METRICS=run.jsonl)
+	if [ -n "$BSITE_METRICS" ]; then
+		python3 metrics.py "$BSITE_METRICS"
+	fi
 	exit 0
 fi
 
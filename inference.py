@@ -0,0 +1,255 @@
+import numpy as np
+import argparse
+import json
+import os
+import sys
+import time
+from contextlib import nullcontext
+from multiprocessing import Pool
+from pathlib import Path
+
+from featurizer import element_codes
+from metrics import metrics
+from tensors import aligned_zeros
+from voxelizer import Voxelizer
+
+# Predictions with at most this many values are written inline in the JSON lines output;
+# larger ones (i.e. per-voxel class scores) are saved as .npy files
+INLINE_VALUES = 64
+
+
+def load_model(model_path):
+    """
+    Loads a saved Keras model (.keras, .h5 or SavedModel directory) once for the whole run.
+    """
+    from tensorflow import keras
+    with metrics.stage('model_load'):
+        return keras.models.load_model(model_path, compile=False)
+
+def pocket_tasks(sources):
+    """
+    Expands the inputs into (name, source, archive key) tasks: .pdb files are used as they
+    are, directories give their *_binding_site.pdb files and .bsa archives the binding site
+    of every complex.
+    """
+    tasks = []
+    for source in sources:
+        source = str(source)
+        if source.endswith('.bsa'):
+            from complex_archive import ComplexArchive
+            tasks.extend((key, source, key) for key in ComplexArchive(source).keys())
+        elif os.path.isdir(source):
+            for site_file in sorted(Path(source).glob('*_binding_site.pdb')):
+                if not site_file.name.startswith('._'):
+                    tasks.append((site_file.name[:-len('_binding_site.pdb')], str(site_file), None))
+        else:
+            tasks.append((Path(source).stem, source, None))
+    return tasks
+
+_archives = {}
+
+def pocket_data(source, key=None):
+    """
+    The (x, y, z, element code) rows of a pocket, as `process_pdb_file` in TEMP_voxelizer+keras.py builds them.
+    """
+    if key is not None:
+        if source not in _archives:
+            from complex_archive import ComplexArchive
+            _archives[source] = ComplexArchive(source)
+        df = _archives[source][key].to_dataframe('binding_site')
+    else:
+        from process_pdb import process_pdb
+        df = process_pdb(source)
+    data = np.zeros((len(df), 4))
+    data[:, :3] = df[['orth_x', 'orth_y', 'orth_z']].to_numpy(dtype=float)
+    data[:, 3] = element_codes(df['element_plus_charge'])
+    return data
+
+def _prepare(args):
+    """
+    Parses and voxelizes one pocket (in a worker process); only the occupied voxels are sent back.
+    """
+    (name, source, key), spec, center = args
+    start = time.time()
+    try:
+        data = pocket_data(source, key)
+        voxelizer = Voxelizer.from_spec(spec)
+        if center:
+            data[:, :3] += voxelizer.global_min + np.array(spec['shape']) * voxelizer.voxel_size / 2 - data[:, :3].mean(axis=0)
+        indices = voxelizer.index_array(data)
+        return {'name': name, 'source': source, 'start': start, 'indices': indices, 'values': data[:, 3].astype(np.float32),
+                'prepare': time.time() - start}
+    except Exception as e:
+        return {'name': name, 'source': source, 'start': start, 'error': f'{type(e).__name__}: {e}'}
+
+def _done_names(output):
+    # Pockets already in the output of an earlier run, so an interrupted screen can be restarted
+    if not os.path.isfile(output):
+        return set()
+    with open(output) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    # Pockets that failed are tried again
+    return {record['name'] for record in records if 'error' not in record}
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) else 0.0
+
+
+class Screen:
+    """
+    Scores pockets with a model that is loaded once, in micro-batches.
+
+    Pockets are parsed and voxelized by `workers` processes (or inline) while the main
+    process writes them into aligned batches of up to `batch_size` and calls `predict_on_batch`.
+    Every prediction is appended to the output as soon as its batch is scored.
+
+    Args:
+        model: a loaded Keras model (see `load_model`), or anything with `input_shape`
+            and `predict_on_batch`.
+        spec (dict): `Voxelizer.spec()` of the training grid. When not given, the grid is
+            the model's input shape at `voxel_size` with every pocket centered in it.
+        voxel_size (float): voxel size in Å when `spec` is not given.
+        center (bool): if True, pockets are centered in the `spec` grid instead of using their coordinates.
+        batch_size (int): largest micro-batch.
+    """
+    def __init__(self, model, spec=None, voxel_size=1.0, center=False, batch_size=32):
+        self.model = model
+        input_shape = tuple(model.input_shape[1:])
+        self.shape = input_shape[:3]
+        self.channels = input_shape[3] if len(input_shape) > 3 else None
+        if spec is None:
+            spec = {'global_min': list(-np.array(self.shape) * voxel_size / 2), 'shape': list(self.shape), 'voxel_size': voxel_size}
+            center = True
+        if tuple(spec['shape']) != self.shape:
+            raise ValueError(f"grid {tuple(spec['shape'])} does not match the model input {self.shape}")
+        self.spec = spec
+        self.center = center
+        self.batch_size = batch_size
+        self.latencies = []
+        self.predict_seconds = 0.0
+        self.n_batches = 0
+
+    def _dense(self, batch):
+        # Grids are written in place into one aligned batch instead of stacking copies
+        dense = aligned_zeros((len(batch),) + self.shape + ((1,) if self.channels is not None else ()), np.float32)
+        grids = dense.reshape((len(batch),) + self.shape)
+        for grid, item in zip(grids, batch):
+            indices = item['indices']
+            grid[indices[:, 0], indices[:, 1], indices[:, 2]] = item['values']
+        return dense
+
+    def _flush(self, batch, write):
+        start = time.perf_counter()
+        with metrics.stage('predict'):
+            predictions = np.asarray(self.model.predict_on_batch(self._dense(batch)))
+        self.predict_seconds += time.perf_counter() - start
+        self.n_batches += 1
+        metrics.count('pockets_scored', len(batch))
+        end = time.time()
+        for item, prediction in zip(batch, predictions):
+            latency = end - item['start']
+            self.latencies.append(latency)
+            write(item, prediction, latency)
+
+    def run(self, tasks, output, arrays_dir=None, workers=1, resume=True, progress=100):
+        """
+        Scores `tasks` (from `pocket_tasks`) and appends one JSON line per pocket to `output`.
+
+        Lines are {"name", "source", "prediction" (a list) or "array" (path of a .npy file
+        with the prediction) and "shape", "latency" (seconds from the start of parsing to
+        the prediction)}, or {"name", "source", "error"}.
+
+        Args:
+            tasks (list): (name, source, archive key) tuples.
+            output (str): JSON lines file.
+            arrays_dir (str): directory for the predictions that are too large to write inline;
+                defaults to OUTPUT_arrays next to `output`.
+            workers (int): processes that parse and voxelize pockets.
+            resume (bool): if True, pockets already in `output` are skipped.
+            progress (int): a progress line is printed every `progress` pockets.
+
+        Returns:
+            dict: throughput and latency summary.
+        """
+        done = _done_names(output) if resume else set()
+        n_tasks = len(tasks)
+        tasks = [task for task in tasks if task[0] not in done]
+        arrays_dir = arrays_dir or f'{os.path.splitext(output)[0]}_arrays'
+        start = time.perf_counter()
+        counts = {'scored': 0, 'failed': 0, 'skipped': n_tasks - len(tasks)}
+
+        with open(output, 'a') as out:
+            def write(item, prediction, latency=None):
+                record = {'name': item['name'], 'source': item['source']}
+                if prediction is None:
+                    record['error'] = item['error']
+                    counts['failed'] += 1
+                else:
+                    if prediction.size <= INLINE_VALUES:
+                        record['prediction'] = prediction.tolist()
+                    else:
+                        os.makedirs(arrays_dir, exist_ok=True)
+                        record['array'] = os.path.join(arrays_dir, f"{item['name']}.npy")
+                        record['shape'] = list(prediction.shape)
+                        np.save(record['array'], prediction)
+                    record['latency'] = round(latency, 4)
+                    counts['scored'] += 1
+                out.write(json.dumps(record) + '\n')
+                n = counts['scored'] + counts['failed']
+                if progress and n % progress == 0:
+                    out.flush()
+                    seconds = time.perf_counter() - start
+                    print(f'** {n}/{len(tasks)} pockets in {seconds:.1f} s ({n / seconds:.1f} per s)', file=sys.stderr)
+
+            args = [(task, self.spec, self.center) for task in tasks]
+            batch = []
+            with Pool(workers) if workers > 1 else nullcontext() as pool:
+                prepared = pool.imap(_prepare, args, chunksize=1) if pool else map(_prepare, args)
+                for item in prepared:
+                    if 'error' in item:
+                        write(item, None)
+                        continue
+                    batch.append(item)
+                    if len(batch) == self.batch_size:
+                        self._flush(batch, write)
+                        out.flush()
+                        batch = []
+                if batch:
+                    self._flush(batch, write)
+
+        seconds = time.perf_counter() - start
+        return {**counts, 'seconds': seconds, 'pockets_per_second': counts['scored'] / seconds if seconds else 0.0,
+                'batches': self.n_batches, 'predict_seconds': self.predict_seconds,
+                'latency_p50': _percentile(self.latencies, 50), 'latency_p95': _percentile(self.latencies, 95),
+                'latency_max': max(self.latencies, default=0.0)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='score many pockets with a saved model loaded once')
+    parser.add_argument("inputs", nargs='+', help='pocket .pdb files, directories of *_binding_site.pdb files or .bsa archives')
+    parser.add_argument("-M", "--model", required=True, help='saved Keras model (.keras, .h5 or SavedModel directory)')
+    parser.add_argument("-o", "--output", required=True, help='predictions, one JSON line per pocket; appended to')
+    parser.add_argument("-g", "--grid", required=False, help='grid of the training voxelizer (Voxelizer.save_spec); default is the model input shape centered on each pocket')
+    parser.add_argument("-v", "--voxel_size", type=float, default=1.0, help='voxel size when no grid is given; default is 1Å')
+    parser.add_argument("-c", "--center", action='store_true', help='if included, pockets are centered in the grid given with -g')
+    parser.add_argument("-b", "--batch_size", type=int, default=32, help='largest micro-batch; default is 32')
+    parser.add_argument("-w", "--workers", type=int, default=1, help='processes that parse and voxelize pockets; default is 1')
+    parser.add_argument("--arrays_dir", required=False, help='directory for predictions too large to write inline; default is OUTPUT_arrays')
+    parser.add_argument("--no_resume", action='store_true', help='if included, pockets already in the output are scored again')
+    parser.add_argument("-m", "--metrics", required=False, help='if included, model load and predict timings are appended to this .jsonl file')
+    args = parser.parse_args()
+
+    if args.metrics:
+        metrics.enable(args.metrics)
+
+    spec = None
+    if args.grid:
+        with open(args.grid) as f:
+            spec = json.load(f)
+
+    model = load_model(args.model)
+    screen = Screen(model, spec, args.voxel_size, args.center, args.batch_size)
+    summary = screen.run(pocket_tasks(args.inputs), args.output, args.arrays_dir, args.workers, not args.no_resume)
+    print(f"** {summary['scored']} pockets scored, {summary['failed']} failed, {summary['skipped']} already done")
+    print(f"** {summary['seconds']:.1f} s ({summary['pockets_per_second']:.1f} pockets per s), {summary['batches']} batches, {summary['predict_seconds']:.1f} s in predict")
+    print(f"** latency per pocket: p50 {summary['latency_p50']:.3f} s, p95 {summary['latency_p95']:.3f} s, max {summary['latency_max']:.3f} s")
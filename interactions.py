@@ -0,0 +1,274 @@
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import time
+from pathlib import Path
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from featurizer import FEATURES, atom_features, parse_element
+from metrics import metrics
+
+INTERACTIONS = ('hbond', 'salt_bridge', 'hydrophobic', 'pi_stacking', 'cation_pi')
+# Bit of each interaction in the per-atom annotations
+BITS = {name: 1 << i for i, name in enumerate(INTERACTIONS)}
+
+# Distance cutoffs in Å
+CUTOFFS = {
+    'hbond': 3.5,           # donor/acceptor heavy atoms
+    'salt_bridge': 4.0,     # opposite formal charges
+    'hydrophobic': 4.0,     # carbon/halogen pairs
+    'pi_parallel': 5.5,     # ring centroids, normals within 30°
+    'pi_tshaped': 6.5,      # ring centroids, normals 60-90°
+    'cation_pi': 6.0,       # cation to ring centroid
+}
+# Largest cutoff of the atom pair interactions; rings are compared separately
+ATOM_CUTOFF = max(CUTOFFS['hbond'], CUTOFFS['salt_bridge'], CUTOFFS['hydrophobic'])
+HYDROPHOBIC_ELEMENTS = ('C', 'F', 'CL', 'BR', 'I')
+# Aromatic bonds are 1.34-1.44 Å; used to find the rings of ligands read without bond orders
+AROMATIC_BOND = (1.30, 1.45)
+
+_COLUMN = {name: i for i, name in enumerate(FEATURES)}
+
+
+class Atoms:
+    """
+    The arrays the detection works on, computed once per ligand or binding site.
+
+    Args:
+        df (pandas.DataFrame): pdb dataframe (`process_pdb` columns).
+        features (numpy.ndarray): `featurizer.atom_features` of `df`; computed when not given
+            (for ligands, `featurizer.mol_features` of the ligand with bond orders is better).
+    """
+    def __init__(self, df, features=None):
+        self.df = df
+        self.coords = df[['orth_x', 'orth_y', 'orth_z']].to_numpy(dtype=float)
+        self.features = atom_features(df) if features is None else features
+        elements = pd.factorize(df['element_plus_charge'].astype(str))
+        self.element = np.array([parse_element(value)[0] for value in elements[1]], dtype=object)[elements[0]] if len(df) else np.zeros(0, dtype=object)
+        self.donor = self.features[:, _COLUMN['donor']] > 0
+        self.acceptor = self.features[:, _COLUMN['acceptor']] > 0
+        self.charge = self.features[:, _COLUMN['formal_charge']]
+        self.hydrophobic = np.isin(self.element, HYDROPHOBIC_ELEMENTS)
+        self.aromatic = self.features[:, _COLUMN['aromatic']] > 0
+
+    def __len__(self):
+        return len(self.coords)
+
+    def rings(self):
+        """
+        Aromatic rings as (centroid, normal, atom positions) arrays.
+
+        Rings are the connected groups of aromatic atoms; when no atom is flagged aromatic
+        (a ligand read from a .pdb), atoms joined by aromatic-length bonds are used instead.
+        """
+        if not hasattr(self, '_rings'):
+            self._rings = _rings(self.coords, self.aromatic if self.aromatic.any() else None)
+        return self._rings
+
+
+def _rings(coords, aromatic=None):
+    if aromatic is not None:
+        candidates = np.flatnonzero(aromatic)
+        max_bond = AROMATIC_BOND[1] + 0.1
+    else:
+        candidates = np.arange(len(coords))
+        max_bond = AROMATIC_BOND[1]
+    empty = (np.zeros((0, 3)), np.zeros((0, 3)), [])
+    if len(candidates) < 5:
+        return empty
+
+    tree = cKDTree(coords[candidates])
+    pairs = tree.query_pairs(max_bond, output_type='ndarray')
+    if aromatic is None and len(pairs):
+        lengths = np.linalg.norm(coords[candidates[pairs[:, 0]]] - coords[candidates[pairs[:, 1]]], axis=1)
+        pairs = pairs[lengths >= AROMATIC_BOND[0]]
+    if not len(pairs):
+        return empty
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(candidates), len(candidates)))
+    n_groups, labels = connected_components(graph, directed=False)
+
+    centroids, normals, members = [], [], []
+    for group in range(n_groups):
+        atoms = candidates[labels == group]
+        if len(atoms) < 5:
+            continue
+        points = coords[atoms]
+        centroid = points.mean(axis=0)
+        # The normal is the direction of least spread; groups that are not flat are not rings
+        _, singular, vt = np.linalg.svd(points - centroid)
+        if singular[-1] / np.sqrt(len(atoms)) > 0.25:
+            continue
+        centroids.append(centroid)
+        normals.append(vt[-1])
+        members.append(atoms)
+    if not centroids:
+        return empty
+    return np.array(centroids), np.array(normals), members
+
+def neighbor_pairs(ligand_coords, protein_coords, cutoff, tree=None):
+    """
+    All (ligand atom, protein atom) pairs within `cutoff`, with their distances.
+
+    Args:
+        ligand_coords (numpy.ndarray): (L, 3) coordinates.
+        protein_coords (numpy.ndarray): (P, 3) coordinates.
+        cutoff (float): largest distance in Å.
+        tree (scipy.spatial.cKDTree): tree over `protein_coords` to reuse (i.e. from the binding site search).
+
+    Returns:
+        tuple: (ligand positions, protein positions, distances) arrays.
+    """
+    tree = cKDTree(protein_coords) if tree is None else tree
+    hits = tree.query_ball_point(ligand_coords, r=cutoff)
+    lengths = np.fromiter((len(hit) for hit in hits), dtype=np.int64, count=len(hits))
+    li = np.repeat(np.arange(len(hits)), lengths)
+    pj = np.concatenate([np.asarray(hit, dtype=np.int64) for hit in hits]) if lengths.sum() else np.zeros(0, dtype=np.int64)
+    distances = np.linalg.norm(ligand_coords[li] - protein_coords[pj], axis=1)
+    return li, pj, distances
+
+@metrics.timed('interactions')
+def detect_interactions(ligand, protein, pairs=None):
+    """
+    Finds the hydrogen bonds, salt bridges, hydrophobic contacts, π-stacking and cation–π
+    interactions between a ligand and its binding site.
+
+    Every candidate pair is classified at once with boolean array operations; rings are
+    compared as centroid/normal arrays.
+
+    Args:
+        ligand (Atoms): ligand atoms.
+        protein (Atoms): binding site atoms.
+        pairs (tuple): `neighbor_pairs` output to reuse (i.e. the pairs of the binding site
+            search, see `binding_site.site_pairs`); must cover ATOM_CUTOFF.
+
+    Returns:
+        pandas.DataFrame: one row per interaction with 'type', 'ligand_atom' and
+        'protein_atom' positions (-1 for ring centroids), and 'distance'.
+    """
+    li, pj, distances = neighbor_pairs(ligand.coords, protein.coords, ATOM_CUTOFF) if pairs is None else pairs
+    metrics.count('interaction_pairs', len(li))
+
+    masks = {
+        'hbond': (distances <= CUTOFFS['hbond']) & ((ligand.donor[li] & protein.acceptor[pj]) | (ligand.acceptor[li] & protein.donor[pj])),
+        'salt_bridge': (distances <= CUTOFFS['salt_bridge']) & (ligand.charge[li] * protein.charge[pj] < 0),
+        'hydrophobic': (distances <= CUTOFFS['hydrophobic']) & ligand.hydrophobic[li] & protein.hydrophobic[pj],
+    }
+    found = [pd.DataFrame({'type': name, 'ligand_atom': li[mask], 'protein_atom': pj[mask], 'distance': distances[mask]})
+             for name, mask in masks.items() if mask.any()]
+
+    lig_centroids, lig_normals, lig_members = ligand.rings()
+    pro_centroids, pro_normals, pro_members = protein.rings()
+    if len(lig_centroids) and len(pro_centroids):
+        separation = np.linalg.norm(lig_centroids[:, None] - pro_centroids[None], axis=2)
+        angle = np.degrees(np.arccos(np.clip(np.abs(lig_normals @ pro_normals.T), 0, 1)))
+        stacked = ((separation <= CUTOFFS['pi_parallel']) & (angle <= 30)) | ((separation <= CUTOFFS['pi_tshaped']) & (angle >= 60))
+        a, b = np.nonzero(stacked)
+        if len(a):
+            found.append(pd.DataFrame({'type': 'pi_stacking', 'ligand_atom': [lig_members[i][0] for i in a],
+                                       'protein_atom': [pro_members[j][0] for j in b], 'distance': separation[a, b],
+                                       'ligand_ring': a, 'protein_ring': b}))
+
+    # Cations of one partner over the rings of the other
+    for cations, rings, cation_column in ((ligand, pro_centroids, 'ligand_atom'), (protein, lig_centroids, 'protein_atom')):
+        positive = np.flatnonzero(cations.charge > 0)
+        if len(positive) and len(rings):
+            separation = np.linalg.norm(cations.coords[positive][:, None] - rings[None], axis=2)
+            a, b = np.nonzero(separation <= CUTOFFS['cation_pi'])
+            if len(a):
+                ring_members = pro_members if cation_column == 'ligand_atom' else lig_members
+                other = 'protein_atom' if cation_column == 'ligand_atom' else 'ligand_atom'
+                found.append(pd.DataFrame({'type': 'cation_pi', cation_column: positive[a],
+                                           other: [ring_members[j][0] for j in b], 'distance': separation[a, b]}))
+
+    if not found:
+        return pd.DataFrame({'type': pd.Series(dtype=str), 'ligand_atom': pd.Series(dtype=int),
+                             'protein_atom': pd.Series(dtype=int), 'distance': pd.Series(dtype=float)})
+    interactions = pd.concat(found, ignore_index=True)
+    return interactions[['type', 'ligand_atom', 'protein_atom', 'distance']]
+
+def annotate(interactions, n_ligand, n_protein):
+    """
+    Per-atom bitmasks (see `BITS`) of the interactions each ligand and protein atom takes part in.
+    Ring interactions (π-stacking, cation–π) are marked on the first atom of the ring.
+
+    Returns:
+        tuple: (ligand annotations (n_ligand,), protein annotations (n_protein,)) uint8 arrays.
+    """
+    ligand_bits = np.zeros(n_ligand, dtype=np.uint8)
+    protein_bits = np.zeros(n_protein, dtype=np.uint8)
+    bits = interactions['type'].map(BITS).to_numpy(dtype=np.uint8)
+    np.bitwise_or.at(ligand_bits, interactions['ligand_atom'].to_numpy(dtype=np.int64), bits)
+    np.bitwise_or.at(protein_bits, interactions['protein_atom'].to_numpy(dtype=np.int64), bits)
+    return ligand_bits, protein_bits
+
+def fingerprint(interactions, protein_df):
+    """
+    Per-complex interaction fingerprint.
+
+    Returns:
+        dict: 'counts' of each interaction type, and 'residues': {'RES CHAIN NUM': [types]}
+        for every binding site residue with an interaction.
+    """
+    counts = interactions['type'].value_counts()
+    residues = {}
+    if len(interactions):
+        rows = protein_df.iloc[interactions['protein_atom'].to_numpy()]
+        labels = (rows['residue'].astype(str) + ' ' + rows['chain'].astype(str) + ' ' + rows['res_seq'].astype(str)).to_numpy()
+        for label, kind in sorted(set(zip(labels, interactions['type']))):
+            residues.setdefault(label, []).append(kind)
+    return {'counts': {name: int(counts.get(name, 0)) for name in INTERACTIONS}, 'residues': residues}
+
+def complex_interactions(ligand_df, protein_df, ligand_features=None, pairs=None):
+    """
+    Detects the interactions of a complex and returns (interactions, fingerprint, ligand bits, protein bits).
+    `pairs` are passed on to `detect_interactions` (i.e. from `binding_site.extract`).
+    """
+    ligand = Atoms(ligand_df, ligand_features)
+    protein = Atoms(protein_df)
+    interactions = detect_interactions(ligand, protein, pairs)
+    return (interactions, fingerprint(interactions, protein_df), *annotate(interactions, len(ligand), len(protein)))
+
+def iter_complexes(source):
+    """
+    Yields (name, ligand dataframe, binding site dataframe) from a .bsa archive or a
+    directory of {name}_binding_site.pdb/{name}_ligand.pdb pairs.
+    """
+    if str(source).endswith('.bsa'):
+        from complex_archive import ComplexArchive
+        for key, view in ComplexArchive(source).items():
+            yield key, view.to_dataframe('ligand'), view.to_dataframe('binding_site')
+        return
+    from process_pdb import process_pdb
+    for site_file in sorted(Path(source).glob('*_binding_site.pdb')):
+        name = site_file.name[:-len('_binding_site.pdb')]
+        ligand_file = site_file.with_name(f'{name}_ligand.pdb')
+        if ligand_file.exists() and not site_file.name.startswith('._'):
+            yield name, process_pdb(str(ligand_file)).reset_index(drop=True), process_pdb(str(site_file)).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='protein-ligand interaction fingerprints')
+    parser.add_argument("source", help='.bsa archive or directory of _binding_site.pdb/_ligand.pdb pairs')
+    parser.add_argument("-o", "--output", required=True, help='fingerprints, one JSON line per complex')
+    parser.add_argument("-a", "--annotations", required=False, help='if included, per-atom interaction bits are saved to this .npz file')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    annotations = {}
+    n = 0
+    with open(args.output, 'w') as out:
+        for name, ligand_df, site_df in iter_complexes(args.source):
+            with metrics.file(name):
+                interactions, fp, ligand_bits, protein_bits = complex_interactions(ligand_df.reset_index(drop=True), site_df.reset_index(drop=True))
+            out.write(json.dumps({'name': name, **fp}) + '\n')
+            if args.annotations:
+                annotations[f'{name}/ligand'] = ligand_bits
+                annotations[f'{name}/binding_site'] = protein_bits
+            n += 1
+    if args.annotations:
+        np.savez_compressed(args.annotations, **annotations)
+    seconds = time.perf_counter() - start
+    print(f'** {n} complexes in {seconds:.1f} s ({60 * n / max(seconds, 1e-9):.0f} per minute)')
@@ -0,0 +1,275 @@
+import argparse
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+from pathlib import Path
+
+from metrics import metrics
+
+# Ligands that are amino acids are skipped, as in hetatm_batch_script_2.0.sh
+AMINO_ACIDS = {'ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'GLN', 'GLU', 'GLY', 'HIS', 'ILE',
+               'LEU', 'LYS', 'MET', 'PHE', 'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL'}
+
+def read_pairs_txt(ligands_file, pdbs_file):
+    """
+    Reads (HET id, PDB ids) pairs from bindingDB_ligands.txt and bindingDB_pdbs.txt.
+
+    Line i of the ligands file goes with line i of the PDB ids file. The two files come from
+    bindingdb_data_grab.sh and can be out of line when a record has no PDB ids, so the index
+    from bindingDB_parsing/bindingdb_index.py should be preferred.
+
+    Yields:
+        tuple: (HET id, list of PDB ids)
+    """
+    with open(ligands_file) as ligands, open(pdbs_file) as pdbs:
+        ligand_lines = [line.strip() for line in ligands]
+        pdb_lines = [line.strip() for line in pdbs]
+    if len(ligand_lines) != len(pdb_lines):
+        print(f'** WARNING: {ligands_file} has {len(ligand_lines)} lines but {pdbs_file} has {len(pdb_lines)}; pairs may be misaligned', file=sys.stderr)
+    for het_id, pdb_ids in zip(ligand_lines, pdb_lines):
+        yield het_id, [pdb_id for pdb_id in pdb_ids.split(',')]
+
+def read_pairs_index(index_file):
+    """
+    Reads (HET id, PDB ids) pairs from an index written by bindingDB_parsing/bindingdb_index.py.
+
+    Yields:
+        tuple: (HET id, list of PDB ids)
+    """
+    sys.path.insert(0, str(Path(__file__).resolve().parent / 'bindingDB_parsing'))
+    from bindingdb_index import load_index, iter_pairs
+    yield from iter_pairs(load_index(index_file))
+
+def expand_pairs(pairs):
+    """
+    Expands ligand lines into unique (PDB id, HET id) pairs grouped by structure.
+
+    Args:
+        pairs (iterable): (HET id, list of PDB ids) tuples.
+
+    Returns:
+        dict: {PDB id: list of HET ids} with the PDB ids upper case, and the HET ids
+        in order of first appearance without repeats.
+    """
+    structures = {}
+    for het_id, pdb_ids in pairs:
+        het_id = het_id.strip().upper()
+        if not het_id or het_id in AMINO_ACIDS:
+            continue
+        for pdb_id in pdb_ids:
+            pdb_id = pdb_id.strip().upper()
+            if not pdb_id:
+                continue
+            ligands = structures.setdefault(pdb_id, [])
+            if het_id not in ligands:
+                ligands.append(het_id)
+    return structures
+
+def find_pdb_file(pdb_dir, pdb_id):
+    """
+    Returns the path of `pdb_id` in `pdb_dir` (as 1abc.pdb or 1ABC.pdb), or None when it is not there.
+    """
+    if pdb_dir is None:
+        return None
+    for name in (f'{pdb_id.lower()}.pdb', f'{pdb_id.upper()}.pdb'):
+        path = os.path.join(pdb_dir, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+def plan(structures, pdb_dir=None):
+    """
+    Builds the job manifest: one job per structure, largest structures first.
+
+    The size of a structure is the size of its file when it is in `pdb_dir`. Structures
+    that are not available yet are given the median size of the known ones, since most
+    structures are close to it.
+
+    Args:
+        structures (dict): {PDB id: list of HET ids} from `expand_pairs`.
+        pdb_dir (str): directory with the downloaded structures.
+
+    Returns:
+        list of dict: jobs with 'pdb_id', 'ligands', 'pdb_file', 'est_size' and 'size_known'.
+    """
+    jobs = []
+    for pdb_id, ligands in structures.items():
+        pdb_file = find_pdb_file(pdb_dir, pdb_id)
+        jobs.append({
+            'pdb_id': pdb_id,
+            'ligands': ligands,
+            'pdb_file': pdb_file,
+            'est_size': os.path.getsize(pdb_file) if pdb_file else None,
+            'size_known': pdb_file is not None,
+        })
+
+    known = sorted(job['est_size'] for job in jobs if job['size_known'])
+    median = known[len(known) // 2] if known else 0
+    for job in jobs:
+        if not job['size_known']:
+            job['est_size'] = median
+
+    # Longest jobs first so that the big structures do not straggle at the end of a run
+    jobs.sort(key=lambda job: (-job['est_size'], job['pdb_id']))
+    return jobs
+
+def write_manifest(jobs, manifest_file):
+    with open(manifest_file, 'w') as f:
+        for job in jobs:
+            f.write(json.dumps(job) + '\n')
+
+def read_manifest(manifest_file):
+    with open(manifest_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def run_job(job, output_dir, distance=3.5, center=False, archive=None):
+    """
+    Extracts the binding site of every ligand of a job from a single parse of its structure.
+
+    The structure is read once into a compact `structure.Structure` and spatially indexed
+    once; each ligand then only costs a split and a k-d tree query on index views. Outputs are written as {pdb}_{het}_binding_site.pdb and
+    {pdb}_{het}_ligand.pdb in `output_dir`, or appended to `archive` as {pdb}_{het}.
+
+    Args:
+        job (dict): a job from the manifest.
+        output_dir (str): directory for the output files.
+        distance (float): binding site distance in Å.
+        center (bool): if True, the structure is centered to (0, 0, 0).
+        archive (str): if given, complexes go to this `complex_archive` .bsa file instead of .pdb files.
+
+    Returns:
+        dict: the job's 'pdb_id', the ligands 'done', the ligands 'failed' with the reason, and 'seconds'.
+    """
+    from structure import read_pdb, center as center_structure, split_ligand_protein, binding_site, write_pdb
+    from complex_archive import ComplexArchive
+
+    start = time.perf_counter()
+    result = {'pdb_id': job['pdb_id'], 'done': [], 'failed': {}}
+    pdb_file = job.get('pdb_file')
+    if not pdb_file or not os.path.isfile(pdb_file):
+        result['failed'] = {het_id: 'structure not found' for het_id in job['ligands']}
+        result['seconds'] = time.perf_counter() - start
+        return result
+
+    with metrics.file(pdb_file, ligands=job['ligands']):
+        try:
+            structure = read_pdb(pdb_file)
+            if center:
+                structure = center_structure(structure)
+            metrics.count('structure_bytes', structure.nbytes)
+        except Exception as e:
+            result['failed'] = {het_id: f'{type(e).__name__}: {e}' for het_id in job['ligands']}
+            result['seconds'] = time.perf_counter() - start
+            return result
+
+        stem = job['pdb_id'].lower()
+        packed = ComplexArchive(archive, 'a') if archive else None
+        for het_id in job['ligands']:
+            try:
+                ligand, protein, primary_chain = split_ligand_protein(structure, het_id)
+                bindingsite = binding_site(ligand, protein, distance)
+                if bindingsite.empty:
+                    result['failed'][het_id] = 'no binding site residues within the distance'
+                    continue
+                if packed is not None:
+                    packed.append(f'{stem}_{het_id}', bindingsite.to_dataframe(), ligand.to_dataframe(), pdb_id=job['pdb_id'], het_id=het_id, distance=distance)
+                else:
+                    write_pdb(bindingsite, os.path.join(output_dir, f'{stem}_{het_id}_binding_site.pdb'))
+                    write_pdb(ligand, os.path.join(output_dir, f'{stem}_{het_id}_ligand.pdb'))
+                result['done'].append(het_id)
+            except Exception as e:
+                result['failed'][het_id] = f'{type(e).__name__}: {e}'
+
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def _run_job(args):
+    return run_job(*args)
+
+def run_manifest(jobs, output_dir, distance=3.5, center=False, workers=1, log_file=None, archive=None):
+    """
+    Runs every job of a manifest, largest first, over a pool of worker processes.
+
+    Args:
+        jobs (list of dict): jobs from `plan` or `read_manifest`.
+        output_dir (str): directory for the output files.
+        distance (float): binding site distance in Å.
+        center (bool): if True, structures are centered to (0, 0, 0).
+        workers (int): number of worker processes.
+        log_file (str): if given, the result of every job is appended to it as a JSON line.
+        archive (str): if given, complexes go to this .bsa archive instead of .pdb files.
+
+    Returns:
+        list of dict: results from `run_job`, in order of completion.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [(job, output_dir, distance, center, archive) for job in jobs]
+    results = []
+    log = open(log_file, 'a') if log_file else None
+    try:
+        if workers > 1:
+            with Pool(workers) as pool:
+                # chunksize=1 keeps the largest-first order of the manifest
+                for result in pool.imap_unordered(_run_job, tasks, chunksize=1):
+                    results.append(result)
+                    if log:
+                        log.write(json.dumps(result) + '\n')
+                        log.flush()
+        else:
+            for task in tasks:
+                result = _run_job(task)
+                results.append(result)
+                if log:
+                    log.write(json.dumps(result) + '\n')
+                    log.flush()
+    finally:
+        if log:
+            log.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='plan (and run) binding site extraction jobs grouped by structure')
+    parser.add_argument("-x", "--index", required=False, help='index from bindingDB_parsing/bindingdb_index.py')
+    parser.add_argument("-lf", "--ligands", required=False, help='ligands file i.e. bindingDB_parsing/bindingDB_ligands.txt')
+    parser.add_argument("-pf", "--pdbs", required=False, help='PDB ids file i.e. bindingDB_parsing/bindingDB_pdbs.txt')
+    parser.add_argument("-p", "--pdb_dir", required=False, help='directory with the downloaded structures (1abc.pdb)')
+    parser.add_argument("-o", "--manifest", required=False, help='name for the job manifest (.jsonl)')
+    parser.add_argument("-j", "--jobs", required=False, help='run an existing manifest instead of planning one')
+    parser.add_argument("-r", "--run", required=False, metavar='OUTPUT_DIR', help='if included, the jobs are run and the outputs written to this directory')
+    parser.add_argument("-d", "--distance", type=float, default=3.5, help='binding site distance; default is 3.5Å')
+    parser.add_argument("-c", "--center", action='store_true', help='if included, structures will be centered to (0,0,0)')
+    parser.add_argument("-w", "--workers", type=int, default=1, help='number of worker processes; default is 1')
+    parser.add_argument("-a", "--archive", required=False, help='if included, complexes are appended to this packed archive (.bsa) instead of written as .pdb files')
+    parser.add_argument("-m", "--metrics", required=False, help='if included, per-stage timings are appended to this .jsonl file')
+    args = parser.parse_args()
+
+    if args.metrics:
+        metrics.enable(args.metrics)
+
+    if args.jobs:
+        jobs = read_manifest(args.jobs)
+    else:
+        if args.index:
+            pairs = read_pairs_index(args.index)
+        elif args.ligands and args.pdbs:
+            pairs = read_pairs_txt(args.ligands, args.pdbs)
+        else:
+            parser.error('either --index, --ligands and --pdbs, or --jobs is required')
+        structures = expand_pairs(pairs)
+        jobs = plan(structures, args.pdb_dir)
+        n_pairs = sum(len(job['ligands']) for job in jobs)
+        print(f'** {n_pairs} unique (PDB, HET) pairs in {len(jobs)} structures; {sum(job["size_known"] for job in jobs)} structures found locally')
+        if args.manifest:
+            write_manifest(jobs, args.manifest)
+            print('** wrote', args.manifest)
+
+    if args.run:
+        start = time.perf_counter()
+        log_file = os.path.join(args.run, 'jobs.log.jsonl')
+        results = run_manifest(jobs, args.run, args.distance, args.center, args.workers, log_file, args.archive)
+        done = sum(len(result['done']) for result in results)
+        failed = sum(len(result['failed']) for result in results)
+        print(f'** {done} binding sites written, {failed} failed in {time.perf_counter() - start:.1f} s; see {log_file}')
@@ -0,0 +1,297 @@
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from multiprocessing import Process
+
+from metrics import metrics
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    pdb_id TEXT UNIQUE NOT NULL,
+    job TEXT NOT NULL,
+    est_size INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL,
+    heartbeat REAL,
+    result TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, est_size);
+"""
+STATES = ('pending', 'running', 'done', 'failed')
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+
+
+class JobQueue:
+    """
+    Job queue in a single SQLite file that workers on several hosts claim jobs from.
+
+    A claimed job is leased to its worker for `lease` seconds and the worker renews the
+    lease with `heartbeat` while it runs. A job whose lease ran out (the worker died or
+    lost the filesystem) goes back to pending, or to failed after `max_attempts` claims.
+    Every change is a short IMMEDIATE transaction, which serializes the workers without
+    a broker. WAL mode is not used since it does not work on network filesystems.
+
+    Args:
+        path (str): the queue file; created if needed.
+        lease (float): lease duration in seconds.
+        max_attempts (int): claims of a job before it is marked failed.
+    """
+    def __init__(self, path, lease=300.0, max_attempts=3):
+        self.path = str(path)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.db = sqlite3.connect(self.path, timeout=120, isolation_level=None)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _transaction(self):
+        return _Transaction(self.db)
+
+    def add(self, jobs):
+        """
+        Adds manifest jobs (see job_planner.py); jobs of a structure already in the queue are left as they are.
+
+        Returns:
+            int: number of jobs added.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            before = db.total_changes
+            db.executemany('INSERT OR IGNORE INTO jobs (pdb_id, job, est_size, updated) VALUES (?, ?, ?, ?)',
+                           [(job['pdb_id'], json.dumps(job), job.get('est_size') or 0, now) for job in jobs])
+            return db.total_changes - before
+
+    def requeue_expired(self, now=None):
+        """
+        Puts the running jobs whose lease ran out back to pending (or failed after `max_attempts`).
+
+        Returns:
+            int: number of jobs requeued or failed.
+        """
+        now = time.time() if now is None else now
+        with self._transaction() as db:
+            return self._requeue_expired(db, now)
+
+    def _requeue_expired(self, db, now):
+        failed = db.execute("UPDATE jobs SET state = 'failed', worker = NULL, updated = ?, result = ? "
+                            "WHERE state = 'running' AND lease_until < ? AND attempts >= ?",
+                            (now, json.dumps({'error': 'lease expired'}), now, self.max_attempts)).rowcount
+        requeued = db.execute("UPDATE jobs SET state = 'pending', worker = NULL, updated = ? "
+                              "WHERE state = 'running' AND lease_until < ?", (now, now)).rowcount
+        return failed + requeued
+
+    def claim(self, worker):
+        """
+        Leases the largest pending job to `worker`.
+
+        Returns:
+            tuple: (job id, job dict), or None when no job is pending.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            self._requeue_expired(db, now)
+            row = db.execute("SELECT id, job FROM jobs WHERE state = 'pending' ORDER BY est_size DESC, pdb_id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET state = 'running', worker = ?, attempts = attempts + 1, lease_until = ?, heartbeat = ?, updated = ? WHERE id = ?",
+                       (worker, now + self.lease, now, now, row[0]))
+        return row[0], json.loads(row[1])
+
+    def heartbeat(self, job_id, worker):
+        """
+        Renews the lease of a job.
+
+        Returns:
+            bool: False if the job is no longer leased to `worker` (it was requeued), in which case its result will be ignored.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            return db.execute("UPDATE jobs SET lease_until = ?, heartbeat = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                              (now + self.lease, now, job_id, worker)).rowcount == 1
+
+    def finish(self, job_id, worker, result, failed=False):
+        """
+        Stores the result of a job and marks it done (or failed).
+
+        Returns:
+            bool: False if the job was no longer leased to `worker`.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            return db.execute("UPDATE jobs SET state = ?, result = ?, worker = NULL, lease_until = NULL, updated = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                              ('failed' if failed else 'done', json.dumps(result), now, job_id, worker)).rowcount == 1
+
+    def reset(self, states=('failed',)):
+        """
+        Puts the jobs in `states` back to pending with their attempts cleared.
+        """
+        with self._transaction() as db:
+            return db.execute(f"UPDATE jobs SET state = 'pending', attempts = 0, worker = NULL, result = NULL, updated = ? WHERE state IN ({','.join('?' * len(states))})",
+                              (time.time(), *states)).rowcount
+
+    def progress(self):
+        """
+        Returns the number of jobs in each state, the ligands done and failed, and the active workers.
+        """
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(self.db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        ligands = {'done': 0, 'failed': 0}
+        for (result,) in self.db.execute("SELECT result FROM jobs WHERE result IS NOT NULL"):
+            result = json.loads(result)
+            ligands['done'] += len(result.get('done', []))
+            ligands['failed'] += len(result.get('failed', {}))
+        workers = self.db.execute("SELECT worker, pdb_id, heartbeat FROM jobs WHERE state = 'running'").fetchall()
+        return {'jobs': counts, 'total': sum(counts.values()), 'ligands': ligands,
+                'running': [{'worker': worker, 'pdb_id': pdb_id, 'heartbeat_age': time.time() - heartbeat} for worker, pdb_id, heartbeat in workers]}
+
+
+class _Transaction:
+    # BEGIN IMMEDIATE takes the write lock up front, so two workers cannot claim the same job
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+def work(queue_path, output_dir, distance=3.5, center=False, archive=None, lease=300.0, max_jobs=None, idle_exit=True):
+    """
+    Claims and runs jobs until the queue is empty, renewing the lease of the current job from a thread.
+
+    Args:
+        queue_path (str): the queue file.
+        output_dir (str): directory for the output files.
+        distance (float): binding site distance in Å.
+        center (bool): if True, structures are centered to (0, 0, 0).
+        archive (str): if given, complexes are appended to this .bsa archive instead of .pdb files.
+        lease (float): lease duration in seconds; heartbeats are sent every lease / 3.
+        max_jobs (int): stop after this many jobs.
+        idle_exit (bool): if False, the worker waits for new jobs instead of exiting when the queue is empty.
+
+    Returns:
+        int: number of jobs run.
+    """
+    from job_planner import run_job
+
+    os.makedirs(output_dir, exist_ok=True)
+    queue = JobQueue(queue_path, lease=lease)
+    worker = worker_name()
+    n = 0
+    try:
+        while max_jobs is None or n < max_jobs:
+            claimed = queue.claim(worker)
+            if claimed is None:
+                if idle_exit and not queue.progress()['jobs']['running']:
+                    break
+                time.sleep(min(lease / 3, 10))
+                continue
+            job_id, job = claimed
+
+            stop = threading.Event()
+            def beat():
+                # A separate connection, since sqlite3 connections are not shared between threads
+                beat_queue = JobQueue(queue_path, lease=lease)
+                try:
+                    while not stop.wait(lease / 3):
+                        if not beat_queue.heartbeat(job_id, worker):
+                            break
+                finally:
+                    beat_queue.close()
+            heartbeat = threading.Thread(target=beat, daemon=True)
+            heartbeat.start()
+            try:
+                result = run_job(job, output_dir, distance, center, archive)
+                failed = bool(result['failed']) and not result['done']
+            except Exception as e:
+                result, failed = {'pdb_id': job['pdb_id'], 'error': f'{type(e).__name__}: {e}'}, True
+            finally:
+                stop.set()
+                heartbeat.join()
+            result['worker'] = worker
+            if not queue.finish(job_id, worker, result, failed):
+                print(f'** {worker}: lease of {job["pdb_id"]} was lost; result discarded')
+            n += 1
+    finally:
+        queue.close()
+        metrics.flush()
+    return n
+
+def print_progress(progress):
+    jobs = progress['jobs']
+    print(f"** jobs: {progress['total']}  " + '  '.join(f'{state}: {jobs[state]}' for state in STATES))
+    print(f"** ligands done: {progress['ligands']['done']}  failed: {progress['ligands']['failed']}")
+    for running in progress['running']:
+        print(f"   {running['worker']:<40}{running['pdb_id']:>8}   last heartbeat {running['heartbeat_age']:.0f} s ago")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='SQLite job queue shared by workers on several hosts')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    add = subparsers.add_parser('add', help='add the jobs of a manifest from job_planner.py')
+    add.add_argument("queue", help='queue file (.sqlite)')
+    add.add_argument("manifest")
+
+    worker = subparsers.add_parser('work', help='claim and run jobs until the queue is empty')
+    worker.add_argument("queue")
+    worker.add_argument("-o", "--output_dir", required=True)
+    worker.add_argument("-n", "--processes", type=int, default=1, help='number of worker processes on this host; default is 1')
+    worker.add_argument("-d", "--distance", type=float, default=3.5, help='binding site distance; default is 3.5Å')
+    worker.add_argument("-c", "--center", action='store_true', help='if included, structures will be centered to (0,0,0)')
+    worker.add_argument("-a", "--archive", required=False, help='if included, complexes are appended to this packed archive (.bsa)')
+    worker.add_argument("-L", "--lease", type=float, default=300.0, help='lease in seconds; default is 300')
+    worker.add_argument("-m", "--metrics", required=False, help='if included, per-stage timings are appended to this .jsonl file')
+
+    status = subparsers.add_parser('status', help='print the progress of the queue')
+    status.add_argument("queue")
+    status.add_argument("--json", action='store_true', help='print the progress as JSON')
+
+    requeue = subparsers.add_parser('requeue', help='requeue expired leases, and failed jobs with --failed')
+    requeue.add_argument("queue")
+    requeue.add_argument("--failed", action='store_true', help='also put the failed jobs back to pending')
+
+    args = parser.parse_args()
+
+    if args.command == 'add':
+        from job_planner import read_manifest
+        queue = JobQueue(args.queue)
+        print(f'** added {queue.add(read_manifest(args.manifest))} jobs to {args.queue}')
+    elif args.command == 'work':
+        if args.metrics:
+            metrics.enable(args.metrics)
+        kwargs = dict(distance=args.distance, center=args.center, archive=args.archive, lease=args.lease)
+        workers = [Process(target=work, args=(args.queue, args.output_dir), kwargs=kwargs) for _ in range(args.processes)]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+        print_progress(JobQueue(args.queue).progress())
+    elif args.command == 'status':
+        progress = JobQueue(args.queue).progress()
+        if args.json:
+            print(json.dumps(progress, indent=1))
+        else:
+            print_progress(progress)
+    elif args.command == 'requeue':
+        queue = JobQueue(args.queue)
+        n = queue.requeue_expired()
+        if args.failed:
+            n += queue.reset(('failed',))
+        print(f'** requeued {n} jobs')
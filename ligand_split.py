@@ -0,0 +1,309 @@
+import numpy as np
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+from metrics import metrics
+
+N_BITS = 2048
+RADIUS = 2
+THRESHOLD = 0.6
+SPLITS = ('train', 'val', 'test')
+
+# Bits set in every byte value, for numpy versions without np.bitwise_count (< 2.0)
+_BYTE_COUNTS = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def bit_counts(words):
+    """
+    Number of set bits of every uint64 word.
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    return _BYTE_COUNTS[np.ascontiguousarray(words).view(np.uint8)].reshape(*words.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+def popcount(words):
+    """
+    Number of set bits of each row of packed uint64 words.
+    """
+    return bit_counts(words).sum(axis=-1, dtype=np.int32)
+
+def pack_bits(bits):
+    """
+    Packs a (n, n_bits) boolean array into (n, n_bits / 64) uint64 words.
+    """
+    bits = np.asarray(bits, dtype=bool)
+    n_words = -(-bits.shape[1] // 64)
+    packed = np.packbits(bits, axis=1, bitorder='little')
+    packed = np.pad(packed, ((0, 0), (0, n_words * 8 - packed.shape[1])))
+    return np.ascontiguousarray(packed).view('<u8').astype(np.uint64, copy=False)
+
+def ligand_name(sdf_file):
+    """
+    The name a fingerprint is stored under: 'LIG' for LIG_ideal.sdf (downloader.py -k sdf)
+    and '1abc_LIG' for 1abc_LIG_ligand.sdf (downloader.py -lp).
+    """
+    stem = Path(sdf_file).stem
+    for suffix in ('_ideal', '_ligand'):
+        if stem.endswith(suffix):
+            return stem[:-len(suffix)]
+    return stem
+
+def sdf_files(sources):
+    # SDF files and directories of SDF files
+    files = []
+    for source in sources:
+        if os.path.isdir(source):
+            files.extend(str(path) for path in sorted(Path(source).glob('*.sdf')) if not path.name.startswith('._'))
+        else:
+            files.append(str(source))
+    return files
+
+@metrics.timed('fingerprints')
+def ligand_fingerprints(files, n_bits=N_BITS, radius=RADIUS):
+    """
+    Morgan fingerprints and Bemis-Murcko scaffolds of the first molecule of each SDF file.
+
+    Args:
+        files (list of str): component SDFs (i.e. LIG_ideal.sdf from downloader.py).
+        n_bits (int): fingerprint length, a multiple of 64.
+        radius (int): Morgan radius (2 is ECFP4).
+
+    Returns:
+        tuple: (names, (n, n_bits / 64) uint64 fingerprints, scaffold SMILES, {name: error} of the files that could not be read)
+    """
+    from rdkit import Chem, DataStructs, RDLogger
+    from rdkit.Chem import rdFingerprintGenerator
+    from rdkit.Chem.Scaffolds import MurckoScaffold
+    RDLogger.DisableLog('rdApp.*')
+
+    generator = rdFingerprintGenerator.GetMorganGenerator(radius=radius, fpSize=n_bits)
+    names, rows, scaffolds, failed = [], [], [], {}
+    bits = np.zeros(n_bits, dtype=np.uint8)
+    for sdf_file in files:
+        name = ligand_name(sdf_file)
+        molecule = next(iter(Chem.SDMolSupplier(sdf_file)), None)
+        if molecule is None:
+            failed[name] = f'no molecule could be read from {sdf_file}'
+            continue
+        DataStructs.ConvertToNumpyArray(generator.GetFingerprint(molecule), bits)
+        try:
+            scaffold = MurckoScaffold.MurckoScaffoldSmiles(mol=molecule)
+        except ValueError:
+            scaffold = ''
+        names.append(name)
+        rows.append(bits.astype(bool))
+        scaffolds.append(scaffold)
+    metrics.count('fingerprints', len(names))
+    fingerprints = pack_bits(np.array(rows)) if rows else np.zeros((0, n_bits // 64), dtype=np.uint64)
+    return names, fingerprints, scaffolds, failed
+
+def save_fingerprints(path, names, fingerprints, scaffolds):
+    np.savez_compressed(path, names=np.array(names), fingerprints=fingerprints, scaffolds=np.array(scaffolds))
+
+def load_fingerprints(path):
+    data = np.load(path)
+    return data['names'].tolist(), data['fingerprints'], data['scaffolds'].tolist()
+
+@metrics.timed('similarity_search')
+def similar_pairs(fingerprints, threshold=THRESHOLD, batch_size=256, block_size=4096):
+    """
+    Every pair of fingerprints with a Tanimoto similarity of at least `threshold`.
+
+    Tanimoto similarities are computed for a batch of queries against a block of fingerprints
+    at a time, with AND and popcount on the packed words. Fingerprints are ordered by their
+    bit count first: two fingerprints with a and b bits (a <= b) are at most a / b similar,
+    so each batch is only compared with the fingerprints whose counts can reach the threshold.
+
+    Args:
+        fingerprints (numpy.ndarray): (n, words) uint64 fingerprints.
+        threshold (float): smallest Tanimoto similarity of a pair.
+        batch_size (int): queries per batch.
+        block_size (int): fingerprints compared with a batch at once.
+
+    Returns:
+        tuple: (i, j) position arrays with i < j.
+    """
+    counts = popcount(fingerprints)
+    order = np.argsort(counts, kind='stable')
+    sorted_counts = counts[order]
+    # Word-major copy, so a block of one word is contiguous
+    columns = np.ascontiguousarray(fingerprints[order].T)
+    pairs_i, pairs_j = [], []
+    compared = 0
+    for start in range(0, len(order), batch_size):
+        stop = min(start + batch_size, len(order))
+        queries, query_counts = columns[:, start:stop, None], sorted_counts[start:stop]
+        # Partners come after the query in count order, up to the largest count within reach
+        last = np.searchsorted(sorted_counts, query_counts[-1] / threshold if threshold > 0 else np.inf, side='right')
+        for block in range(start, last, block_size):
+            block_stop = min(block + block_size, last)
+            # One word at a time, so the temporaries stay batch_size x block_size
+            common = np.zeros((stop - start, block_stop - block), dtype=np.int32)
+            both = np.empty(common.shape, dtype=np.uint64)
+            for word in range(columns.shape[0]):
+                np.bitwise_and(queries[word], columns[word, block:block_stop], out=both)
+                common += bit_counts(both)
+            union = query_counts[:, None] + sorted_counts[None, block:block_stop] - common
+            similarity = np.divide(common, union, out=np.ones(common.shape), where=union > 0)
+            rows, cols = np.nonzero(similarity >= threshold)
+            cols += block
+            rows += start
+            keep = cols > rows
+            pairs_i.append(rows[keep])
+            pairs_j.append(cols[keep])
+            compared += common.size
+    metrics.count('tanimoto_comparisons', compared)
+    i = order[np.concatenate(pairs_i)] if pairs_i else np.zeros(0, dtype=np.int64)
+    j = order[np.concatenate(pairs_j)] if pairs_j else np.zeros(0, dtype=np.int64)
+    return np.minimum(i, j), np.maximum(i, j)
+
+def butina_clusters(n, pairs):
+    """
+    Butina (sphere exclusion) clustering of `n` items from their similar pairs.
+
+    Items are taken by decreasing number of neighbors; an unassigned item becomes a cluster
+    center and takes all of its unassigned neighbors. Clusters are compact (every member is
+    similar to its center), but a member can still be similar to an item of another cluster;
+    `similarity_components` keeps those together.
+
+    Returns:
+        numpy.ndarray: cluster of every item.
+    """
+    i, j = pairs
+    ends = np.concatenate([i, j])
+    starts = np.concatenate([j, i])
+    order = np.argsort(ends, kind='stable')
+    neighbors = starts[order]
+    offsets = np.r_[0, np.cumsum(np.bincount(ends, minlength=n))]
+    degree = np.diff(offsets)
+
+    cluster = np.full(n, -1, dtype=np.int64)
+    n_clusters = 0
+    for center in np.argsort(-degree, kind='stable'):
+        if cluster[center] >= 0:
+            continue
+        members = neighbors[offsets[center]:offsets[center + 1]]
+        cluster[members[cluster[members] < 0]] = n_clusters
+        cluster[center] = n_clusters
+        n_clusters += 1
+    return cluster
+
+def similarity_components(n, pairs):
+    """
+    Connected components of the similarity graph (single linkage): no item is similar to an
+    item of another component, at the cost of chains of similar ligands forming large components.
+
+    Returns:
+        numpy.ndarray: component of every item.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    i, j = pairs
+    graph = coo_matrix((np.ones(len(i), dtype=np.int8), (i, j)), shape=(n, n))
+    return connected_components(graph, directed=False)[1]
+
+def scaffold_groups(scaffolds):
+    """
+    Groups of ligands with the same Bemis-Murcko scaffold; acyclic ligands (no scaffold) each get their own.
+    """
+    groups = {}
+    return np.array([groups.setdefault(scaffold, len(groups)) if scaffold else -1 - i for i, scaffold in enumerate(scaffolds)])
+
+def assign_splits(groups, fractions=(0.8, 0.1, 0.1), seed=0):
+    """
+    Assigns whole groups to train, val and test.
+
+    Groups are taken in a seeded random order and each goes to the first split that is
+    still below its share, so no group is shared between splits and the split sizes come
+    close to `fractions` (a large group can overshoot its split).
+
+    Returns:
+        numpy.ndarray: index into SPLITS of every item.
+    """
+    labels, inverse, sizes = np.unique(groups, return_inverse=True, return_counts=True)
+    targets = np.cumsum(fractions) / np.sum(fractions) * len(groups)
+    split_of_group = np.zeros(len(labels), dtype=np.int64)
+    filled = 0
+    for group in np.random.default_rng(seed).permutation(len(labels)):
+        split = min(int(np.searchsorted(targets, filled, side='right')), len(fractions) - 1)
+        split_of_group[group] = split
+        filled += sizes[group]
+    return split_of_group[inverse]
+
+def ligand_het_id(ligand_file):
+    """
+    The HET id of a ligand .pdb file (i.e. 8e4l_ligand.pdb, whose name does not have it):
+    the residue name of its first atom record.
+    """
+    with open(ligand_file) as f:
+        for line in f:
+            if line.startswith(('HETATM', 'ATOM')):
+                residue = line[16:20].strip()
+                # Alternate locations are read into the residue column i.e. ALIG or BLIG
+                return residue[1:] if len(residue) == 4 and residue[0] in 'AB' else residue
+    return None
+
+def complex_split(name, splits, het_id=None):
+    """
+    Split of a complex from a {ligand: split} mapping keyed by complex (i.e. '1abc_LIG') or
+    by HET id. Complexes named by PDB id only (i.e. '8e4l') need their `het_id` (see
+    `ligand_het_id`); otherwise the HET id is taken from the end of the name.
+    """
+    for key in (name, f'{name}_{het_id}', het_id, name.rsplit('_', 1)[-1]):
+        if key in splits:
+            return splits[key]
+    return None
+
+def load_splits(path):
+    """
+    {name: split} from the output of ligand_split.py.
+    """
+    with open(path) as f:
+        return {record['name']: record['split'] for record in map(json.loads, f) if record.get('split')}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='cluster-disjoint train/val/test splits of ligands by scaffold or fingerprint similarity')
+    parser.add_argument("inputs", nargs='+', help='component SDF files (LIG_ideal.sdf or NAME_ligand.sdf), directories of them, or a fingerprints .npz from -f')
+    parser.add_argument("-o", "--output", required=True, help='name, cluster and split of every ligand, one JSON line per ligand')
+    parser.add_argument("-b", "--by", choices=('similarity', 'components', 'scaffold'), default='similarity', help='group ligands by Butina clusters of Tanimoto similarity, by connected components of similar pairs (no similar pair is split) or by Bemis-Murcko scaffold; default is similarity')
+    parser.add_argument("-t", "--threshold", type=float, default=THRESHOLD, help=f'Tanimoto similarity within a cluster; default is {THRESHOLD}')
+    parser.add_argument("-s", "--fractions", type=float, nargs=3, default=[0.8, 0.1, 0.1], help='train, val and test fractions; default is 0.8 0.1 0.1')
+    parser.add_argument("-n", "--n_bits", type=int, default=N_BITS, help=f'fingerprint length; default is {N_BITS}')
+    parser.add_argument("-f", "--fingerprints", required=False, help='if included, the fingerprints are saved to this .npz file and can be given as input next time')
+    parser.add_argument("--seed", type=int, default=0, help='seed of the group order; default is 0')
+    parser.add_argument("-m", "--metrics", required=False, help='if included, fingerprint and search timings are appended to this .jsonl file')
+    args = parser.parse_args()
+
+    if args.metrics:
+        metrics.enable(args.metrics)
+
+    start = time.perf_counter()
+    failed = {}
+    if len(args.inputs) == 1 and args.inputs[0].endswith('.npz'):
+        names, fingerprints, scaffolds = load_fingerprints(args.inputs[0])
+    else:
+        names, fingerprints, scaffolds, failed = ligand_fingerprints(sdf_files(args.inputs), args.n_bits)
+        if args.fingerprints:
+            save_fingerprints(args.fingerprints, names, fingerprints, scaffolds)
+    print(f'** {len(names)} fingerprints, {len(failed)} unreadable in {time.perf_counter() - start:.1f} s')
+
+    if args.by == 'scaffold':
+        groups = scaffold_groups(scaffolds)
+    else:
+        pairs = similar_pairs(fingerprints, args.threshold)
+        groups = (butina_clusters if args.by == 'similarity' else similarity_components)(len(names), pairs)
+        print(f'** {len(pairs[0])} pairs at Tanimoto >= {args.threshold:g}')
+    splits = assign_splits(groups, args.fractions, args.seed)
+
+    with open(args.output, 'w') as out:
+        for name, group, split in zip(names, groups, splits):
+            out.write(json.dumps({'name': name, 'cluster': int(group), 'split': SPLITS[split]}) + '\n')
+        for name, error in failed.items():
+            out.write(json.dumps({'name': name, 'cluster': None, 'split': None, 'error': error}) + '\n')
+    metrics.flush()
+    sizes = np.bincount(splits, minlength=len(SPLITS))
+    print(f"** {len(np.unique(groups))} groups; " + ', '.join(f'{split} {size}' for split, size in zip(SPLITS, sizes)) + f' in {time.perf_counter() - start:.1f} s')
@@ -0,0 +1,269 @@
+import argparse
+import atexit
+import functools
+import json
+import os
+import resource
+import socket
+import sys
+import time
+from contextlib import contextmanager
+
+# Instrumentation is off unless a metrics file is given, either with the environment
+# variable below or with `metrics.enable(path)` (i.e. the --metrics option of the scripts)
+METRICS_ENV = 'BSITE_METRICS'
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of the current process in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+class Metrics:
+    """
+    Collects per-file stage timings, counters and cache hits/misses and writes them as JSON lines.
+
+    One record is written for each `file()` block:
+        {"file": ..., "stages": {"parse": seconds, ...}, "counts": {"atoms_parsed": n, ...},
+         "cache": {"sdf": {"hit": n, "miss": n}}, "wall": seconds, "peak_rss_mb": MB, ...}
+
+    Timings and counts made outside of a `file()` block are written as a single record
+    with "file": null when the process exits.
+    """
+    def __init__(self, output=None):
+        self.output = None
+        self.enabled = False
+        self.record = None
+        if output:
+            self.enable(output)
+
+    def enable(self, output):
+        """
+        Turns instrumentation on; records are appended to `output`.
+        """
+        self.output = str(output)
+        self.enabled = True
+        # Child processes (i.e. find_HETATM_1.2.py called from a batch) write to the same file
+        os.environ[METRICS_ENV] = self.output
+
+    def _new_record(self, filepath=None, **fields):
+        return {
+            'file': str(filepath) if filepath is not None else None,
+            **fields,
+            'stages': {},
+            'counts': {},
+            'cache': {},
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'start': time.time(),
+        }
+
+    def _current(self):
+        if self.record is None:
+            self.record = self._new_record()
+        return self.record
+
+    @contextmanager
+    def file(self, filepath, **fields):
+        """
+        Attributes every stage and count inside the block to `filepath`.
+
+        Args:
+            filepath (str): the file being processed.
+            **fields: extra information stored in the record (i.e. the ligand HET id).
+        """
+        if not self.enabled:
+            yield
+            return
+        outer = self.record
+        self.record = self._new_record(filepath, **fields)
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            if not (isinstance(e, SystemExit) and not e.code):
+                self.record['error'] = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            self.record['wall'] = time.perf_counter() - start
+            self.emit(self.record)
+            self.record = outer
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the block and adds it to the stage `name` of the current record.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stages = self._current()['stages']
+            stages[name] = stages.get(name, 0.0) + time.perf_counter() - start
+
+    def timed(self, name):
+        """
+        Decorator version of `stage` for whole functions.
+        """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with self.stage(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, n=1):
+        """
+        Adds `n` to the counter `name` of the current record.
+        """
+        if not self.enabled:
+            return
+        counts = self._current()['counts']
+        counts[name] = counts.get(name, 0) + int(n)
+
+    def cache(self, name, hit):
+        """
+        Records a hit (`hit=True`) or miss of the cache `name`.
+        """
+        if not self.enabled:
+            return
+        cache = self._current()['cache'].setdefault(name, {'hit': 0, 'miss': 0})
+        cache['hit' if hit else 'miss'] += 1
+
+    def emit(self, record):
+        """
+        Appends a record to the metrics file as a single JSON line.
+        """
+        record['peak_rss_mb'] = peak_rss_mb()
+        with open(self.output, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def flush(self):
+        """
+        Writes the timings and counts made outside of a `file()` block.
+        """
+        if self.enabled and self.record is not None and self.record['file'] is None:
+            if self.record['stages'] or self.record['counts'] or self.record['cache']:
+                self.emit(self.record)
+            self.record = None
+
+
+metrics = Metrics(os.environ.get(METRICS_ENV))
+atexit.register(metrics.flush)
+
+
+def read_records(path):
+    """
+    Reads the records of a metrics file.
+
+    Args:
+        path (str): path to the .jsonl metrics file.
+
+    Returns:
+        list of dict: one dict per record.
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def summarize(records, top=10):
+    """
+    Aggregates metrics records into a run summary.
+
+    Args:
+        records (list of dict): records from `read_records`.
+        top (int): number of slowest files to list.
+
+    Returns:
+        dict: totals and percentiles per stage, counter totals, cache hit rates,
+        the highest peak RSS and the slowest files.
+    """
+    stage_times = {}
+    counts = {}
+    cache = {}
+    files = {}
+    errors = 0
+    n_records = 0
+    for record in records:
+        for name, seconds in record.get('stages', {}).items():
+            stage_times.setdefault(name, []).append(seconds)
+        for name, n in record.get('counts', {}).items():
+            counts[name] = counts.get(name, 0) + n
+        for name, c in record.get('cache', {}).items():
+            total = cache.setdefault(name, {'hit': 0, 'miss': 0})
+            total['hit'] += c['hit']
+            total['miss'] += c['miss']
+        if record.get('file') is not None:
+            n_records += 1
+            files[record['file']] = files.get(record['file'], 0.0) + record.get('wall', 0.0)
+        errors += 'error' in record
+
+    def percentile(values, q):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    stages = {
+        name: {
+            'total': sum(times),
+            'mean': sum(times) / len(times),
+            'p95': percentile(times, 0.95),
+            'max': max(times),
+            'n': len(times),
+        }
+        for name, times in stage_times.items()
+    }
+    for name, c in cache.items():
+        c['hit_rate'] = c['hit'] / (c['hit'] + c['miss']) if c['hit'] + c['miss'] else 0.0
+
+    return {
+        'files': len(files),
+        'records': n_records,
+        'errors': errors,
+        'wall': sum(files.values()),
+        'stages': stages,
+        'counts': counts,
+        'cache': cache,
+        'peak_rss_mb': max((record.get('peak_rss_mb', 0.0) for record in records), default=0.0),
+        'slowest': sorted(files.items(), key=lambda item: item[1], reverse=True)[:top],
+    }
+
+def print_summary(summary):
+    """
+    Prints a summary from `summarize` as a table.
+    """
+    print(f"** files: {summary['files']}  records: {summary['records']}  errors: {summary['errors']}  wall: {summary['wall']:.2f} s  peak RSS: {summary['peak_rss_mb']:.1f} MB")
+    # Stages can be nested (i.e. sdf_download inside bonds) so shares are relative to the wall time
+    total = summary['wall'] or sum(stage['total'] for stage in summary['stages'].values()) or 1.0
+    print(f"{'stage':<22}{'total s':>10}{'share':>8}{'mean s':>10}{'p95 s':>10}{'max s':>10}{'n':>8}")
+    for name, stage in sorted(summary['stages'].items(), key=lambda item: item[1]['total'], reverse=True):
+        print(f"{name:<22}{stage['total']:>10.2f}{stage['total'] / total:>8.1%}{stage['mean']:>10.4f}{stage['p95']:>10.4f}{stage['max']:>10.4f}{stage['n']:>8}")
+    for name, n in sorted(summary['counts'].items()):
+        print(f"** {name}: {n}")
+    for name, c in sorted(summary['cache'].items()):
+        print(f"** {name} cache: {c['hit']} hits, {c['miss']} misses ({c['hit_rate']:.1%} hit rate)")
+    if summary['slowest']:
+        print('** slowest files:')
+        for filepath, wall in summary['slowest']:
+            print(f"   {wall:>10.2f} s  {filepath}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='summarize a metrics .jsonl file')
+    parser.add_argument("metrics_file", help='metrics file written by a run with --metrics or BSITE_METRICS set')
+    parser.add_argument("--top", type=int, default=10, help='number of slowest files to list; default is 10')
+    parser.add_argument("--json", action='store_true', help='print the summary as JSON')
+    args = parser.parse_args()
+
+    summary = summarize(read_records(args.metrics_file), args.top)
+    if args.json:
+        print(json.dumps(summary, indent=1))
+    else:
+        print_summary(summary)
@@ -0,0 +1,87 @@
+import numpy as np
+import re
+
+# Charge field of the V2000 atom block
+V2000_CHARGES = {1: 3.0, 2: 2.0, 3: 1.0, 5: -1.0, 6: -2.0, 7: -3.0}
+
+
+def split_molblocks(text):
+    """
+    The molblocks of .sdf text, with their lines. Only the newline after each $$$$ is
+    dropped, so line 0 is always the title, even when it is empty (as RDKit writes it).
+    """
+    blocks = []
+    for i, block in enumerate(text.split('$$$$')):
+        if i:
+            block = block[2:] if block.startswith('\r\n') else block[1:] if block.startswith('\n') else block
+        lines = block.splitlines() if block.strip() else []
+        if len(lines) >= 4:
+            blocks.append(lines)
+    return blocks
+
+def parse_molblock(lines):
+    """
+    The atoms and data of one molblock (V2000 or V3000).
+
+    Returns:
+        dict: 'title', 'lines', 'coords' ((n_atoms, 3) array), 'elements', 'charges'
+        (formal charges from M  CHG lines, which supersede the V2000 atom block charge
+        field, or CHG= in V3000) and 'properties' ({name: value lines} of the SD data items).
+    """
+    coords, elements, charges = [], [], []
+    end = len(lines)
+    if 'V3000' in lines[3]:
+        atoms = False
+        for i, line in enumerate(lines[4:], 4):
+            if line.startswith('M  V30 BEGIN ATOM'):
+                atoms = True
+            elif line.startswith('M  V30 END ATOM'):
+                atoms = False
+            elif atoms:
+                fields = line[7:].split()
+                elements.append(fields[1])
+                coords.append(fields[2:5])
+                charges.append(next((float(field[4:]) for field in fields[6:] if field.startswith('CHG=')), 0.0))
+            elif line.startswith('M  END'):
+                end = i
+                break
+    else:
+        n_atoms = int(lines[3][0:3])
+        for line in lines[4:4 + n_atoms]:
+            coords.append((line[0:10], line[10:20], line[20:30]))
+            elements.append(line[31:34].strip())
+            charges.append(V2000_CHARGES.get(int(line[36:39].strip() or 0), 0.0))
+        chg = []
+        for i, line in enumerate(lines[4 + n_atoms:], 4 + n_atoms):
+            if line.startswith('M  CHG'):
+                chg.append(line)
+            elif line.startswith('M  END'):
+                end = i
+                break
+        if chg:
+            charges = [0.0] * n_atoms
+            for line in chg:
+                fields = line.split()[3:]
+                for atom, charge in zip(fields[::2], fields[1::2]):
+                    charges[int(atom) - 1] = float(charge)
+
+    properties, name = {}, None
+    for line in lines[end + 1:]:
+        if line.startswith('>'):
+            match = re.search(r'<([^>]*)>', line)
+            name = match.group(1) if match else None
+            if name is not None:
+                properties[name] = []
+        elif not line.strip():
+            name = None
+        elif name is not None:
+            properties[name].append(line)
+    return {'title': lines[0], 'lines': lines, 'coords': np.asarray(coords, dtype=float).reshape(-1, 3),
+            'elements': elements, 'charges': np.asarray(charges, dtype=float), 'properties': properties}
+
+def read_molblocks(path):
+    """
+    `parse_molblock` of every molblock of an .sdf (.sd, .mol) file.
+    """
+    with open(path) as f:
+        return [parse_molblock(lines) for lines in split_molblocks(f.read())]
@@ -1,12 +1,26 @@
 import numpy as np
 import pandas as pd
-from rdkit import Chem
-from rdkit.Chem import AllChem
-from scipy.spatial.distance import cdist
 
 import os
 from pathlib import Path
 
+from downloader import fetch_one, DownloadError
+from metrics import metrics
+from structure import Hierarchy
+
+
+class _Match:
+    """
+    The `index` and `empty` of the one-row dataframes the atom lookups of `bonds_protein_df` returned.
+    """
+    def __init__(self, label):
+        self.index = [] if label is None else [label]
+
+    @property
+    def empty(self):
+        return not self.index
+
+@metrics.timed('parse')
 def process_pdb(pdb_file):
     """
     Converts files from PDB format to a Pandas DataFrame
@@ -54,15 +68,19 @@ def process_pdb(pdb_file):
     pdb['orth_z'] = pdb['record_name'].str.slice(start=46, stop=54).str.strip().astype(float)
     pdb['occupancy'] = pdb['record_name'].str.slice(start=54, stop=60).str.strip()
     pdb['temp_factor'] = pdb['record_name'].str.slice(start=60, stop=66).str.strip()
-    pdb['element_plus_charge'] = pdb['record_name'].str.slice(start=66, stop=79).str.strip()
+    # Element in 76:78 and formal charge (i.e. 1+) in 78:80
+    pdb['element_plus_charge'] = pdb['record_name'].str.slice(start=66, stop=80).str.strip()
     pdb['record_name'] = pdb['record_name'].str.slice(stop=6).str.strip()
 
     # Remove water and glucose residues
     pdb = pdb[~pdb['residue'].str.startswith('HOH')]  # Removes waters from the PDB
     pdb = pdb[~pdb['residue'].str.startswith('GLC')]  # Removes glucose from the PDB
 
+    metrics.count('atoms_parsed', len(pdb))
+
     return pdb
 
+@metrics.timed('ligand_bonds')
 def bonds_ligand_df(obj, pdb_file=None, sdf_file=None, override_bond_order=False):
     """
     Adds bonds and bond orders to a pdb dataframe of a LIGAND. Requires a SDF file of the ligand with bonding information
@@ -78,6 +96,11 @@ def bonds_ligand_df(obj, pdb_file=None, sdf_file=None, override_bond_order=False
     Returns:
         dataframe with bonds and bond orders.
     """
+    # RDKit and scipy are only imported by the bond stage, so parsing with this module stays fast
+    from rdkit import Chem
+    from rdkit.Chem import AllChem
+    from scipy.spatial.distance import cdist
+
     m = Chem.MolFromPDBFile(pdb_file)
     m2 = Chem.MolFromMolFile(sdf_file)
 
@@ -174,8 +197,12 @@ def bonds_ligand_df(obj, pdb_file=None, sdf_file=None, override_bond_order=False
         df.at[closest_atom_idx, 'bond'].append([closest_atom_idx, _])
         df.at[closest_atom_idx, 'bond_order'].append(1)
 
+    # Both directions of every bond are stored, as in the 'bond' column
+    metrics.count('ligand_bonds_emitted', 2 * (m_bondorder.GetNumBonds() + len(hydrogen_atoms)))
+
     return df
 
+@metrics.timed('bonds')
 def bonds_protein_df(obj):
     """
     Adds bonds and bond orders to a PDB dataframe for a protein structure.
@@ -194,8 +221,24 @@ def bonds_protein_df(obj):
     fn = filename = Path(filepath).stem
 
 
-    def get_row(atom_name, df=df):
-        return df[(df['res_seq'] == res_seq) & (df['atom_name'] == atom_name)]
+    # Atoms are looked up by name within their residue, found in the hierarchy, instead of
+    # filtering the whole dataframe for every atom
+    hierarchy = Hierarchy.from_dataframe(df, ['chain', 'res_seq', 'residue'])
+    atom_names = df['atom_name'].to_numpy()
+    residue_atoms = {}
+
+    def atoms_of(chain, res_seq):
+        # {atom name: index label} of a residue; alternate locations (AARG, BARG) are one residue here
+        key = (chain, res_seq)
+        if key not in residue_atoms:
+            names = {}
+            for position in hierarchy.atoms(sorted(hierarchy.find(chain, res_seq))):
+                names.setdefault(atom_names[position], df.index[position])
+            residue_atoms[key] = names
+        return residue_atoms[key]
+
+    def get_row(atom_name):
+        return _Match(atoms_of(chain, res_seq).get(atom_name))
 
     def add_bond(idx, target_idx, bond_order):
         df.at[idx, 'bond'].append([idx, target_idx])
@@ -233,7 +276,7 @@ def bonds_protein_df(obj):
 
     for idx, row in df.iterrows():
 
-        res_seq = row['res_seq']
+        chain, res_seq = row['chain'], row['res_seq']
 
         if row['record_name'] == 'HETATM': # If your binding site has HETATMs, an SDF file will be downloaded for these bond orders
             
@@ -248,7 +291,15 @@ def bonds_protein_df(obj):
             # Download the file if not already processed
             url = f"https://files.rcsb.org/ligands/download/{residue}_ideal.sdf"
             newfile = f"{wd}/{fn}_{residue}"
-            os.system(f"wget -O {newfile}.sdf {url} > /dev/null 2>&1")
+            sdf_cached = os.path.isfile(f"{newfile}.sdf") and os.path.getsize(f"{newfile}.sdf") > 0
+            metrics.cache('sdf', sdf_cached)
+            if not sdf_cached:
+                with metrics.stage('sdf_download'):
+                    try:
+                        fetch_one(url, f"{newfile}.sdf")
+                    except DownloadError as e:
+                        print(f"Error downloading {url}: {e}")
+                        open(f"{newfile}.sdf", 'w').close() # Same empty file wget -O left behind
             downloaded_residues.add(residue)
             os.system(f"grep {residue} {filepath} > {newfile}.pdb")
             
@@ -285,7 +336,7 @@ def bonds_protein_df(obj):
             if row['atom_name'] == 'C': # Carboxyl Carbon
                 row1 = get_row('O')
                 add_bond(idx, row1.index[0], 2)
-                if (df['res_seq'] == row['res_seq']+1).any():
+                if hierarchy.find(chain, res_seq+1):
                     row2 = get_row('N')
                     add_bond(idx, row2.index[0], 1)
 
@@ -299,8 +350,8 @@ def bonds_protein_df(obj):
                 row2 = get_row('H')
                 if not row2.empty:
                     add_bond(idx, row2.index[0], 1)
-                if (df['res_seq'] == row['res_seq']-1).any():
-                    row3 = df[(df['res_seq'] == res_seq-1) & (df['atom_name'] == 'C')]
+                if hierarchy.find(chain, res_seq-1):
+                    row3 = _Match(atoms_of(chain, res_seq-1).get('C'))
                     if not row2.empty:
                         bond3 = [idx, row2.index[0]]
                         df.at[idx, 'bond'].append(bond3); df.at[idx, 'bond_order'].append(1)
@@ -633,4 +684,7 @@ def bonds_protein_df(obj):
                 if row['atom_name'] == 'OE1' or row['atom_name'] == 'OE2':
                     aromatic(idx, ['CG'])
 
+    if metrics.enabled:
+        metrics.count('bonds_emitted', sum(len(bonds) for bonds in df['bond']))
+
     return df
\ No newline at end of file
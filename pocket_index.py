@@ -0,0 +1,258 @@
+import numpy as np
+import argparse
+import json
+import time
+
+from featurizer import AMINO_ACIDS
+from metrics import metrics
+
+# Residue codes of the descriptor; cofactors, modified residues and anything else share the last one
+RESIDUE_CODES = {residue: i for i, residue in enumerate(AMINO_ACIDS)}
+OTHER_RESIDUE = len(AMINO_ACIDS)
+# Geometry bins in Å: distance of a residue to the pocket centroid, and between two residues
+SHELL_WIDTH = 3.0
+PAIR_WIDTH = 2.0
+PAIR_CUTOFF = 12.0
+NUM_PERM = 128
+THRESHOLD = 0.8
+
+# Tokens are packed into one integer: kind | residue | residue | bin | occurrence
+_COMPOSITION, _SHELL, _PAIR = 0, 1, 2
+
+
+def _pack(kind, first, second, bin_, occurrence):
+    return (kind << 40) | (first << 32) | (second << 24) | (bin_ << 16) | occurrence
+
+def _with_occurrence(base):
+    # Repeated tokens are numbered (LEU#0, LEU#1, ...) so that the set keeps the multiset
+    order = np.argsort(base, kind='stable')
+    sorted_base = base[order]
+    starts = np.r_[0, np.flatnonzero(sorted_base[1:] != sorted_base[:-1]) + 1]
+    occurrence = np.arange(len(base)) - np.repeat(starts, np.diff(np.r_[starts, len(base)]))
+    return sorted_base | np.minimum(occurrence, 0xFFFF)
+
+@metrics.timed('pocket_descriptor')
+def pocket_tokens(site):
+    """
+    The descriptor of a binding site: a set of integer tokens from its residue composition and geometry.
+
+    Three kinds of tokens are made from the residues (their centroids):
+        composition: the residue type;
+        shell: the residue type and its distance to the pocket centroid, in SHELL_WIDTH bins;
+        pair: two residue types and their distance, in PAIR_WIDTH bins up to PAIR_CUTOFF.
+    Repeated tokens are numbered, so two pockets with the same residues at the same
+    distances have the same set and the Jaccard similarity of two sets measures how
+    much of the pockets is the same. Nothing depends on the orientation of the pocket.
+
+    Args:
+        site (pandas.DataFrame): binding site atoms (`process_pdb` columns).
+
+    Returns:
+        numpy.ndarray: sorted, unique int64 tokens.
+    """
+    keys = site['residue'].astype(str) + '|' + site['chain'].astype(str) + '|' + site['res_seq'].astype(str)
+    coords = site[['orth_x', 'orth_y', 'orth_z']].to_numpy(dtype=float)
+    codes, inverse = np.unique(keys.to_numpy(), return_inverse=True)
+    counts = np.bincount(inverse)
+    centroids = np.column_stack([np.bincount(inverse, coords[:, k]) for k in range(3)]) / counts[:, None]
+    residues = np.array([RESIDUE_CODES.get(code.split('|')[0], OTHER_RESIDUE) for code in codes], dtype=np.int64)
+
+    shell = np.minimum(np.linalg.norm(centroids - coords.mean(axis=0), axis=1) // SHELL_WIDTH, 255).astype(np.int64)
+    i, j = np.triu_indices(len(residues), k=1)
+    distance = np.linalg.norm(centroids[i] - centroids[j], axis=1)
+    near = distance < PAIR_CUTOFF
+    i, j = i[near], j[near]
+    first, second = np.minimum(residues[i], residues[j]), np.maximum(residues[i], residues[j])
+
+    tokens = np.concatenate([
+        _with_occurrence(_pack(_COMPOSITION, residues, 0, 0, 0)),
+        _with_occurrence(_pack(_SHELL, residues, 0, shell, 0)),
+        _with_occurrence(_pack(_PAIR, first, second, (distance[near] // PAIR_WIDTH).astype(np.int64), 0)),
+    ])
+    return np.unique(tokens)
+
+def jaccard(a, b):
+    """
+    Jaccard similarity of two token sets from `pocket_tokens`.
+    """
+    union = len(np.union1d(a, b))
+    return len(np.intersect1d(a, b, assume_unique=True)) / union if union else 1.0
+
+
+class MinHasher:
+    """
+    MinHash signatures of token sets: the fraction of equal values of two signatures
+    estimates the Jaccard similarity of the sets.
+
+    Args:
+        num_perm (int): signature length.
+        seed (int): seed of the hash functions; signatures are only comparable with the same seed.
+    """
+    def __init__(self, num_perm=NUM_PERM, seed=1):
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hashing on uint64, which wraps around
+        self.a = rng.integers(1, 2**63, num_perm, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 2**63, num_perm, dtype=np.uint64)
+        self.num_perm = num_perm
+
+    def signature(self, tokens):
+        tokens = np.asarray(tokens, dtype=np.int64).view(np.uint64)
+        if not len(tokens):
+            return np.full(self.num_perm, np.iinfo(np.uint32).max, dtype=np.uint32)
+        with np.errstate(over='ignore'):
+            hashes = (self.a[:, None] * tokens[None, :] + self.b[:, None]) >> np.uint64(32)
+        return hashes.min(axis=1).astype(np.uint32)
+
+def lsh_bands(num_perm, threshold):
+    """
+    The (bands, rows) split of a signature whose S-curve (1 - (1 - s^rows)^bands) rises at `threshold`.
+
+    Bands and rows are chosen so that pairs at the threshold are found with a probability
+    of about 0.9 or more; the candidates are checked against the threshold afterwards, so
+    a lower rise only costs comparisons.
+    """
+    best = None
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        found = 1 - (1 - threshold ** rows) ** bands
+        if found >= 0.9 and (best is None or rows > best[1]):
+            best = (bands, rows)
+    return best or (num_perm, 1)
+
+
+class PocketIndex:
+    """
+    Locality-sensitive hashing index of pocket signatures for near-duplicate search.
+
+    Signatures are cut into bands and every band is a key of a hash table, so pockets that
+    agree on a whole band are candidates; candidates are kept when their estimated Jaccard
+    similarity is at least `threshold`. A query costs the size of its buckets, not of the index.
+
+    Args:
+        threshold (float): Jaccard similarity above which two pockets are near duplicates.
+        num_perm (int): signature length.
+        seed (int): seed of the MinHash functions.
+    """
+    def __init__(self, threshold=THRESHOLD, num_perm=NUM_PERM, seed=1):
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm, seed)
+        self.bands, self.rows = lsh_bands(num_perm, threshold)
+        self.tables = [{} for _ in range(self.bands)]
+        self.names = []
+        self.signatures = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def _band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def query(self, signature):
+        """
+        The pockets of the index within the threshold of `signature`.
+
+        Returns:
+            list: (position, estimated similarity) pairs, most similar first.
+        """
+        candidates = set()
+        for table, key in zip(self.tables, self._band_keys(signature)):
+            candidates.update(table.get(key, ()))
+        metrics.count('lsh_candidates', len(candidates))
+        if not candidates:
+            return []
+        candidates = np.fromiter(candidates, dtype=np.int64)
+        similarity = (np.stack([self.signatures[i] for i in candidates]) == signature).mean(axis=1)
+        keep = similarity >= self.threshold
+        order = np.argsort(-similarity[keep], kind='stable')
+        return list(zip(candidates[keep][order].tolist(), similarity[keep][order].tolist()))
+
+    def add(self, name, signature):
+        position = len(self.names)
+        for table, key in zip(self.tables, self._band_keys(signature)):
+            table.setdefault(key, []).append(position)
+        self.names.append(name)
+        self.signatures.append(signature)
+        return position
+
+
+@metrics.timed('dedup')
+def cluster_pockets(items, threshold=THRESHOLD, num_perm=NUM_PERM, seed=1, progress=None):
+    """
+    Groups pockets into clusters of near duplicates.
+
+    Every pocket is queried against the pockets before it and joined to the clusters of
+    its near duplicates (single linkage, with a union-find), so the whole set is clustered
+    in one pass without comparing all pairs. The representative of a cluster is its first
+    pocket in input order.
+
+    Args:
+        items (iterable): (name, tokens from `pocket_tokens`) pairs.
+        threshold (float): Jaccard similarity above which two pockets are near duplicates.
+        num_perm (int): MinHash signature length.
+        seed (int): seed of the MinHash functions.
+        progress (int): if given, a progress line is printed every `progress` pockets.
+
+    Returns:
+        list: one dict per pocket, in input order: 'name', 'cluster' (position of the
+        representative), 'representative' (its name) and 'similarity' (estimated Jaccard
+        similarity to the closest earlier pocket, 0 for the first of a cluster).
+    """
+    index = PocketIndex(threshold, num_perm, seed)
+    parent = []
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    similarity = []
+    start = time.perf_counter()
+    for name, tokens in items:
+        signature = index.hasher.signature(tokens)
+        matches = index.query(signature)
+        position = index.add(name, signature)
+        parent.append(position)
+        for match, _ in matches:
+            a, b = root(match), root(position)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+        similarity.append(matches[0][1] if matches else 0.0)
+        if progress and len(index) % progress == 0:
+            print(f'** {len(index)} pockets indexed in {time.perf_counter() - start:.1f} s')
+
+    metrics.count('pockets_indexed', len(index))
+    return [{'name': name, 'cluster': root(i), 'representative': index.names[root(i)], 'similarity': round(similarity[i], 4)}
+            for i, name in enumerate(index.names)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='pocket fingerprints and near-duplicate removal with locality-sensitive hashing')
+    parser.add_argument("sources", nargs='+', help='.bsa archives or directories of _binding_site.pdb/_ligand.pdb pairs')
+    parser.add_argument("-o", "--output", required=True, help='cluster of every pocket, one JSON line per pocket')
+    parser.add_argument("-k", "--keep", required=False, help='if included, the names of the cluster representatives are written to this file, one per line')
+    parser.add_argument("-t", "--threshold", type=float, default=THRESHOLD, help=f'Jaccard similarity of near duplicates; default is {THRESHOLD}')
+    parser.add_argument("-n", "--num_perm", type=int, default=NUM_PERM, help=f'MinHash signature length; default is {NUM_PERM}')
+    parser.add_argument("-p", "--progress", type=int, default=10000, help='a progress line is printed every this many pockets; default is 10000')
+    parser.add_argument("-m", "--metrics", required=False, help='if included, descriptor and index timings are appended to this .jsonl file')
+    args = parser.parse_args()
+
+    from interactions import iter_complexes
+
+    if args.metrics:
+        metrics.enable(args.metrics)
+
+    start = time.perf_counter()
+    items = ((name, pocket_tokens(site)) for source in args.sources for name, _, site in iter_complexes(source))
+    clusters = cluster_pockets(items, args.threshold, args.num_perm, progress=args.progress)
+    with open(args.output, 'w') as out:
+        for record in clusters:
+            out.write(json.dumps(record) + '\n')
+    representatives = [record['name'] for i, record in enumerate(clusters) if record['cluster'] == i]
+    if args.keep:
+        with open(args.keep, 'w') as f:
+            f.write(''.join(name + '\n' for name in representatives))
+    metrics.flush()
+    print(f'** {len(clusters)} pockets, {len(representatives)} clusters at Jaccard >= {args.threshold:g} in {time.perf_counter() - start:.1f} s')
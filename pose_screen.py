@@ -0,0 +1,287 @@
+import numpy as np
+import argparse
+import json
+import time
+from pathlib import Path
+
+from featurizer import element_codes
+from metrics import metrics
+from molblocks import read_molblocks
+from structure import COLUMNS
+from tensors import aligned_zeros
+from voxelizer import Voxelizer
+
+# Space around the pocket for the poses, in Å, when the grid is taken from the pocket itself
+MARGIN = 4.0
+BATCH_SIZE = 256
+# Predictions with more values than this (i.e. per-voxel scores) are written as their mean
+INLINE_VALUES = 64
+
+
+def _pose_array(coords, elements):
+    data = np.zeros((len(coords), 4))
+    if len(coords):
+        data[:, :3] = np.asarray(coords, dtype=float)
+        data[:, 3] = element_codes(elements)
+    return data
+
+def read_pdb_poses(path):
+    """
+    Poses of a multi-model .pdb file: one pose per MODEL record, or the whole file when it
+    has none.
+
+    Pose files hold thousands of models, so the file is read as one byte array: lines are
+    found from the newlines and every field is gathered from all the atom lines at once,
+    with the columns of `structure.COLUMNS`.
+
+    Returns:
+        list: (name, title, (n_atoms, 4) array of x, y, z and element code) per pose.
+    """
+    stem = Path(path).stem
+    with open(path, 'rb') as f:
+        buffer = np.frombuffer(f.read(), dtype=np.uint8)
+    if not len(buffer):
+        return []
+    ends = np.flatnonzero(buffer == ord('\n'))
+    if not len(ends) or ends[-1] != len(buffer) - 1:
+        ends = np.r_[ends, len(buffer)]
+    starts = np.r_[0, ends[:-1] + 1]
+    lengths = ends - starts - (buffer[np.maximum(ends - 1, 0)] == ord('\r'))
+
+    def field(lines, start, stop):
+        # Columns start:stop of `lines`, padded with spaces past the end of a line
+        columns = np.arange(start, stop)
+        chars = buffer[np.minimum(starts[lines, None] + columns, len(buffer) - 1)]
+        chars[columns >= lengths[lines, None]] = ord(' ')
+        return chars.view(f'S{stop - start}').reshape(len(lines))
+
+    everything = np.arange(len(starts))
+    record = field(everything, 0, 6)
+    atoms = np.flatnonzero(np.char.startswith(record, b'ATOM') | (record == b'HETATM'))
+    models = np.flatnonzero(np.char.startswith(record, b'MODEL'))
+
+    data = np.zeros((len(atoms), 4))
+    if len(atoms):
+        data[:, :3] = np.stack([field(atoms, *COLUMNS[axis]) for axis in ('orth_x', 'orth_y', 'orth_z')], axis=1).astype(float)
+        data[:, 3] = element_codes(field(atoms, *COLUMNS['element_plus_charge']).astype(str))
+    if not len(models):
+        return [(f'{stem}:1', '', data)] if len(atoms) else []
+    names = [name.strip() or str(i + 1) for i, name in enumerate(field(models, 5, 80).astype(str))]
+    bounds = np.r_[np.searchsorted(atoms, models), len(atoms)]
+    return [(f'{stem}:{name}', '', data[bounds[i]:bounds[i + 1]]) for i, name in enumerate(names)]
+
+def read_sdf_poses(path):
+    """
+    Poses of an .sdf file, one per molblock (V2000 or V3000); hydrogens are kept as written.
+
+    Returns:
+        list: (name, title, (n_atoms, 4) array of x, y, z and element code) per pose.
+    """
+    stem = Path(path).stem
+    return [(f'{stem}:{i}', molblock['title'].strip(), _pose_array(molblock['coords'], molblock['elements']))
+            for i, molblock in enumerate(read_molblocks(path), 1)]
+
+def read_poses(path):
+    """
+    Poses of an .sdf (.sd, .mol) or multi-model .pdb file; see `read_sdf_poses` and `read_pdb_poses`.
+    """
+    if str(path).lower().endswith(('.sdf', '.sd', '.mol')):
+        return read_sdf_poses(path)
+    return read_pdb_poses(path)
+
+def pocket_spec(data, voxel_size=1.0, margin=MARGIN, shape=None):
+    """
+    A grid for a pocket, as a `Voxelizer.spec()`: its bounding box plus `margin` Å on every
+    side or, with `shape` (i.e. the input of a model), a grid of that shape centered on it.
+    """
+    coords = data[:, :3]
+    if shape is not None:
+        low = coords.mean(axis=0) - np.array(shape) * voxel_size / 2
+    else:
+        low = coords.min(axis=0) - margin
+        shape = np.ceil((coords.max(axis=0) + margin - low) / voxel_size).astype(int)
+    return {'global_min': [float(value) for value in low], 'shape': [int(n) for n in shape], 'voxel_size': float(voxel_size)}
+
+def pocket_grid_stage(pocket_file, spec):
+    # Stage function of StageCache, so only its inputs and parameters are used
+    from inference import pocket_data
+    return Voxelizer.from_spec(spec).dense(pocket_data(str(pocket_file)))
+
+
+class PoseScreen:
+    """
+    Voxelizes (and scores) docked ligand poses in one binding site.
+
+    The pocket is voxelized once, and with a `cache` directory once per pocket file and
+    grid across runs (see stage_cache.py). Every batch of poses is then one array
+    operation: the cached pocket grid is broadcast into the pocket channel of an aligned
+    batch and the atoms of all the poses are indexed together and written into the
+    ligand channel, so nothing is parsed or voxelized per pose.
+
+    Args:
+        pocket_file (str): binding site .pdb file.
+        spec (dict): `Voxelizer.spec()` of the grid (see `pocket_spec`).
+        model: a loaded Keras model (see `inference.load_model`), or None to only voxelize.
+        overlay (bool): if True, ligand atoms are written over the pocket in its channel
+            instead of into a second channel.
+        channels (str): 'last' or 'first'; see `Voxelizer.batch_shape`.
+        cache (str): StageCache directory for the pocket grid.
+    """
+    def __init__(self, pocket_file, spec, model=None, overlay=False, channels='last', cache=None):
+        self.voxelizer = Voxelizer.from_spec(spec)
+        self.model = model
+        self.channels = channels
+        self.n_channels = 1 if overlay else 2
+        self.ligand_channel = 0 if overlay else 1
+        if model is not None:
+            input_shape = tuple(model.input_shape[1:])
+            if input_shape[:3] != tuple(spec['shape']):
+                raise ValueError(f"grid {tuple(spec['shape'])} does not match the model input {input_shape[:3]}")
+            model_channels = input_shape[3] if len(input_shape) > 3 else 1
+            if model_channels != self.n_channels:
+                raise ValueError(f'the model takes {model_channels} input channels, the batches have {self.n_channels}' +
+                                 (' (use overlay)' if not overlay else ''))
+            self.channels = 'last' if len(input_shape) > 3 else None
+        if self.channels is None and self.n_channels > 1:
+            raise ValueError('a pocket and a ligand channel need a channel axis; use overlay')
+        start = time.perf_counter()
+        if cache:
+            from stage_cache import StageCache
+            artifact = StageCache(cache).run('pocket_grid', pocket_grid_stage, [pocket_file], {'spec': spec})
+            self.pocket, self.pocket_cached = artifact.value, artifact.hit
+        else:
+            self.pocket, self.pocket_cached = pocket_grid_stage(pocket_file, spec), False
+        self.pocket_seconds = time.perf_counter() - start
+
+    def _channel(self, batch, channel):
+        # (n, x, y, z) view of one channel of a batch
+        if self.channels == 'first':
+            return batch[:, channel]
+        return batch[..., channel] if self.channels == 'last' else batch
+
+    @metrics.timed('pose_voxelize')
+    def batch(self, datasets):
+        """
+        The grids of the poses in `datasets`, composited onto the pocket.
+
+        Returns:
+            tuple: (batch array, dict of per-pose 'atoms', 'outside' (atoms outside the grid,
+            which are clipped to its edge as in training) and 'clashes' (atoms on a voxel of a
+            pocket atom)).
+        """
+        voxelizer = self.voxelizer
+        batch = aligned_zeros(voxelizer.batch_shape(len(datasets), self.channels, self.n_channels), np.float32)
+        self._channel(batch, 0)[...] = self.pocket
+
+        lengths = np.array([len(data) for data in datasets], dtype=np.int64)
+        data = np.concatenate(datasets) if len(datasets) else np.zeros((0, 4))
+        owner = np.repeat(np.arange(len(datasets)), lengths)
+        raw = np.floor((data[:, :3] - voxelizer.global_min) / voxelizer.voxel_size)
+        outside = ((raw < 0) | (raw >= [voxelizer.x_dim, voxelizer.y_dim, voxelizer.z_dim])).any(axis=1)
+        indices = voxelizer.index_array(data)
+        clashes = self.pocket[indices[:, 0], indices[:, 1], indices[:, 2]] != 0
+        self._channel(batch, self.ligand_channel)[owner, indices[:, 0], indices[:, 1], indices[:, 2]] = data[:, 3]
+        metrics.count('poses_voxelized', len(datasets))
+
+        stats = {'atoms': lengths,
+                 'outside': np.bincount(owner, outside, minlength=len(datasets)).astype(np.int64),
+                 'clashes': np.bincount(owner, clashes, minlength=len(datasets)).astype(np.int64)}
+        return batch, stats
+
+    def run(self, pose_files, output, batch_size=BATCH_SIZE, progress=10000):
+        """
+        Voxelizes the poses of `pose_files` in batches of `batch_size`, scores them with the
+        model if there is one and writes one JSON line per pose to `output`.
+
+        Lines are {"name", "title", "file", "atoms", "outside", "clashes"} and, with a model,
+        "prediction" (a list) or "score" (the mean of a prediction larger than INLINE_VALUES).
+
+        Returns:
+            dict: counts and timings.
+        """
+        start = time.perf_counter()
+        summary = {'poses': 0, 'read_seconds': 0.0, 'voxelize_seconds': 0.0, 'predict_seconds': 0.0}
+
+        with open(output, 'w') as out:
+            def flush(poses):
+                begin = time.perf_counter()
+                batch, stats = self.batch([data for _, _, _, data in poses])
+                summary['voxelize_seconds'] += time.perf_counter() - begin
+                predictions = None
+                if self.model is not None:
+                    begin = time.perf_counter()
+                    with metrics.stage('predict'):
+                        predictions = np.asarray(self.model.predict_on_batch(batch))
+                    summary['predict_seconds'] += time.perf_counter() - begin
+                for i, (name, title, pose_file, _) in enumerate(poses):
+                    record = {'name': name, 'title': title, 'file': pose_file,
+                              'atoms': int(stats['atoms'][i]), 'outside': int(stats['outside'][i]), 'clashes': int(stats['clashes'][i])}
+                    if predictions is not None:
+                        prediction = predictions[i]
+                        if prediction.size <= INLINE_VALUES:
+                            record['prediction'] = prediction.ravel().tolist()
+                        else:
+                            record['score'] = float(prediction.mean())
+                    out.write(json.dumps(record) + '\n')
+                summary['poses'] += len(poses)
+                if progress and summary['poses'] // progress != (summary['poses'] - len(poses)) // progress:
+                    seconds = time.perf_counter() - start
+                    print(f"** {summary['poses']} poses in {seconds:.1f} s ({summary['poses'] / seconds:.0f} per s)")
+
+            pending = []
+            for pose_file in pose_files:
+                begin = time.perf_counter()
+                poses = read_poses(pose_file)
+                summary['read_seconds'] += time.perf_counter() - begin
+                for name, title, data in poses:
+                    pending.append((name, title, str(pose_file), data))
+                    if len(pending) == batch_size:
+                        flush(pending)
+                        pending = []
+            if pending:
+                flush(pending)
+
+        summary['seconds'] = time.perf_counter() - start
+        summary['poses_per_second'] = summary['poses'] / summary['seconds'] if summary['seconds'] else 0.0
+        return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='voxelize and score many docked ligand poses in one binding site')
+    parser.add_argument("-p", "--pocket", required=True, help='binding site .pdb file')
+    parser.add_argument("-l", "--poses", nargs='+', required=True, help='pose files: .sdf (several molblocks) or multi-model .pdb')
+    parser.add_argument("-o", "--output", required=True, help='one JSON line per pose')
+    parser.add_argument("-M", "--model", required=False, help='if included, the poses are scored with this saved Keras model')
+    parser.add_argument("-g", "--grid", required=False, help='grid of the training voxelizer (Voxelizer.save_spec); default is the model input shape centered on the pocket, or the pocket box plus --margin')
+    parser.add_argument("-c", "--center", action='store_true', help='if included, the grid given with -g is centered on the pocket')
+    parser.add_argument("-v", "--voxel_size", type=float, default=1.0, help='voxel size when no grid is given; default is 1Å')
+    parser.add_argument("--margin", type=float, default=MARGIN, help=f'space around the pocket when the grid is the pocket box; default is {MARGIN}Å')
+    parser.add_argument("--overlay", action='store_true', help='if included, ligand atoms are written over the pocket channel instead of into a second channel')
+    parser.add_argument("-b", "--batch_size", type=int, default=BATCH_SIZE, help=f'poses per batch; default is {BATCH_SIZE}')
+    parser.add_argument("-C", "--cache", required=False, help='if included, the pocket grid is cached in this StageCache directory')
+    parser.add_argument("-m", "--metrics", required=False, help='if included, voxelization and predict timings are appended to this .jsonl file')
+    args = parser.parse_args()
+
+    from inference import pocket_data, load_model
+
+    if args.metrics:
+        metrics.enable(args.metrics)
+
+    model = load_model(args.model) if args.model else None
+    pocket = pocket_data(args.pocket)
+    if args.grid:
+        with open(args.grid) as f:
+            spec = json.load(f)
+        if args.center:
+            spec = pocket_spec(pocket, spec['voxel_size'], shape=spec['shape'])
+    elif model is not None:
+        spec = pocket_spec(pocket, args.voxel_size, shape=tuple(model.input_shape[1:4]))
+    else:
+        spec = pocket_spec(pocket, args.voxel_size, args.margin)
+
+    screen = PoseScreen(args.pocket, spec, model, args.overlay, cache=args.cache)
+    print(f"** pocket grid {'x'.join(str(n) for n in spec['shape'])} {'reused' if screen.pocket_cached else 'built'} in {screen.pocket_seconds:.3f} s")
+    summary = screen.run(args.poses, args.output, args.batch_size)
+    metrics.flush()
+    print(f"** {summary['poses']} poses in {summary['seconds']:.1f} s ({summary['poses_per_second']:.0f} per s): "
+          f"{summary['read_seconds']:.1f} s reading, {summary['voxelize_seconds']:.1f} s voxelizing, {summary['predict_seconds']:.1f} s in predict")
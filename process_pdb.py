@@ -1,6 +1,9 @@
 import numpy as np
 import pandas as pd
 
+from metrics import metrics
+
+@metrics.timed('parse')
 def process_pdb(pdbfile):
     # Read the initial PDB file
     with open(pdbfile, 'r') as initial_read:
@@ -40,11 +43,14 @@ def process_pdb(pdbfile):
     pdb['orth_z'] = pdb['record_name'].str.slice(start=46, stop=54).str.strip().astype(float)
     pdb['occupancy'] = pdb['record_name'].str.slice(start=54, stop=60).str.strip()
     pdb['temp_factor'] = pdb['record_name'].str.slice(start=60, stop=66).str.strip()
-    pdb['element_plus_charge'] = pdb['record_name'].str.slice(start=66, stop=79).str.strip()
+    # Element in 76:78 and formal charge (i.e. 1+) in 78:80
+    pdb['element_plus_charge'] = pdb['record_name'].str.slice(start=66, stop=80).str.strip()
     pdb['record_name'] = pdb['record_name'].str.slice(stop=6).str.strip()
 
     # Remove water and glucose residues
     pdb = pdb[~pdb['residue'].str.startswith('HOH')]  # Removes waters from the PDB
     pdb = pdb[~pdb['residue'].str.startswith('GLC')]  # Removes glucose from the PDB
 
+    metrics.count('atoms_parsed', len(pdb))
+
     return pdb
@@ -0,0 +1,213 @@
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import time
+from scipy.spatial import cKDTree
+
+from featurizer import _lookup, parse_element
+from metrics import metrics
+
+# Bondi van der Waals radii (Å); other elements get DEFAULT_RADIUS
+VDW_RADII = {'H': 1.20, 'C': 1.70, 'N': 1.55, 'O': 1.52, 'S': 1.80, 'P': 1.80, 'F': 1.47, 'CL': 1.75,
+             'BR': 1.85, 'I': 1.98, 'SE': 1.90, 'MG': 1.73, 'ZN': 1.39, 'FE': 1.94, 'CA': 2.31, 'NA': 2.27, 'K': 2.75}
+DEFAULT_RADIUS = 1.80
+PROBE = 1.4
+N_POINTS = 100
+
+
+def vdw_radii(element_plus_charge):
+    """
+    Van der Waals radii of the 'element_plus_charge' column of a pdb dataframe.
+    """
+    return _lookup(element_plus_charge, lambda value: VDW_RADII.get(parse_element(value)[0].upper(), DEFAULT_RADIUS), np.float64)
+
+def sphere_points(n=N_POINTS):
+    """
+    `n` nearly evenly spaced points on the unit sphere (golden spiral).
+    """
+    i = np.arange(n) + 0.5
+    polar = np.arccos(1 - 2 * i / n)
+    azimuth = np.pi * (1 + 5**0.5) * i
+    return np.column_stack([np.cos(azimuth) * np.sin(polar), np.sin(azimuth) * np.sin(polar), np.cos(polar)])
+
+@metrics.timed('sasa')
+def atom_sasa(coords, radii, targets=None, groups=None, n_points=N_POINTS, probe=PROBE, batch_size=256, tree=None):
+    """
+    Shrake-Rupley solvent accessible surface area of each atom in `targets`.
+
+    Every target atom gets `n_points` test points on its sphere (van der Waals radius +
+    probe); a point is buried when it lies inside the sphere of another atom. Neighbors
+    come from a k-d tree over all the atoms and the points of a batch of targets are tested
+    against all of their neighbors at once, so only overlapping spheres are ever compared.
+
+    With `groups` (i.e. 0 for protein and 1 for ligand atoms), the same test also gives
+    the SASA of each atom with only its own group present, so the unbound and bound states
+    come from one pass.
+
+    Args:
+        coords (numpy.ndarray): (n, 3) coordinates of every atom that can bury a point.
+        radii (numpy.ndarray): van der Waals radii (see `vdw_radii`).
+        targets (numpy.ndarray): positions of the atoms whose SASA is computed; default is all.
+        groups (numpy.ndarray): group label of every atom, for the unbound SASA.
+        n_points (int): test points per atom.
+        probe (float): probe radius in Å.
+        batch_size (int): target atoms per batch.
+        tree (cKDTree): tree over `coords`, if one exists already.
+
+    Returns:
+        numpy.ndarray: SASA (Å²) of the targets, or (bound, unbound) when `groups` is given.
+    """
+    coords = np.asarray(coords, dtype=float)
+    radii = np.asarray(radii, dtype=float) + probe
+    targets = np.arange(len(coords)) if targets is None else np.asarray(targets)
+    tree = cKDTree(coords) if tree is None else tree
+    sphere = sphere_points(n_points)
+    squared = radii**2
+    bound = np.zeros(len(targets))
+    unbound = np.zeros(len(targets)) if groups is not None else None
+
+    for start in range(0, len(targets), batch_size):
+        batch = targets[start:start + batch_size]
+        hits = tree.query_ball_point(coords[batch], radii[batch] + radii.max())
+        lengths = np.fromiter((len(hit) for hit in hits), dtype=np.int64, count=len(hits))
+        owner = np.repeat(np.arange(len(batch)), lengths)
+        neighbor = np.concatenate(hits).astype(np.int64) if lengths.sum() else np.zeros(0, dtype=np.int64)
+        # Only other atoms whose spheres overlap
+        keep = (neighbor != batch[owner]) & (np.linalg.norm(coords[neighbor] - coords[batch[owner]], axis=1) < radii[neighbor] + radii[batch[owner]])
+        owner, neighbor = owner[keep], neighbor[keep]
+        metrics.count('sasa_pairs', len(owner))
+
+        # A point p = a + R_a s is inside the sphere of n when |a - n|² + R_a² + 2 R_a (a - n)·s < R_n²,
+        # so the points of all pairs are tested with one matrix product
+        delta = coords[batch[owner]] - coords[neighbor]
+        owner_radii = radii[batch[owner]]
+        limit = squared[neighbor] - (delta**2).sum(axis=1) - owner_radii**2
+        inside = 2 * owner_radii[:, None] * (delta @ sphere.T) < limit[:, None]
+        area = 4 * np.pi * squared[batch] / n_points
+
+        def exposed(inside):
+            buried = np.zeros((len(batch), n_points), dtype=bool)
+            if len(owner):
+                # Pairs are ordered by their target, so each target's pairs are one run
+                starts = np.r_[0, np.flatnonzero(np.diff(owner)) + 1]
+                buried[owner[starts]] = np.logical_or.reduceat(inside, starts, axis=0)
+            return (~buried).sum(axis=1) * area
+
+        bound[start:start + len(batch)] = exposed(inside)
+        if groups is not None:
+            same = groups[neighbor] == groups[batch[owner]]
+            unbound[start:start + len(batch)] = exposed(inside & same[:, None])
+    return (bound, unbound) if groups is not None else bound
+
+def atom_sasa_reference(coords, radii, n_points=N_POINTS, probe=PROBE):
+    """
+    The plain Shrake-Rupley loop (every point of every atom against every other atom),
+    kept to check `atom_sasa` against.
+    """
+    radii = np.asarray(radii, dtype=float) + probe
+    sphere = sphere_points(n_points)
+    sasa = np.zeros(len(coords))
+    for i in range(len(coords)):
+        exposed = 0
+        for point in coords[i] + radii[i] * sphere:
+            if not any(j != i and np.sum((point - coords[j])**2) < radii[j]**2 for j in range(len(coords))):
+                exposed += 1
+        sasa[i] = 4 * np.pi * radii[i]**2 * exposed / n_points
+    return sasa
+
+def complex_sasa(ligand, site, protein=None, n_points=N_POINTS, probe=PROBE):
+    """
+    Per-atom SASA of a binding site and its ligand, bound and unbound.
+
+    The surroundings of the site are the whole `protein` when given (i.e. during extraction),
+    so residues at the edge of the site are not exposed where the rest of the protein would
+    cover them; from a binding site file alone, the site is all there is.
+
+    Args:
+        ligand (pandas.DataFrame): ligand atoms.
+        site (pandas.DataFrame): binding site atoms.
+        protein (pandas.DataFrame): every protein atom, of which `site` is a subset.
+
+    Returns:
+        tuple: (site, ligand) dataframes with 'sasa_unbound', 'sasa_bound' and 'sasa_buried' columns.
+    """
+    protein = site if protein is None else protein
+    xyz = ['orth_x', 'orth_y', 'orth_z']
+    coords = np.concatenate([protein[xyz].to_numpy(dtype=float), ligand[xyz].to_numpy(dtype=float)])
+    radii = vdw_radii(pd.concat([protein['element_plus_charge'], ligand['element_plus_charge']]).to_numpy())
+    groups = np.r_[np.zeros(len(protein), dtype=np.int8), np.ones(len(ligand), dtype=np.int8)]
+    if protein is site:
+        site_positions = np.arange(len(site))
+    else:
+        # Positions of the site atoms in `protein`; sites from `complete_residues` have a new index
+        from binding_site import residue_columns
+        columns = residue_columns(site) + ['atom_name', 'serial_number']
+        positions = protein[columns].reset_index(drop=True).reset_index()
+        site_positions = site[columns].merge(positions, on=columns, how='left')['index'].to_numpy()
+        if np.isnan(site_positions.astype(float)).any():
+            raise ValueError('the binding site has atoms that are not in the protein')
+        site_positions = site_positions.astype(np.int64)
+    targets = np.r_[site_positions, np.arange(len(protein), len(coords))]
+    bound, unbound = atom_sasa(coords, radii, targets, groups, n_points, probe)
+
+    results = []
+    for part, positions in ((site, slice(0, len(site_positions))), (ligand, slice(len(site_positions), None))):
+        part = part.copy()
+        part['sasa_unbound'] = unbound[positions]
+        part['sasa_bound'] = bound[positions]
+        part['sasa_buried'] = part['sasa_unbound'] - part['sasa_bound']
+        results.append(part)
+    return tuple(results)
+
+def residue_sasa(atoms):
+    """
+    Sums the SASA columns of `complex_sasa` per residue.
+    """
+    from binding_site import residue_columns
+    columns = residue_columns(atoms)
+    return atoms.groupby(columns, sort=False, as_index=False)[['sasa_unbound', 'sasa_bound', 'sasa_buried']].sum()
+
+def trim_buried(site, residues, min_sasa):
+    """
+    The binding site without the residues whose unbound SASA is below `min_sasa` Å², i.e.
+    residues of the protein core that are within the distance but never face the pocket.
+    """
+    from binding_site import residue_columns
+    exposed = residues.loc[residues['sasa_unbound'] >= min_sasa, residue_columns(site)]
+    return site.merge(exposed, on=residue_columns(site), how='inner')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='solvent accessible surface area of binding sites and ligands, bound and unbound')
+    parser.add_argument("source", help='.bsa archive or directory of _binding_site.pdb/_ligand.pdb pairs')
+    parser.add_argument("-o", "--output", required=True, help='per-residue SASA of every complex, one JSON line per complex')
+    parser.add_argument("-a", "--atoms", required=False, help='if included, the per-atom SASA (unbound, bound) is saved to this .npz file')
+    parser.add_argument("-n", "--n_points", type=int, default=N_POINTS, help=f'test points per atom; default is {N_POINTS}')
+    parser.add_argument("-p", "--probe", type=float, default=PROBE, help=f'probe radius; default is {PROBE}Å')
+    args = parser.parse_args()
+
+    from interactions import iter_complexes
+
+    start = time.perf_counter()
+    atoms = {}
+    n = 0
+    with open(args.output, 'w') as out:
+        for name, ligand_df, site_df in iter_complexes(args.source):
+            with metrics.file(name):
+                site, ligand = complex_sasa(ligand_df, site_df, n_points=args.n_points, probe=args.probe)
+            residues = residue_sasa(site)
+            record = {'name': name,
+                      'ligand': {column: round(float(ligand[column].sum()), 2) for column in ('sasa_unbound', 'sasa_bound', 'sasa_buried')},
+                      'buried_total': round(float(residues['sasa_buried'].sum() + ligand['sasa_buried'].sum()), 2),
+                      'residues': [{key: (round(value, 2) if isinstance(value, float) else value) for key, value in row.items()}
+                                   for row in residues.to_dict('records')]}
+            out.write(json.dumps(record, default=int) + '\n')
+            if args.atoms:
+                for part, df in (('binding_site', site), ('ligand', ligand)):
+                    atoms[f'{name}/{part}'] = df[['sasa_unbound', 'sasa_bound']].to_numpy(dtype=np.float32)
+            n += 1
+    if args.atoms:
+        np.savez_compressed(args.atoms, **atoms)
+    seconds = time.perf_counter() - start
+    print(f'** {n} complexes in {seconds:.1f} s ({60 * n / max(seconds, 1e-9):.0f} per minute)')
@@ -1,15 +1,11 @@
 from pdb_pandas import *
 from pathlib import Path
 import itertools
-import dgl
 
-elements_hash = {'H': 1, 'C': 2, 'O': 3, 'N': 4, 'P': 5, 'S': 6}
+from featurizer import ELEMENTS_HASH, element_codes
+from metrics import metrics, print_summary, read_records, summarize
 
-directory = Path("/home/faisal/tmp/bindingdb_cnn/rcsb_small_testset/combos")
-
-# Get all .pdb files in the current directory
-files_binding_site = [file for file in directory.glob("*binding_site.pdb") if not file.name.startswith("._")]
-files_ligand = [file for file in directory.glob("*ligand.pdb") if not file.name.startswith("._")]
+elements_hash = ELEMENTS_HASH
 
 def process_pdb_single(filepath, hashing=elements_hash):
     """
@@ -26,7 +22,7 @@ def process_pdb_single(filepath, hashing=elements_hash):
     pdb = process_pdb(filepath)
     
     # Map element charges
-    pdb['hashing'] = pdb['element_plus_charge'].apply(lambda x: hashing.get(x, 7))  # Default to 7 if not found
+    pdb['hashing'] = element_codes(pdb['element_plus_charge'], hashing)  # Default to 7 if not found
     
     return pdb
 
@@ -50,17 +46,7 @@ class ProcessedPDB:
         self.df = df
 
 
-# Add Bonds and Bond Order to dataframes
-alldf_binding_site = [
-    ProcessedPDB(obj.filepath, bonds_protein_df(obj))
-    for obj in process_pdb_multi(files_binding_site)
-]
-
-alldf_ligand = [
-    ProcessedPDB(obj.filepath, bonds_ligand_df(obj))
-    for obj in process_pdb_multi(files_ligand)
-]
-
+@metrics.timed('graph')
 def dgl_graph(obj_list):
     """
     Converts the data from dataframes to DGL Graphs.
@@ -77,23 +63,50 @@ def dgl_graph(obj_list):
                 - Nodes include 'hashing' (node feature) and 'coords' (coordinates of atoms).
                 - Edges include 'bond_order' (bond strength/order between atoms).
     """
+    import torch
+    import dgl
+
     graph_list = []
     for obj in obj_list:
         df = obj.df
-        all_bonds = list(itertools.chain(*df['bond']))
-        all_bonds_transposed = np.transpose(all_bonds)
+        # Columns are gathered once into contiguous arrays that torch wraps without a copy
+        bonds = np.fromiter(itertools.chain.from_iterable(itertools.chain(*df['bond'])), dtype=np.int64).reshape(-1, 2)
+        src, dst = (torch.from_numpy(np.ascontiguousarray(column)) for column in bonds.T)
 
-        g = dgl.graph((all_bonds_transposed[0], all_bonds_transposed[1]))
+        g = dgl.graph((src, dst))
 
-        hashing = torch.tensor(df['hashing'].to_numpy()).unsqueeze(1).float()
+        hashing = torch.from_numpy(df['hashing'].to_numpy(dtype=np.float32).reshape(-1, 1))
         if g.num_nodes() != len(hashing): # For ions
             g.add_nodes(len(hashing)-g.num_nodes())
         g.ndata['hashing'] = hashing
-        g.ndata['coords'] = torch.tensor(df[['orth_x', 'orth_y', 'orth_z']].to_numpy()).float()
-        g.edata['bond_order'] = torch.tensor(list(itertools.chain(*df['bond_order']))).float()
+        g.ndata['coords'] = torch.from_numpy(np.ascontiguousarray(df[['orth_x', 'orth_y', 'orth_z']].to_numpy(), dtype=np.float32))
+        g.edata['bond_order'] = torch.from_numpy(np.fromiter(itertools.chain(*df['bond_order']), dtype=np.float32))
         graph_list.append(g)
+        metrics.count('graph_edges', g.num_edges())
     return graph_list
-    
 
-allg_bs = dgl_graph(alldf_binding_site)
-allg_lig = dgl_graph(alldf_ligand)
+
+if __name__ == "__main__":
+    directory = Path("/home/faisal/tmp/bindingdb_cnn/rcsb_small_testset/combos")
+
+    # Get all .pdb files in the current directory
+    files_binding_site = [file for file in directory.glob("*binding_site.pdb") if not file.name.startswith("._")]
+    files_ligand = [file for file in directory.glob("*ligand.pdb") if not file.name.startswith("._")]
+
+    # Add Bonds and Bond Order to dataframes
+    alldf_binding_site = [
+        ProcessedPDB(obj.filepath, bonds_protein_df(obj))
+        for obj in process_pdb_multi(files_binding_site)
+    ]
+
+    alldf_ligand = [
+        ProcessedPDB(obj.filepath, bonds_ligand_df(obj))
+        for obj in process_pdb_multi(files_ligand)
+    ]
+
+    allg_bs = dgl_graph(alldf_binding_site)
+    allg_lig = dgl_graph(alldf_ligand)
+
+    if metrics.enabled:
+        metrics.flush()
+        print_summary(summarize(read_records(metrics.output)))
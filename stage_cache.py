@@ -0,0 +1,415 @@
+import numpy as np
+import argparse
+import ast
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import socket
+import textwrap
+import time
+import types
+from pathlib import Path
+
+from featurizer import ELEMENTS_HASH, element_codes
+from metrics import metrics
+
+# Bump to invalidate every artifact written by an older layout of the cache
+CACHE_VERSION = 1
+STAGES = ('parse', 'binding_site', 'bonds', 'graph', 'features', 'voxels', 'pocket')
+# Modules that do not change what a stage returns, so editing them keeps every artifact
+INSTRUMENTATION = ('metrics',)
+_ROOT = Path(__file__).resolve().parent
+
+def _hash_json(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()
+
+def _imported_names(tree):
+    # Top-level names of the modules imported anywhere in `tree`
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            yield from (alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            yield node.module.split('.')[0]
+
+def _module_source(name):
+    """
+    (content hash, imported module names) of the repository module `name`, or None when it
+    is not one (i.e. numpy). Remembered by the file's mtime, so each file is read once per run.
+    """
+    path = _ROOT / f'{name}.py'
+    try:
+        mtime = path.stat().st_mtime_ns
+    except OSError:
+        return None
+    known = _sources.get(name)
+    if known is None or known[0] != mtime:
+        source = path.read_bytes()
+        known = _sources[name] = (mtime, hashlib.sha256(source).hexdigest(), set(_imported_names(ast.parse(source))))
+    return known[1:]
+
+_sources = {}
+
+def code_digest(fn):
+    """
+    Returns a hash of the code `fn` runs, so that editing a stage rebuilds its artifacts.
+
+    That is the source of `fn` and of the functions and classes of its own module that it
+    uses, and the whole source of every repository module it uses (imported in the
+    function or used through a module-level import), with the modules those import in
+    turn. Editing i.e. `binding_site.complete_residues` or a table of featurizer.py then
+    rebuilds the stages that depend on it. INSTRUMENTATION modules are left out.
+    """
+    sha = hashlib.sha256()
+    modules, seen, pending = set(), set(), [fn]
+    while pending:
+        f = pending.pop()
+        if f in seen:
+            continue
+        seen.add(f)
+        try:
+            source = inspect.getsource(f)
+        except (OSError, TypeError):
+            sha.update(f'{f.__module__}.{f.__qualname__}'.encode())
+            continue
+        sha.update(source.encode())
+        tree = ast.parse(textwrap.dedent(source))
+        modules.update(_imported_names(tree))
+        scope = getattr(inspect.unwrap(f), '__globals__', {})
+        for node in ast.walk(tree):
+            value = scope.get(node.id) if isinstance(node, ast.Name) else None
+            if isinstance(value, types.ModuleType):
+                modules.add(value.__name__.split('.')[0])
+            elif (inspect.isfunction(value) or inspect.isclass(value)) and value is not f:
+                if value.__module__ == f.__module__:
+                    pending.append(value)
+                else:
+                    modules.add(value.__module__.split('.')[0])
+
+    # Repository modules, with the ones they import
+    closure, pending = set(), sorted(modules)
+    while pending:
+        name = pending.pop()
+        if name in closure or name in INSTRUMENTATION:
+            continue
+        module = _module_source(name)
+        if module is not None:
+            closure.add(name)
+            sha.update(f'{name}:{module[0]}'.encode())
+            pending.extend(sorted(module[1]))
+    return sha.hexdigest()[:16]
+
+class Artifact:
+    """
+    Output of a stage. `key` identifies the inputs the artifact was built from and
+    `digest` is the hash of its content; downstream stages are keyed on the digest, so
+    they are not rebuilt when an upstream rebuild gives the same output.
+    """
+    def __init__(self, stage, key, digest, path, value=None, hit=False):
+        self.stage = stage
+        self.key = key
+        self.digest = digest
+        self.path = path
+        self.hit = hit
+        self._value = value
+
+    @property
+    def value(self):
+        if self._value is None:
+            with open(self.path, 'rb') as f:
+                self._value = pickle.load(f)
+        return self._value
+
+    def __repr__(self):
+        return f'Artifact({self.stage!r}, {self.key[:12]}, hit={self.hit})'
+
+
+class StageCache:
+    """
+    Content addressed store of stage artifacts with their provenance.
+
+    Artifacts are stored as ROOT/STAGE/ab/KEY.pkl with a KEY.json next to them recording
+    the stage, the inputs and parameters, the code digest, the host and the build time.
+    A key is the hash of the stage name, its code digest, its parameters and the digests
+    of its inputs (files or upstream artifacts), so an artifact is rebuilt exactly when
+    one of those changes.
+
+    Args:
+        root (str): cache directory.
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.built = {stage: 0 for stage in STAGES}
+        self.reused = {stage: 0 for stage in STAGES}
+
+    def file_digest(self, path):
+        """
+        Returns the content hash of a file. Hashes are remembered by (size, mtime), so
+        unchanged files are not read again on the next run.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        memo = self.root / 'files' / f'{hashlib.sha1(path.encode()).hexdigest()}.json'
+        if memo.exists():
+            with open(memo) as f:
+                known = json.load(f)
+            if known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+                return known['digest']
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        memo.parent.mkdir(exist_ok=True)
+        self._write_atomic(memo, json.dumps({'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest}).encode())
+        return digest
+
+    def _paths(self, stage, key):
+        base = self.root / stage / key[:2] / key
+        return base.with_suffix('.pkl'), base.with_suffix('.json')
+
+    def _write_atomic(self, path, data):
+        # Concurrent builders of the same artifact write the same bytes, so the last rename wins safely
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _input_digest(self, item):
+        if isinstance(item, Artifact):
+            return {'stage': item.stage, 'digest': item.digest}
+        if isinstance(item, (str, Path)) and os.path.isfile(item):
+            return {'file': str(item), 'digest': self.file_digest(item)}
+        return {'value': item}
+
+    def provenance(self, stage, key):
+        """
+        Returns the provenance record of an artifact, or None if it is not in the cache.
+        """
+        meta_path = self._paths(stage, key)[1]
+        if not meta_path.exists():
+            return None
+        with open(meta_path) as f:
+            return json.load(f)
+
+    def run(self, stage, fn, inputs, params=None):
+        """
+        Returns the artifact of `fn(*inputs, **params)`, built only if it is not in the cache.
+
+        Args:
+            stage (str): stage name.
+            fn (function): builds the artifact; receives the values of artifact inputs,
+                and file paths and other inputs as they are.
+            inputs (list): upstream artifacts, file paths or JSON serializable values.
+            params (dict): JSON serializable keyword arguments of `fn`.
+
+        Returns:
+            Artifact
+        """
+        params = params or {}
+        input_digests = [self._input_digest(item) for item in inputs]
+        code = code_digest(fn)
+        key = _hash_json({'version': CACHE_VERSION, 'stage': stage, 'code': code,
+                          'inputs': [item['digest'] if 'digest' in item else item for item in input_digests],
+                          'params': params})
+        data_path, meta_path = self._paths(stage, key)
+
+        hit = meta_path.exists() and data_path.exists()
+        metrics.cache(f'stage_{stage}', hit)
+        if hit:
+            self.reused[stage] = self.reused.get(stage, 0) + 1
+            with open(meta_path) as f:
+                return Artifact(stage, key, json.load(f)['digest'], data_path, hit=True)
+
+        start = time.perf_counter()
+        args = [item.value if isinstance(item, Artifact) else item for item in inputs]
+        value = fn(*args, **params)
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.sha256(data).hexdigest()
+
+        data_path.parent.mkdir(parents=True, exist_ok=True)
+        self._write_atomic(data_path, data)
+        self._write_atomic(meta_path, json.dumps({
+            'stage': stage,
+            'key': key,
+            'digest': digest,
+            'code': code,
+            'function': f'{fn.__module__}.{fn.__qualname__}',
+            'inputs': input_digests,
+            'params': params,
+            'host': socket.gethostname(),
+            'created': time.time(),
+            'seconds': time.perf_counter() - start,
+        }, indent=1, default=str).encode())
+        self.built[stage] = self.built.get(stage, 0) + 1
+        return Artifact(stage, key, digest, data_path, value=value)
+
+
+# Stage functions; each only sees its inputs and parameters so it can be cached
+
+def parse_stage(pdb_file):
+    from process_pdb import process_pdb
+    return process_pdb(str(pdb_file))
+
+def binding_site_stage(pdb, hetatm, distance=3.5, center=False):
+    from binding_site import center as center_pdb, split_ligand_protein, binding_site_atoms, complete_residues
+    if center:
+        pdb = center_pdb(pdb)
+    ligand, protein, primary_chain = split_ligand_protein(pdb, hetatm)
+    bs_atoms = binding_site_atoms(ligand, protein, distance)
+    if bs_atoms.empty:
+        raise ValueError(f'no binding site residues within {distance} Å of {hetatm}')
+    return {'binding_site': complete_residues(protein, bs_atoms), 'ligand': ligand, 'primary_chain': primary_chain}
+
+def bonds_stage(site, name, workdir):
+    # bonds_protein_df reads HETATM lines back from the file and downloads SDFs next to it
+    from binding_site import write_pdb
+    from pdb_pandas import process_pdb, bonds_protein_df
+    from se3_prep import ProcessedPDB
+    os.makedirs(workdir, exist_ok=True)
+    site_file = os.path.join(workdir, f'{name}_binding_site.pdb')
+    write_pdb(site['binding_site'], site_file)
+    return bonds_protein_df(ProcessedPDB(site_file, process_pdb(site_file)))
+
+def graph_stage(df, elements_hash):
+    from se3_prep import ProcessedPDB, dgl_graph
+    df = df.copy()
+    df['hashing'] = element_codes(df['element_plus_charge'], elements_hash)
+    return dgl_graph([ProcessedPDB(None, df)])[0]
+
+def features_stage(site, elements_hash):
+    # Same (x, y, z, element) rows as process_pdb_file in TEMP_voxelizer+keras.py
+    features = {}
+    for part in ('binding_site', 'ligand'):
+        df = site[part]
+        codes = element_codes(df['element_plus_charge'], elements_hash).astype(float)
+        features[part] = np.column_stack([df[['orth_x', 'orth_y', 'orth_z']].to_numpy(dtype=float), codes])
+    return features
+
+def pocket_stage(site):
+    from pocket_index import pocket_tokens
+    return pocket_tokens(site['binding_site'])
+
+def voxels_stage(*features, voxel_size=1.0):
+    # The grid spans every complex, so this stage depends on all of them
+    from voxelizer import Voxelizer
+    datasets = [f[part] for f in features for part in ('binding_site', 'ligand')]
+    voxelizer = Voxelizer(datasets, voxel_size=voxel_size)
+    return {
+        'global_min': voxelizer.global_min,
+        'global_max': voxelizer.global_max,
+        'shape': (voxelizer.x_dim, voxelizer.y_dim, voxelizer.z_dim),
+        'voxel_size': voxel_size,
+        'indices': [np.asarray(voxelizer.indexer(data), dtype=np.int32) for data in datasets],
+        'values': [np.asarray(voxelizer.valuer(data), dtype=np.float32) for data in datasets],
+    }
+
+
+def build_complex(cache, pdb_file, hetatm, workdir, distance=3.5, center=False, elements_hash=None, stages=STAGES):
+    """
+    Runs the cached chain parse → binding site → bonds → graph (and features, pocket) for one ligand.
+
+    Args:
+        cache (StageCache): artifact store.
+        pdb_file (str): structure file.
+        hetatm (str): ligand HET id.
+        workdir (str): directory for the files the bonds stage needs (binding site .pdb, SDFs).
+        distance (float): binding site distance in Å.
+        center (bool): if True, the structure is centered to (0, 0, 0).
+        elements_hash (dict): element codes of the graph and voxel stages.
+        stages (tuple): stages to run; bonds and graph need rdkit, torch and dgl.
+
+    Returns:
+        dict: {stage: Artifact}
+    """
+    elements_hash = ELEMENTS_HASH if elements_hash is None else elements_hash
+    name = f'{Path(pdb_file).stem}_{hetatm}'
+    artifacts = {}
+    with metrics.file(pdb_file, hetatm=hetatm):
+        artifacts['parse'] = cache.run('parse', parse_stage, [pdb_file])
+        artifacts['binding_site'] = cache.run('binding_site', binding_site_stage, [artifacts['parse']],
+                                              {'hetatm': hetatm, 'distance': distance, 'center': center})
+        if 'features' in stages:
+            artifacts['features'] = cache.run('features', features_stage, [artifacts['binding_site']], {'elements_hash': elements_hash})
+        if 'pocket' in stages:
+            artifacts['pocket'] = cache.run('pocket', pocket_stage, [artifacts['binding_site']])
+        if 'bonds' in stages:
+            artifacts['bonds'] = cache.run('bonds', bonds_stage, [artifacts['binding_site'], name, workdir])
+            if 'graph' in stages:
+                artifacts['graph'] = cache.run('graph', graph_stage, [artifacts['bonds']], {'elements_hash': elements_hash})
+    return artifacts
+
+def build_voxels(cache, feature_artifacts, voxel_size=1.0):
+    """
+    Voxelizes a set of complexes on one shared grid; rebuilt only when a complex or `voxel_size` changes.
+    """
+    return cache.run('voxels', voxels_stage, list(feature_artifacts), {'voxel_size': voxel_size})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='incremental, cached preprocessing: parse → binding site → bonds → graph → voxels')
+    parser.add_argument("-j", "--jobs", required=False, help='job manifest from job_planner.py')
+    parser.add_argument("-i", "--inputpdb", required=False, help='input PDB file in .pdb format (with -ht)')
+    parser.add_argument("-ht", "--hetatm", required=False, help='ligand HET id in PDB')
+    parser.add_argument("-C", "--cache", required=True, help='cache directory')
+    parser.add_argument("-w", "--workdir", required=False, help='directory for binding site files and SDFs; default is CACHE/work')
+    parser.add_argument("-d", "--distance", type=float, default=3.5, help='binding site distance; default is 3.5Å')
+    parser.add_argument("-c", "--center", action='store_true', help='if included, structures will be centered to (0,0,0)')
+    parser.add_argument("-v", "--voxel_size", type=float, default=None, help='if included, every complex is voxelized on a shared grid of this voxel size')
+    parser.add_argument("-s", "--stages", nargs='+', default=['parse', 'binding_site', 'features'], choices=STAGES, help='stages to run; default is parse binding_site features')
+    parser.add_argument("--dedup", type=float, default=None, metavar='THRESHOLD', help='if included, the pockets are clustered into near duplicates at this Jaccard similarity (see pocket_index.py); adds the pocket stage')
+    parser.add_argument("--clusters", required=False, help='cluster of every pocket with --dedup, one JSON line per pocket; default is CACHE/clusters.jsonl')
+    parser.add_argument("-m", "--metrics", required=False, help='if included, per-stage timings and cache hits are appended to this .jsonl file')
+    args = parser.parse_args()
+    if args.dedup is not None and 'pocket' not in args.stages:
+        args.stages.append('pocket')
+
+    if args.metrics:
+        metrics.enable(args.metrics)
+
+    if args.jobs:
+        from job_planner import read_manifest
+        pairs = [(job['pdb_file'], het_id) for job in read_manifest(args.jobs) if job.get('pdb_file') for het_id in job['ligands']]
+    elif args.inputpdb and args.hetatm:
+        pairs = [(args.inputpdb, args.hetatm)]
+    else:
+        parser.error('either --jobs or --inputpdb and --hetatm is required')
+
+    start = time.perf_counter()
+    cache = StageCache(args.cache)
+    workdir = args.workdir or os.path.join(args.cache, 'work')
+    features = []
+    pockets = []
+    failed = 0
+    for pdb_file, hetatm in pairs:
+        try:
+            artifacts = build_complex(cache, pdb_file, hetatm, workdir, args.distance, args.center, stages=args.stages)
+        except Exception as e:
+            print(f'** {pdb_file} {hetatm}: {type(e).__name__}: {e}')
+            failed += 1
+            continue
+        if 'features' in artifacts:
+            features.append(artifacts['features'])
+        if 'pocket' in artifacts:
+            pockets.append((f'{Path(pdb_file).stem}_{hetatm}', artifacts['pocket']))
+
+    if args.voxel_size and features:
+        voxels = build_voxels(cache, features, args.voxel_size)
+        print('** voxel grid', voxels.value['shape'], 'reused' if voxels.hit else 'built')
+
+    if args.dedup is not None and pockets:
+        from pocket_index import cluster_pockets
+        clusters = cluster_pockets(((name, artifact.value) for name, artifact in pockets), args.dedup)
+        clusters_file = args.clusters or os.path.join(args.cache, 'clusters.jsonl')
+        with open(clusters_file, 'w') as out:
+            for record in clusters:
+                out.write(json.dumps(record) + '\n')
+        print(f"** {len(clusters)} pockets in {len({record['cluster'] for record in clusters})} clusters at Jaccard >= {args.dedup:g}, written to {clusters_file}")
+
+    for stage in STAGES:
+        if cache.built[stage] or cache.reused[stage]:
+            print(f'** {stage:<14} built: {cache.built[stage]:>6}  reused: {cache.reused[stage]:>6}')
+    print(f'** {len(pairs)} complexes, {failed} failed in {time.perf_counter() - start:.1f} s')
@@ -0,0 +1,444 @@
+import numpy as np
+import pandas as pd
+import threading
+
+from metrics import metrics
+
+# Columns of `process_pdb` and the fixed-width .pdb columns they are read from
+STRING_FIELDS = ('record_name', 'atom_name', 'residue', 'chain', 'icode', 'occupancy', 'temp_factor', 'element_plus_charge')
+COLUMNS = {
+    'record_name': (0, 6),
+    'serial_number': (6, 11),
+    'atom_name': (11, 16),
+    'residue': (16, 20),
+    'chain': (20, 22),
+    'res_seq': (22, 26),
+    'icode': (26, 27),
+    'orth_x': (30, 38),
+    'orth_y': (38, 46),
+    'orth_z': (46, 54),
+    'occupancy': (54, 60),
+    'temp_factor': (60, 66),
+    # Element in 76:78 and formal charge (i.e. 1+) in 78:80
+    'element_plus_charge': (66, 80),
+}
+LINE_WIDTH = 80
+
+
+def element_field(element_plus_charge):
+    """
+    Columns 66:80 of an atom line for an 'element_plus_charge' value: the element
+    right-justified to column 78 and its charge (i.e. N1+) in 78:80.
+    """
+    value = element_plus_charge
+    if value.endswith(('+', '-')):
+        digit = value[-2:-1].isdigit()
+        return f"{value[:-2] if digit else value[:-1]:>12}{value[-2] if digit else '1'}{value[-1]}"
+    return f'{value:>12}'
+
+
+class StringPool:
+    """
+    Interns strings as int32 codes. A single pool is shared by every structure of a
+    process, so an atom name such as 'CA' is stored once however many files are read.
+    """
+    def __init__(self):
+        self.codes = {}
+        self.strings = []
+        self.lock = threading.Lock()
+        self._table = np.zeros(0, dtype=object)
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, code):
+        return self.strings[code]
+
+    def code(self, string):
+        code = self.codes.get(string)
+        if code is None:
+            with self.lock:
+                code = self.codes.setdefault(string, len(self.strings))
+                if code == len(self.strings):
+                    self.strings.append(string)
+        return code
+
+    def encode(self, values):
+        """
+        Returns the codes of an array of strings (or bytes); only the distinct values are looked up.
+        """
+        values = np.asarray(values)
+        uniques, inverse = np.unique(values, return_inverse=True)
+        if uniques.dtype.kind == 'S':
+            uniques = [value.decode('ascii', 'replace') for value in uniques]
+        table = np.array([self.code(str(value)) for value in uniques], dtype=np.int32)
+        return table[inverse.reshape(-1)] if len(table) else np.zeros(0, dtype=np.int32)
+
+    def decode(self, codes):
+        """
+        Returns an object array of the strings of `codes`.
+        """
+        if len(self._table) != len(self.strings):
+            self._table = np.array(self.strings, dtype=object)
+        return self._table[codes] if len(codes) else np.zeros(0, dtype=object)
+
+    def matches(self, codes, predicate):
+        """
+        Applies a string predicate (i.e. `str.startswith`) to codes, evaluating it once per distinct code.
+        """
+        uniques, inverse = np.unique(codes, return_inverse=True)
+        table = np.array([bool(predicate(self.strings[code])) for code in uniques], dtype=bool)
+        return table[inverse.reshape(-1)] if len(table) else np.zeros(0, dtype=bool)
+
+
+POOL = StringPool()
+
+
+class Structure:
+    """
+    Compact atom table of a structure.
+
+    String columns are int32 codes into the shared `POOL`, serials and residue numbers
+    are int32 and coordinates float32, which is about 52 bytes per atom instead of the
+    several hundred of a `process_pdb` dataframe. Occupancy and temperature factor are
+    interned as written in the file so that `write_pdb` gives back the same text.
+
+    Subsets (ligand, protein, binding site) are `AtomView`s: an index array into the
+    structure, never a copy of its columns.
+
+    Args:
+        columns (dict): {column name: numpy.ndarray} with the fields of `COLUMNS`
+            ('orth_x/y/z' as a single (n, 3) 'coords' array).
+        pool (StringPool): pool the string codes refer to.
+    """
+    def __init__(self, columns, pool=POOL, offset=None):
+        self.pool = pool
+        self.columns = columns
+        self.coords = columns['coords']
+        # Subtracted from the coordinates as read (see `center`), kept in float64
+        self.offset = np.zeros(3) if offset is None else np.asarray(offset, dtype=np.float64)
+        self._tree = None
+        self._hierarchy = None
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.columns.values())
+
+    def all(self):
+        return AtomView(self, np.arange(len(self), dtype=np.int32))
+
+    def coords64(self):
+        """
+        Coordinates as float64, rounded to the 3 decimals of the .pdb so they are the same
+        values `process_pdb` reads (and distances give the same cutoffs), minus `offset`.
+        """
+        return np.round(self.coords.astype(np.float64), 3) - self.offset
+
+    @property
+    def tree(self):
+        """
+        k-d tree over every atom, built on first use and reused for every ligand.
+        """
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+            self._tree = cKDTree(self.coords64())
+        return self._tree
+
+    @property
+    def hierarchy(self):
+        """
+        `Hierarchy` of the chains and residues, built on first use like `tree`.
+        """
+        if self._hierarchy is None:
+            self._hierarchy = Hierarchy({name: self.columns[name] for name in ('chain', 'res_seq', 'icode', 'residue')})
+        return self._hierarchy
+
+    def find_residue(self, chain, res_seq, icode=''):
+        """
+        Residues (positions in `hierarchy`) with this chain, residue number and insertion code;
+        more than one when alternate locations give the same residue two names (i.e. AARG and BARG).
+        """
+        chain, icode = self.pool.codes.get(chain), self.pool.codes.get(icode)
+        if chain is None or icode is None:
+            return ()
+        return self.hierarchy.find(chain, res_seq, icode)
+
+    @classmethod
+    def from_dataframe(cls, df, pool=POOL):
+        """
+        Builds a structure from a `process_pdb` dataframe.
+        """
+        # Dataframes of `process_pdb` have no insertion codes
+        columns = {name: pool.encode(df[name].astype(str).to_numpy() if name in df else np.full(len(df), '')) for name in STRING_FIELDS}
+        columns['serial_number'] = df['serial_number'].to_numpy(dtype=np.int32)
+        columns['res_seq'] = df['res_seq'].to_numpy(dtype=np.int32)
+        columns['coords'] = df[['orth_x', 'orth_y', 'orth_z']].to_numpy(dtype=np.float32)
+        return cls(columns, pool)
+
+
+class Hierarchy:
+    """
+    Chain → residue → atom offsets of an atom table.
+
+    Residues are the atoms with the same key (i.e. chain, residue number, insertion code
+    and residue name), numbered in order of first appearance. The atoms of residue r are
+    `order[residue_starts[r]:residue_starts[r + 1]]`, where `order` sorts the atoms by
+    residue and is None when every residue is already one contiguous run (as in almost
+    every .pdb file), and the residues of the c-th run of a chain are
+    `chain_starts[c]:chain_starts[c + 1]`.
+    Expanding atoms into whole residues, finding a residue by its id and per-residue
+    reductions are then slices of these arrays instead of scans or merges of the table.
+
+    Args:
+        keys (dict): {column name: numpy.ndarray with a value per atom} of the columns that
+            identify a residue; `find` looks up 'chain', 'res_seq' and 'icode' (if present).
+    """
+    def __init__(self, keys):
+        combined = np.zeros(len(next(iter(keys.values()))), dtype=np.int64)
+        for values in keys.values():
+            uniques, inverse = np.unique(values, return_inverse=True)
+            _, combined = np.unique(combined * len(uniques) + inverse.reshape(-1), return_inverse=True)
+            combined = combined.reshape(-1)
+        _, first, inverse = np.unique(combined, return_index=True, return_inverse=True)
+        # Residues are numbered in order of first appearance
+        rank = np.empty(len(first), dtype=np.int64)
+        rank[np.argsort(first, kind='stable')] = np.arange(len(first))
+        self.atom_residue = rank[inverse.reshape(-1)]
+        self.first_atoms = np.sort(first)
+        self.order = None if (np.diff(self.atom_residue) >= 0).all() else np.argsort(self.atom_residue, kind='stable')
+        self.residue_starts = np.r_[0, np.cumsum(np.bincount(self.atom_residue, minlength=len(first)))]
+        self.residues = {name: np.asarray(values)[self.first_atoms] for name, values in keys.items()}
+        if 'chain' in self.residues:
+            chains = self.residues['chain']
+            self.chain_starts = np.r_[0, np.flatnonzero(chains[1:] != chains[:-1]) + 1, len(chains)] if len(chains) else np.zeros(1, dtype=np.int64)
+        self._lookup = None
+
+    @classmethod
+    def from_dataframe(cls, df, columns):
+        """
+        Builds the hierarchy of a pdb dataframe from its `columns` (i.e. `binding_site.residue_columns`);
+        atoms are the row positions of `df`.
+        """
+        return cls({name: df[name].to_numpy() for name in columns})
+
+    def __len__(self):
+        return len(self.first_atoms)
+
+    def find(self, chain, res_seq, icode=''):
+        """
+        Residues with this chain, residue number and insertion code, as a tuple of residue
+        positions (empty when there is none).
+        """
+        if self._lookup is None:
+            icodes = self.residues['icode'].tolist() if 'icode' in self.residues else [''] * len(self)
+            self._lookup = {}
+            for residue, key in enumerate(zip(self.residues['chain'].tolist(), self.residues['res_seq'].tolist(), icodes)):
+                self._lookup[key] = self._lookup.get(key, ()) + (residue,)
+        return self._lookup.get((chain, res_seq, icode), ())
+
+    def atoms(self, residues):
+        """
+        Atom positions of `residues`, in atom order when the residues are sorted.
+        """
+        residues = np.asarray(residues, dtype=np.int64)
+        starts = self.residue_starts[residues]
+        lengths = self.residue_starts[residues + 1] - starts
+        positions = np.repeat(starts - np.r_[0, np.cumsum(lengths)[:-1]], lengths) + np.arange(lengths.sum())
+        return positions if self.order is None else np.sort(self.order[positions])
+
+    def expand(self, positions):
+        """
+        Atom positions of the complete residues of the atoms at `positions`.
+        """
+        return self.atoms(np.unique(self.atom_residue[np.asarray(positions, dtype=np.int64)]))
+
+    def reduce(self, values, ufunc=np.add):
+        """
+        Reduces a value per atom to a value per residue with `ufunc` (i.e. np.minimum).
+        """
+        values = np.asarray(values)
+        if self.order is not None:
+            values = values[self.order]
+        return ufunc.reduceat(values, self.residue_starts[:-1], axis=0) if len(self) else values[:0]
+
+
+def center(structure):
+    """
+    Returns the structure centered to (0, 0, 0), sharing the columns of `structure`.
+    """
+    return Structure(structure.columns, structure.pool, structure.offset + structure.coords64().mean(axis=0))
+
+@metrics.timed('parse')
+def read_pdb(pdb_file, pool=POOL):
+    """
+    Reads the ATOM/HETATM records of a .pdb file into a `Structure`.
+
+    Fields are sliced from the same columns as `process_pdb`, and waters (HOH) and
+    glucose (GLC) are removed the same way, but the lines are cut as one fixed-width
+    byte array instead of one Python string per field.
+
+    Args:
+        pdb_file (str): path to the .pdb file.
+        pool (StringPool): pool for the string columns.
+
+    Returns:
+        Structure
+    """
+    with open(pdb_file, 'rb') as f:
+        lines = [line.rstrip(b'\r\n') for line in f if line.startswith((b'ATOM', b'HETATM'))]
+    n = len(lines)
+    raw = np.frombuffer(b''.join(line[:LINE_WIDTH].ljust(LINE_WIDTH) for line in lines), dtype='S1').reshape(n, LINE_WIDTH)
+
+    def field(name):
+        start, stop = COLUMNS[name]
+        return np.char.strip(np.ascontiguousarray(raw[:, start:stop]).view(f'S{stop - start}').reshape(n))
+
+    columns = {name: pool.encode(field(name)) for name in STRING_FIELDS}
+    columns['serial_number'] = field('serial_number').astype(np.int32)
+    columns['res_seq'] = field('res_seq').astype(np.int32)
+    columns['coords'] = np.stack([field(axis).astype(np.float64) for axis in ('orth_x', 'orth_y', 'orth_z')], axis=1).astype(np.float32)
+
+    keep = ~pool.matches(columns['residue'], lambda residue: residue.startswith(('HOH', 'GLC')))
+    if not keep.all():
+        columns = {name: array[keep] for name, array in columns.items()}
+    structure = Structure(columns, pool)
+    metrics.count('atoms_parsed', len(structure))
+    return structure
+
+
+class AtomView:
+    """
+    A subset of the atoms of a `Structure`, in structure order.
+
+    Args:
+        structure (Structure): the structure.
+        idx (numpy.ndarray): int32 positions of the atoms in the structure.
+    """
+    def __init__(self, structure, idx):
+        self.structure = structure
+        self.idx = np.asarray(idx, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.idx)
+
+    @property
+    def empty(self):
+        return len(self.idx) == 0
+
+    def __getitem__(self, name):
+        return self.structure.columns[name][self.idx]
+
+    def strings(self, name):
+        return self.structure.pool.decode(self[name])
+
+    def coords(self):
+        return self.structure.coords[self.idx]
+
+    def coords64(self):
+        return np.round(self.coords().astype(np.float64), 3) - self.structure.offset
+
+    def subset(self, mask):
+        """
+        Returns the atoms of this view where `mask` is True.
+        """
+        return AtomView(self.structure, self.idx[mask])
+
+    def to_dataframe(self):
+        """
+        Returns the atoms as a dataframe with the same columns and values as `process_pdb`.
+        """
+        df = pd.DataFrame({
+            'record_name': self.strings('record_name'),
+            'serial_number': self['serial_number'].astype(int),
+            'atom_name': self.strings('atom_name'),
+            'residue': self.strings('residue'),
+            'chain': self.strings('chain'),
+            'res_seq': self['res_seq'].astype(int),
+        }, index=self.idx)
+        coords = self.coords64()
+        df['orth_x'], df['orth_y'], df['orth_z'] = coords[:, 0], coords[:, 1], coords[:, 2]
+        for name in ('occupancy', 'temp_factor', 'element_plus_charge'):
+            df[name] = self.strings(name)
+        return df
+
+
+def _first_appearance(values):
+    uniques, first = np.unique(values, return_index=True)
+    return uniques[np.argsort(first)]
+
+@metrics.timed('split')
+def split_ligand_protein(structure, hetatm):
+    """
+    `binding_site.split_ligand_protein` for a `Structure`: same atoms, returned as views.
+
+    Returns:
+        tuple: (ligand AtomView, protein AtomView, primary_chain)
+    """
+    pool = structure.pool
+    residues = structure['residue']
+    is_ligand = pool.matches(residues, lambda residue: residue.startswith(hetatm))
+    if not is_ligand.any():
+        # Alternate locations are read into the residue column i.e. AXYZ or BXYZ
+        is_ligand = pool.matches(residues, lambda residue: residue.startswith(('A'+hetatm, 'B'+hetatm)))
+    if not is_ligand.any():
+        raise ValueError(f"ligand {hetatm} was not found")
+
+    everything = structure.all()
+    ligand_raw = everything.subset(is_ligand)
+    protein_raw = everything.subset(~is_ligand)
+
+    chains = _first_appearance(ligand_raw['chain'])
+    drop_chains = chains[1:]
+    protein = protein_raw.subset(~np.isin(protein_raw['chain'], drop_chains))
+    ligand = ligand_raw.subset(~np.isin(ligand_raw['chain'], drop_chains))
+
+    first_res_seq = _first_appearance(ligand['res_seq'])[0]
+    ligand = ligand.subset(ligand['res_seq'] == first_res_seq)
+
+    # To handle multiple conformations of a protein that are overlapping
+    ligand = _drop_duplicates(ligand)
+    protein = _drop_duplicates(protein)
+    return ligand, protein, pool[chains[0]]
+
+def _drop_duplicates(view):
+    keys = np.stack([view['atom_name'], view['residue'], view['chain'], view['res_seq']], axis=1)
+    _, first = np.unique(keys, axis=0, return_index=True)
+    return AtomView(view.structure, view.idx[np.sort(first)])
+
+@metrics.timed('neighbor_search')
+def binding_site(ligand, protein, distance=3.5):
+    """
+    Complete residues of `protein` with an atom within `distance` of the ligand (the
+    output of `binding_site_atoms` + `complete_residues` in binding_site.py), as a view.
+    Residues come from the `Hierarchy`, so insertion codes (i.e. 52 and 52A) are separate
+    residues here, where `process_pdb`, which does not read them, has one.
+    """
+    structure = protein.structure
+    hits = structure.tree.query_ball_point(ligand.coords64(), r=distance)
+    positions = np.unique(np.concatenate([np.asarray(hit, dtype=np.int32) for hit in hits])) if len(hits) else np.zeros(0, dtype=np.int32)
+    bs_atoms = positions[np.isin(positions, protein.idx)]
+    # Whole residues from the hierarchy: a residue mask, looked up by every protein atom
+    hierarchy = structure.hierarchy
+    selected = np.zeros(len(hierarchy), dtype=bool)
+    selected[hierarchy.atom_residue[bs_atoms]] = True
+    return protein.subset(selected[hierarchy.atom_residue[protein.idx]])
+
+@metrics.timed('write')
+def write_pdb(view, output_file):
+    """
+    Writes the atoms of a view to a .pdb file in the same layout as `binding_site.write_pdb`.
+    """
+    record_name, atom_name, residue, chain = (view.strings(name) for name in ('record_name', 'atom_name', 'residue', 'chain'))
+    occupancy, temp_factor, element = (view.strings(name) for name in ('occupancy', 'temp_factor', 'element_plus_charge'))
+    serial, res_seq = view['serial_number'], view['res_seq']
+    coords = view.coords64()
+    with open(output_file, 'w') as f:
+        for i in range(len(view)):
+            x, y, z = ('{:.3f}'.format(value) for value in coords[i])
+            f.write(f'{record_name[i]:<6}{serial[i]:>5}{atom_name[i]:>5}{residue[i]:>4}{chain[i]:>2}{res_seq[i]:>4}{x:>12}{y:>8}{z:>8}{occupancy[i]:>6}{temp_factor[i]:>6}{element_field(element[i])}'+'\n')
@@ -0,0 +1,269 @@
+import numpy as np
+import pandas as pd
+import argparse
+import re
+from fractions import Fraction
+
+from metrics import metrics
+
+# Operators of common protein space groups, used when a file has no REMARK 290 records and
+# gemmi is not installed; {Hermann-Mauguin symbol of CRYST1: (operators, centering translations)}
+_PRIMITIVE = ('0,0,0',)
+_C = ('0,0,0', '1/2,1/2,0')
+_I = ('0,0,0', '1/2,1/2,1/2')
+_P222 = 'x,y,z; -x,-y,z; -x,y,-z; x,-y,-z'
+_P212121 = 'x,y,z; -x+1/2,-y,z+1/2; -x,y+1/2,-z+1/2; x+1/2,-y+1/2,-z'
+SPACE_GROUPS = {
+    'P 1': ('x,y,z', _PRIMITIVE),
+    'P 1 2 1': ('x,y,z; -x,y,-z', _PRIMITIVE),
+    'P 1 21 1': ('x,y,z; -x,y+1/2,-z', _PRIMITIVE),
+    'C 1 2 1': ('x,y,z; -x,y,-z', _C),
+    'P 2 2 2': (_P222, _PRIMITIVE),
+    'P 2 2 21': ('x,y,z; -x,-y,z+1/2; -x,y,-z+1/2; x,-y,-z', _PRIMITIVE),
+    'P 21 21 2': ('x,y,z; -x,-y,z; -x+1/2,y+1/2,-z; x+1/2,-y+1/2,-z', _PRIMITIVE),
+    'P 21 21 21': (_P212121, _PRIMITIVE),
+    'C 2 2 2': (_P222, _C),
+    'C 2 2 21': ('x,y,z; -x,-y,z+1/2; -x,y,-z+1/2; x,-y,-z', _C),
+    'I 2 2 2': (_P222, _I),
+    'P 41 21 2': ('x,y,z; -x,-y,z+1/2; -y+1/2,x+1/2,z+1/4; y+1/2,-x+1/2,z+3/4; '
+                  '-x+1/2,y+1/2,-z+1/4; x+1/2,-y+1/2,-z+3/4; y,x,-z; -y,-x,-z+1/2', _PRIMITIVE),
+    'P 43 21 2': ('x,y,z; -x,-y,z+1/2; -y+1/2,x+1/2,z+3/4; y+1/2,-x+1/2,z+1/4; '
+                  '-x+1/2,y+1/2,-z+3/4; x+1/2,-y+1/2,-z+1/4; y,x,-z; -y,-x,-z+1/2', _PRIMITIVE),
+    'P 31 2 1': ('x,y,z; -y,x-y,z+1/3; -x+y,-x,z+2/3; y,x,-z; x-y,-y,-z+2/3; -x,-x+y,-z+1/3', _PRIMITIVE),
+    'P 32 2 1': ('x,y,z; -y,x-y,z+2/3; -x+y,-x,z+1/3; y,x,-z; x-y,-y,-z+1/3; -x,-x+y,-z+2/3', _PRIMITIVE),
+}
+# Short symbols that CRYST1 records also use
+SPACE_GROUPS['P 21'] = SPACE_GROUPS['P 1 21 1']
+SPACE_GROUPS['P 2'] = SPACE_GROUPS['P 1 2 1']
+SPACE_GROUPS['C 2'] = SPACE_GROUPS['C 1 2 1']
+
+
+def parse_operator(text):
+    """
+    Parses a symmetry operator in coordinate-triplet form, i.e. '-x+1/2,y,z+1/4'.
+
+    Returns:
+        tuple: (3x3 rotation, translation), both acting on fractional coordinates.
+    """
+    rotation = np.zeros((3, 3))
+    translation = np.zeros(3)
+    rows = [row.strip().replace(' ', '').lower() for row in text.split(',')]
+    if len(rows) != 3:
+        raise ValueError(f'symmetry operator {text!r} does not have three coordinates')
+    for i, row in enumerate(rows):
+        for sign, term in re.findall(r'([+-]?)([^+-]+)', row):
+            value = -1.0 if sign == '-' else 1.0
+            if term in 'xyz':
+                rotation[i, 'xyz'.index(term)] = value
+            else:
+                translation[i] = value * float(Fraction(term))
+    return rotation, translation
+
+def cell_matrix(a, b, c, alpha, beta, gamma):
+    """
+    The orthogonalization matrix of a unit cell in the PDB convention (a along x, b in the xy plane).
+
+    Returns:
+        numpy.ndarray: 3x3 matrix M with cartesian = M @ fractional.
+    """
+    alpha, beta, gamma = np.radians([alpha, beta, gamma])
+    cos_a, cos_b, cos_g, sin_g = np.cos(alpha), np.cos(beta), np.cos(gamma), np.sin(gamma)
+    volume = np.sqrt(1 - cos_a**2 - cos_b**2 - cos_g**2 + 2 * cos_a * cos_b * cos_g)
+    return np.array([
+        [a, b * cos_g, c * cos_b],
+        [0, b * sin_g, c * (cos_a - cos_b * cos_g) / sin_g],
+        [0, 0, c * volume / sin_g],
+    ])
+
+
+class Crystal:
+    """
+    The unit cell and symmetry operators of a crystal structure.
+
+    Args:
+        cell (tuple): a, b, c (Å), alpha, beta, gamma (degrees) of the CRYST1 record.
+        space_group (str): Hermann-Mauguin symbol of the CRYST1 record.
+        operators (list): (rotation, translation) pairs on fractional coordinates, the
+            identity first; every centering translation is its own operator.
+    """
+    def __init__(self, cell, space_group, operators):
+        self.cell = tuple(cell)
+        self.space_group = space_group
+        self.operators = operators
+        self.orthogonal = cell_matrix(*cell)
+        self.fractional = np.linalg.inv(self.orthogonal)
+
+    def __repr__(self):
+        return f'Crystal({self.space_group!r}, cell={self.cell}, {len(self.operators)} operators)'
+
+    def to_fractional(self, coords):
+        return coords @ self.fractional.T
+
+    def to_cartesian(self, fractional):
+        return fractional @ self.orthogonal.T
+
+
+def space_group_operators(space_group):
+    """
+    The fractional operators of a space group, from gemmi when installed and `SPACE_GROUPS` otherwise.
+
+    Raises:
+        KeyError: the space group is not known.
+    """
+    try:
+        import gemmi
+        group = gemmi.find_spacegroup_by_name(space_group)
+        if group is not None:
+            return [parse_operator(op.triplet()) for op in group.operations()]
+    except ImportError:
+        pass
+    symbol = ' '.join(space_group.split())
+    if symbol not in SPACE_GROUPS:
+        raise KeyError(f'space group {space_group!r} is not in symmetry.SPACE_GROUPS; install gemmi or keep the REMARK 290 records')
+    operators, centering = SPACE_GROUPS[symbol]
+    operators = [parse_operator(op) for op in operators.split(';')]
+    shifts = [np.array([float(Fraction(value)) for value in shift.split(',')]) for shift in centering]
+    return [(rotation, translation + shift) for shift in shifts for rotation, translation in operators]
+
+def read_crystal(pdbfile):
+    """
+    Reads the CRYST1 record and the symmetry operators of a .pdb file.
+
+    The operators are the REMARK 290 SMTRY records when the file has them (they are written
+    on cartesian coordinates and converted here), else those of the CRYST1 space group.
+
+    Returns:
+        Crystal: or None when the file has no usable CRYST1 record (i.e. NMR or predicted
+        structures, whose CRYST1 is a 1 Å cell).
+    """
+    cryst1 = None
+    smtry = {}
+    with open(pdbfile) as f:
+        for line in f:
+            if line.startswith('CRYST1'):
+                cryst1 = line
+            elif line.startswith('REMARK 290   SMTRY'):
+                fields = line.split()
+                row, number = int(fields[2][-1]) - 1, int(fields[3])
+                smtry.setdefault(number, [None] * 3)[row] = [float(value) for value in fields[4:8]]
+            elif line.startswith(('ATOM', 'HETATM')):
+                break
+    if cryst1 is None:
+        return None
+    cell = tuple(float(cryst1[start:stop]) for start, stop in ((6, 15), (15, 24), (24, 33), (33, 40), (40, 47), (47, 54)))
+    space_group = cryst1[55:66].strip()
+    if min(cell[:3]) <= 1.0:
+        return None
+
+    crystal = Crystal(cell, space_group, [])
+    if smtry and all(None not in rows for rows in smtry.values()):
+        operators = []
+        for number in sorted(smtry):
+            matrix = np.array(smtry[number])
+            rotation = crystal.fractional @ matrix[:, :3] @ crystal.orthogonal
+            translation = crystal.fractional @ matrix[:, 3]
+            operators.append((np.round(rotation), translation))
+    else:
+        operators = space_group_operators(space_group)
+    crystal.operators = operators
+    return crystal
+
+@metrics.timed('symmetry_mates')
+def symmetry_mates(crystal, protein, ligand, cutoff):
+    """
+    The residues of the symmetry mates that come within reach of the ligand.
+
+    Only atoms that some operator (with a lattice translation) moves into the bounding box
+    of the ligand expanded by `cutoff` are considered: for each operator the protein is
+    moved once in fractional coordinates, and the lattice translations that bring an atom
+    into the box follow from its coordinates, so no unit cells are built. The residues of
+    those atoms are then generated whole, so the binding site can use complete residues.
+
+    Args:
+        crystal (Crystal): from `read_crystal`.
+        protein (pandas.DataFrame): protein atoms of the asymmetric unit.
+        ligand (pandas.DataFrame): ligand atoms.
+        cutoff (float): largest binding site distance in Å.
+
+    Returns:
+        pandas.DataFrame: the mate atoms with the columns of `protein`, new serial numbers
+        after the largest one of `protein` and a 'symmetry' column with the operator in the
+        PDB 'n_klm' notation (operator number and lattice translation + 5, i.e. '2_556').
+    """
+    coords = protein[['orth_x', 'orth_y', 'orth_z']].to_numpy(dtype=float)
+    ligand_coords = ligand[['orth_x', 'orth_y', 'orth_z']].to_numpy(dtype=float)
+    low, high = ligand_coords.min(axis=0) - cutoff, ligand_coords.max(axis=0) + cutoff
+    corners = np.array([[x, y, z] for x in (low[0], high[0]) for y in (low[1], high[1]) for z in (low[2], high[2])])
+    corners = crystal.to_fractional(corners)
+    box_low, box_high = corners.min(axis=0), corners.max(axis=0)
+    fractional = crystal.to_fractional(coords)
+    residue_keys = protein[['residue', 'chain', 'res_seq']].astype(str).agg('|'.join, axis=1).to_numpy()
+
+    mates = []
+    for number, (rotation, translation) in enumerate(crystal.operators, start=1):
+        moved = fractional @ rotation.T + translation
+        # Lattice translations that bring each atom into the box, per axis
+        first = np.ceil(box_low - moved).astype(int)
+        last = np.floor(box_high - moved).astype(int)
+        candidates = np.flatnonzero((first <= last).all(axis=1))
+        if not len(candidates):
+            continue
+        first, last = first[candidates], last[candidates]
+        shifts = []
+        for offset in np.ndindex(*(last - first).max(axis=0) + 1):
+            shift = first + offset
+            shifts.append(shift[(shift <= last).all(axis=1)])
+        for shift in map(tuple, np.unique(np.concatenate(shifts), axis=0)):
+            if number == 1 and shift == (0, 0, 0):
+                continue  # the asymmetric unit itself
+            cartesian = crystal.to_cartesian(moved + np.array(shift))
+            inside = np.flatnonzero(((cartesian >= low) & (cartesian <= high)).all(axis=1))
+            if not len(inside):
+                continue
+            atoms = np.isin(residue_keys, residue_keys[inside])
+            mate = protein[atoms].copy()
+            mate[['orth_x', 'orth_y', 'orth_z']] = cartesian[atoms]
+            mate['symmetry'] = f"{number}_{''.join(str(s + 5) for s in shift)}"
+            mates.append(mate)
+
+    if not mates:
+        return protein.iloc[:0].assign(symmetry=pd.Series(dtype=object))
+    mates = pd.concat(mates, ignore_index=True)
+    mates['serial_number'] = np.arange(len(mates)) + (int(protein['serial_number'].max()) + 1 if len(protein) else 1)
+    metrics.count('symmetry_mate_atoms', len(mates))
+    return mates
+
+def with_symmetry_mates(pdbfile, protein, ligand, cutoff, log=print):
+    """
+    `protein` with the symmetry mates near the ligand appended (see `symmetry_mates`).
+
+    Every atom gets a 'symmetry' column, '1_555' for the asymmetric unit; the residue
+    functions of binding_site.py key residues on it, so a residue and its mate stay apart.
+    Files without a CRYST1 record are returned as they are, with a message.
+    """
+    crystal = read_crystal(pdbfile)
+    if crystal is None:
+        log('** no CRYST1 record; symmetry mates are not generated')
+        return protein.assign(symmetry='1_555')
+    mates = symmetry_mates(crystal, protein, ligand, cutoff)
+    log(f'** {crystal.space_group}: {len(mates)} symmetry mate atoms within {cutoff:g} Å of the ligand box')
+    return pd.concat([protein.assign(symmetry='1_555'), mates], ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='list the symmetry mates of a crystal structure near a ligand')
+    parser.add_argument("-i", "--inputpdb", required=True, help='input PDB file in .pdb format, with a CRYST1 record')
+    parser.add_argument("-ht", "--hetatm", required=True, help='ligand HET id in PDB')
+    parser.add_argument("-d", "--distance", type=float, default=3.5, help='binding site distance; default is 3.5Å')
+    args = parser.parse_args()
+
+    from binding_site import split_ligand_protein, residue_distance_table
+    from process_pdb import process_pdb
+
+    ligand, protein, _ = split_ligand_protein(process_pdb(args.inputpdb), args.hetatm)
+    protein = with_symmetry_mates(args.inputpdb, protein, ligand, args.distance)
+    table = residue_distance_table(ligand, protein, args.distance)
+    contacts = table[table['symmetry'] != '1_555']
+    print(f'** {len(contacts)} residues of symmetry mates within {args.distance:g} Å of {args.hetatm}')
+    if not contacts.empty:
+        print(contacts.to_string(index=False, float_format='%.2f'))
@@ -0,0 +1,48 @@
+import numpy as np
+
+# Byte alignment of the arrays handed to the frameworks; TensorFlow only wraps CPU
+# memory aligned to 64 bytes (EIGEN_MAX_ALIGN_BYTES) and copies anything else
+ALIGNMENT = 64
+FRAMEWORKS = ('tensorflow', 'torch')
+
+
+def aligned_zeros(shape, dtype=np.float32, alignment=ALIGNMENT):
+    """
+    A zeroed, C-contiguous array whose data starts on an `alignment`-byte boundary.
+
+    The array is a view into a slightly larger byte buffer, which it keeps alive (as do
+    the tensors wrapped around it with `as_tensor`).
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+    buffer = np.zeros(nbytes + alignment, dtype=np.uint8)
+    offset = -buffer.ctypes.data % alignment
+    return buffer[offset:offset + nbytes].view(dtype).reshape(shape)
+
+def is_aligned(array, alignment=ALIGNMENT):
+    return array.ctypes.data % alignment == 0
+
+def as_tensor(array, framework='tensorflow'):
+    """
+    Wraps a NumPy array as a TensorFlow or PyTorch tensor through DLPack, without copying.
+
+    The tensor shares the memory of `array`, so the array must not be written to while the
+    tensor is in use. Arrays that are not C-contiguous or are read-only (i.e. memory-mapped)
+    are copied first, and TensorFlow copies arrays that are not `ALIGNMENT`-byte aligned
+    (see `aligned_zeros`).
+
+    Args:
+        array (numpy.ndarray): the array.
+        framework (str): 'tensorflow' or 'torch'.
+
+    Returns:
+        tf.Tensor or torch.Tensor
+    """
+    array = np.require(array, requirements='CW')
+    if framework == 'torch':
+        import torch
+        return torch.from_dlpack(array) if hasattr(torch, 'from_dlpack') else torch.from_numpy(array)
+    if framework == 'tensorflow':
+        import tensorflow as tf
+        return tf.experimental.dlpack.from_dlpack(array.__dlpack__())
+    raise ValueError(f"unknown framework {framework!r}, expected one of {', '.join(FRAMEWORKS)}")
@@ -0,0 +1,190 @@
+import numpy as np
+import json
+
+from metrics import metrics
+
+
+class Voxelizer:
+    def __init__(self, datasets, voxel_size=1.0):
+        self.datasets = datasets
+        self.voxel_size = voxel_size
+
+        # Use the provided global_min and global_max
+        self.global_min, self.global_max = self.compute_global_boundaries()
+
+        # Compute voxel grid dimensions
+        self.compute_voxel_dimensions()
+
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Rebuilds a voxelizer from `spec()` (i.e. the grid a model was trained on) without the datasets.
+        """
+        voxelizer = cls.__new__(cls)
+        voxelizer.datasets = []
+        voxelizer.voxel_size = float(spec['voxel_size'])
+        voxelizer.global_min = np.asarray(spec['global_min'], dtype=float)
+        voxelizer.x_dim, voxelizer.y_dim, voxelizer.z_dim = (int(n) for n in spec['shape'])
+        voxelizer.global_max = voxelizer.global_min + np.array(spec['shape']) * voxelizer.voxel_size
+        return voxelizer
+
+    def spec(self):
+        return {'global_min': [float(value) for value in self.global_min], 'shape': [self.x_dim, self.y_dim, self.z_dim], 'voxel_size': self.voxel_size}
+
+    def save_spec(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.spec(), f)
+
+    def compute_global_boundaries(self):
+        # Combine all data points from every dataset to find global min and max
+        all_points = np.vstack([data[:, :3] for data in self.datasets])
+        global_min = np.min(all_points, axis=0)
+        global_max = np.max(all_points, axis=0)
+        return global_min, global_max
+
+    def compute_voxel_dimensions(self):
+        # Calculate voxel grid dimensions based on global min, max, and voxel size
+        self.x_dim = int(np.ceil((self.global_max[0] - self.global_min[0]) / self.voxel_size))
+        self.y_dim = int(np.ceil((self.global_max[1] - self.global_min[1]) / self.voxel_size))
+        self.z_dim = int(np.ceil((self.global_max[2] - self.global_min[2]) / self.voxel_size))
+
+    @metrics.timed('voxelize')
+    def voxelize(self, data):
+        data = np.array(data)
+
+        # Shift data so that global_min corresponds to index 0
+        shifted_data = data[:, :3] - self.global_min
+
+        # Convert coordinates to voxel indices
+        x_indices = np.floor(shifted_data[:, 0] / self.voxel_size).astype(int)
+        y_indices = np.floor(shifted_data[:, 1] / self.voxel_size).astype(int)
+        z_indices = np.floor(shifted_data[:, 2] / self.voxel_size).astype(int)
+
+        # Ensure that indices are within grid dimensions
+        x_indices = np.clip(x_indices, 0, self.x_dim - 1)
+        y_indices = np.clip(y_indices, 0, self.y_dim - 1)
+        z_indices = np.clip(z_indices, 0, self.z_dim - 1)
+
+        # Create an empty voxel grid
+        voxel_grid = np.zeros((self.x_dim, self.y_dim, self.z_dim), dtype=np.float32)
+      
+        # Assign density values to voxel grid
+        for i in range(len(data)):
+            voxel_grid[x_indices[i], y_indices[i], z_indices[i]] = 1
+
+        return voxel_grid
+    
+    def index_array(self, data):
+        """
+        The (n, 3) int32 voxel indices of `indexer`, computed as one array operation.
+        """
+        data = np.asarray(data, dtype=float)
+        indices = np.floor((data[:, :3] - self.global_min) / self.voxel_size).astype(np.int64)
+        return np.clip(indices, 0, np.array([self.x_dim, self.y_dim, self.z_dim]) - 1).astype(np.int32)
+
+    def dense(self, data):
+        """
+        The grid that `tf.sparse.to_dense` builds from `indexer` and `valuer` in TEMP_voxelizer+keras.py:
+        the value (element code) of each atom at its voxel, zero elsewhere.
+        """
+        data = np.asarray(data, dtype=float)
+        grid = np.zeros((self.x_dim, self.y_dim, self.z_dim), dtype=np.float32)
+        indices = self.index_array(data)
+        grid[indices[:, 0], indices[:, 1], indices[:, 2]] = data[:, 3]
+        return grid
+
+    def batch_shape(self, n, channels='last', n_channels=1):
+        """
+        Shape of a batch of `n` grids: (n, x, y, z, n_channels) for channels='last' (Keras),
+        (n, n_channels, x, y, z) for channels='first' (PyTorch) and (n, x, y, z) for None.
+        """
+        grid = (self.x_dim, self.y_dim, self.z_dim)
+        return {'last': (n,) + grid + (n_channels,), 'first': (n, n_channels) + grid, None: (n,) + grid}[channels]
+
+    @metrics.timed('voxelize')
+    def batch(self, datasets, channels='last', out=None):
+        """
+        The `dense` grids of `datasets`, written in place into one batch array.
+
+        The batch is C-contiguous float32 and `tensors.ALIGNMENT`-byte aligned, so it can be
+        handed to TensorFlow or PyTorch with `tensors.as_tensor` without a copy; with one
+        channel, the channel order only changes the shape, not the memory.
+
+        Args:
+            datasets (list of numpy.ndarray): (n_atoms, 4) arrays of coordinates and element code.
+            channels (str): 'last', 'first' or None (no channel axis); see `batch_shape`.
+            out (numpy.ndarray): if given, a zeroed array of `batch_shape` to write into.
+
+        Returns:
+            numpy.ndarray: the batch.
+        """
+        from tensors import aligned_zeros
+
+        if out is None:
+            out = aligned_zeros(self.batch_shape(len(datasets), channels), np.float32)
+        grids = out.reshape(len(datasets), self.x_dim, self.y_dim, self.z_dim)
+        for grid, data in zip(grids, datasets):
+            data = np.asarray(data, dtype=float)
+            indices = self.index_array(data)
+            grid[indices[:, 0], indices[:, 1], indices[:, 2]] = data[:, 3]
+        return out
+
+    def potential(self, coords, charges, cutoff=None, out=None):
+        """
+        The electrostatics channel: the cutoff-truncated potential of charged atoms at the
+        voxel centers (see `electrostatics.potential_grid`), added to `out` when given.
+        """
+        from electrostatics import CUTOFF, potential_grid
+
+        return potential_grid(self, coords, charges, CUTOFF if cutoff is None else cutoff, out)
+
+    def indexer(self, data):
+        data = np.array(data)
+
+        # Shift data so that global_min corresponds to index 0
+        shifted_data = data[:, :3] - self.global_min
+
+        # Convert coordinates to voxel indices
+        x_indices = np.floor(shifted_data[:, 0] / self.voxel_size).astype(int)
+        y_indices = np.floor(shifted_data[:, 1] / self.voxel_size).astype(int)
+        z_indices = np.floor(shifted_data[:, 2] / self.voxel_size).astype(int)
+
+        # Ensure that indices are within grid dimensions
+        x_indices = np.clip(x_indices, 0, self.x_dim - 1)
+        y_indices = np.clip(y_indices, 0, self.y_dim - 1)
+        z_indices = np.clip(z_indices, 0, self.z_dim - 1)
+       
+        indicies = []
+        
+        # Assign density values to voxel grid
+        for i in range(len(data)):
+            indicies.append([x_indices[i], y_indices[i], z_indices[i]])
+
+        return indicies
+    
+    def valuer(self, data):
+        voxel_values_for_grid = []
+        for i in range(len(data)):
+            voxel_values_for_grid.append(data[i,3])
+        return voxel_values_for_grid
+    
+    def revert_voxels_to_coordinates(self, voxel_grid):
+        # Compute voxel centers
+        x_coords = np.linspace(self.global_min[0] + self.voxel_size / 2, 
+                               self.global_max[0] - self.voxel_size / 2, self.x_dim)
+        y_coords = np.linspace(self.global_min[1] + self.voxel_size / 2, 
+                               self.global_max[1] - self.voxel_size / 2, self.y_dim)
+        z_coords = np.linspace(self.global_min[2] + self.voxel_size / 2, 
+                               self.global_max[2] - self.voxel_size / 2, self.z_dim)
+        
+        # Get indices where voxel_grid is not zero
+        nonzero_indices = np.nonzero(voxel_grid)
+        
+        # Extract coordinates and corresponding element values of non-zero voxels
+        coordinates = []
+        for x, y, z in zip(*nonzero_indices):
+            coord = [x_coords[x], y_coords[y], z_coords[z]]
+            density = voxel_grid[x, y, z]
+            coordinates.append(coord + [density])
+        
+        return np.array(coordinates)
@@ -0,0 +1,323 @@
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import metrics
+
+OPS = ('extract', 'job', 'bonds', 'ping', 'stats', 'shutdown')
+# Jobs are run by worker processes forked from the daemon after `preload`, so they start with every module already imported
+_PRELOADED = {}
+
+
+def preload(bonds=True):
+    """
+    Imports the modules and builds the tables the jobs use, once for the daemon.
+
+    numpy, pandas, scipy and the pipeline modules are imported, the featurizer's residue
+    templates are evaluated and the string pool of `structure.py` is filled with the
+    standard residue and atom names. RDKit (for bond jobs) is imported when installed.
+
+    Returns:
+        dict: {module or table: seconds it took}
+    """
+    timings = {}
+    def timed(name, fn):
+        start = time.perf_counter()
+        fn()
+        timings[name] = time.perf_counter() - start
+
+    def pipeline():
+        import numpy, pandas, scipy.spatial, scipy.ndimage
+        import binding_site, process_pdb, structure, job_planner, complex_archive, featurizer
+
+    def tables():
+        from featurizer import _SIDE_CHAINS, _BACKBONE, AMINO_ACIDS, _template_features
+        from structure import POOL
+        for residue in AMINO_ACIDS:
+            POOL.code(residue)
+            for atom_name in {**_BACKBONE, **_SIDE_CHAINS.get(residue, {})}:
+                POOL.code(atom_name)
+                _template_features(f'{residue}|{atom_name}|{atom_name[0]}')
+
+    def rdkit():
+        try:
+            # pdb_pandas only imports these inside the bond functions
+            import pdb_pandas, scipy.spatial.distance
+            from rdkit.Chem import AllChem
+            _PRELOADED['rdkit'] = True
+        except ImportError as e:
+            _PRELOADED['rdkit'] = f'{type(e).__name__}: {e}'
+
+    timed('pipeline', pipeline)
+    timed('tables', tables)
+    if bonds:
+        timed('rdkit', rdkit)
+    _PRELOADED['timings'] = timings
+    return timings
+
+
+def _warm(_):
+    time.sleep(0.05)
+    return os.getpid()
+
+
+class _Log:
+    # Collects the messages `binding_site.extract` prints, for the response
+    def __init__(self):
+        self.lines = []
+
+    def __call__(self, *args):
+        self.lines.append(' '.join(str(arg) for arg in args))
+
+def run_request(request):
+    """
+    Runs one job in the current process.
+
+    Requests are JSON objects with an "op" and an optional "id" that is echoed back:
+        {"op": "extract", "inputpdb": ..., "hetatm": ..., "bindingsite_output": ..., "ligand_output": ...,
+         "distance": [3.5], "center": false, "distance_table": null, "archive": null, "symmetry": false,
+         "sasa": null, "min_sasa": null}
+            the arguments of find_HETATM_1.2.py (`binding_site.extract`)
+        {"op": "job", "job": {...}, "output_dir": ..., "distance": 3.5, "center": false, "archive": null}
+            a job of a job_planner.py manifest (`job_planner.run_job`)
+        {"op": "bonds", "inputpdb": ..., "output": "bonds.pkl"}
+            `pdb_pandas.bonds_protein_df` of a binding site file, pickled to "output"
+
+    Returns:
+        dict: {"id", "op", "ok", "result" or "error", "seconds", "pid"}
+    """
+    start = time.perf_counter()
+    response = {'id': request.get('id'), 'op': request.get('op'), 'pid': os.getpid()}
+    try:
+        op = request.get('op')
+        if op == 'extract':
+            from binding_site import ExtractionError, extract
+            log = _Log()
+            try:
+                distance = request.get('distance', [3.5])
+                result = extract(request['inputpdb'], request['hetatm'], request.get('bindingsite_output'), request.get('ligand_output'),
+                                 distance if isinstance(distance, list) else [distance], request.get('center', False),
+                                 request.get('distance_table'), request.get('archive'), request.get('symmetry', False),
+                                 request.get('sasa'), request.get('min_sasa'), request.get('interactions'), log=log)
+                result['binding_sites'] = {f'{distance:g}': n for distance, n in result['binding_sites'].items()}
+                response.update(ok=True, result=result)
+            except ExtractionError as e:
+                response.update(ok=False, error=str(e))
+            response['log'] = log.lines
+        elif op == 'job':
+            from job_planner import run_job
+            os.makedirs(request['output_dir'], exist_ok=True)
+            result = run_job(request['job'], request['output_dir'], request.get('distance', 3.5), request.get('center', False), request.get('archive'))
+            response.update(ok=not result['failed'] or bool(result['done']), result=result)
+        elif op == 'bonds':
+            from pdb_pandas import process_pdb, bonds_protein_df
+            from se3_prep import ProcessedPDB
+            df = bonds_protein_df(ProcessedPDB(request['inputpdb'], process_pdb(request['inputpdb'])))
+            df.to_pickle(request['output'])
+            response.update(ok=True, result={'atoms': len(df), 'bonds': int(df['bond'].map(len).sum()), 'output': request['output']})
+        else:
+            response.update(ok=False, error=f'unknown op {op!r}; expected one of {", ".join(OPS)}')
+    except Exception as e:
+        response.update(ok=False, error=f'{type(e).__name__}: {e}')
+    response['seconds'] = time.perf_counter() - start
+    return response
+
+
+class Daemon:
+    """
+    A resident pool of extraction workers that takes JSON-lines requests (see `run_request`).
+
+    The heavy modules are imported once in the daemon (`preload`) and the worker processes
+    are forked from it, so a job only costs its own compute. Requests run concurrently on
+    `workers` processes and each response is written as soon as its job is done, tagged
+    with the request "id" (responses may come back out of order).
+
+    Besides the jobs, {"op": "ping"} answers at once, {"op": "stats"} returns the jobs done,
+    the preload timings and the mean job time, and {"op": "shutdown"} stops the daemon
+    after the running jobs.
+
+    Args:
+        workers (int): worker processes.
+        bonds (bool): if True, RDKit is preloaded for bond jobs.
+    """
+    def __init__(self, workers=4, bonds=True):
+        self.started = time.time()
+        self.preload = preload(bonds)
+        # fork keeps the preloaded modules; it is not available on Windows
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        self.executor = ProcessPoolExecutor(workers, mp_context=context)
+        # The workers are started now, before any server thread exists
+        list(self.executor.map(_warm, range(workers)))
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.counts = {'done': 0, 'failed': 0, 'running': 0}
+        self.job_seconds = 0.0
+        self.stopping = threading.Event()
+
+    def stats(self):
+        with self.lock:
+            n = self.counts['done'] + self.counts['failed']
+            return {**self.counts, 'workers': self.workers, 'uptime': time.time() - self.started,
+                    'mean_job_seconds': self.job_seconds / n if n else 0.0, 'preload': self.preload,
+                    'rdkit': _PRELOADED.get('rdkit')}
+
+    def submit(self, request, respond):
+        """
+        Runs a request and calls `respond(response)` when it is done (from another thread for jobs).
+        """
+        op = request.get('op')
+        if op == 'ping':
+            return respond({'id': request.get('id'), 'op': op, 'ok': True})
+        if op == 'stats':
+            return respond({'id': request.get('id'), 'op': op, 'ok': True, 'result': self.stats()})
+        if op == 'shutdown':
+            self.stopping.set()
+            return respond({'id': request.get('id'), 'op': op, 'ok': True})
+
+        queued = time.perf_counter()
+        with self.lock:
+            self.counts['running'] += 1
+        future = self.executor.submit(run_request, request)
+
+        def done(future):
+            try:
+                response = future.result()
+            except Exception as e:
+                # The worker process died
+                response = {'id': request.get('id'), 'op': op, 'ok': False, 'error': f'{type(e).__name__}: {e}', 'seconds': 0.0}
+            response['latency'] = time.perf_counter() - queued
+            with self.lock:
+                self.counts['running'] -= 1
+                self.counts['done' if response['ok'] else 'failed'] += 1
+                self.job_seconds += response['seconds']
+            metrics.count(f'daemon_{op}')
+            respond(response)
+        future.add_done_callback(done)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        metrics.flush()
+
+    def serve_stdio(self, stdin=sys.stdin, stdout=sys.stdout):
+        """
+        Reads requests from `stdin` and writes responses to `stdout`, one JSON object per line, until EOF or shutdown.
+        """
+        write_lock = threading.Lock()
+        def respond(response):
+            with write_lock:
+                stdout.write(json.dumps(response) + '\n')
+                stdout.flush()
+        for line in stdin:
+            if line.strip():
+                self._handle_line(line, respond)
+            if self.stopping.is_set():
+                break
+        self.close()
+
+    def serve_socket(self, path):
+        """
+        Accepts connections on a Unix socket; every connection can send any number of requests.
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                write_lock = threading.Lock()
+                def respond(response):
+                    with write_lock:
+                        try:
+                            self.wfile.write((json.dumps(response) + '\n').encode())
+                            self.wfile.flush()
+                        except OSError:
+                            pass  # the client went away
+                pending = []
+                for line in self.rfile:
+                    if line.strip():
+                        pending.append(daemon._handle_line(line.decode(), respond))
+                    if daemon.stopping.is_set():
+                        break
+                # Keep the connection open until the jobs of this client are answered
+                for event in pending:
+                    event.wait()
+
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        server.daemon_threads = True
+        threading.Thread(target=lambda: (self.stopping.wait(), server.shutdown()), daemon=True).start()
+        print(f'** {self.workers} workers listening on {path}', file=sys.stderr)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(path)
+            self.close()
+
+    def _handle_line(self, line, respond):
+        answered = threading.Event()
+        def respond_once(response):
+            respond(response)
+            answered.set()
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as e:
+            respond_once({'id': None, 'ok': False, 'error': f'invalid JSON: {e}'})
+            return answered
+        self.submit(request, respond_once)
+        return answered
+
+
+def send(path, requests, timeout=None):
+    """
+    Sends requests to a daemon listening on `path` and returns the responses in the order of the requests.
+    """
+    requests = [dict(request, id=request.get('id', i)) for i, request in enumerate(requests)]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(path)
+        client.sendall(''.join(json.dumps(request) + '\n' for request in requests).encode())
+        client.shutdown(socket.SHUT_WR)
+        responses = {}
+        with client.makefile('r') as f:
+            for line in f:
+                response = json.loads(line)
+                responses[response['id']] = response
+    return [responses.get(request['id']) for request in requests]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='resident extraction worker that keeps numpy, pandas, scipy and RDKit loaded between jobs')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve = subparsers.add_parser('serve', help='run the daemon')
+    serve.add_argument("-s", "--socket", required=False, help='Unix socket to listen on; requests are read from stdin when not given')
+    serve.add_argument("-w", "--workers", type=int, default=4, help='worker processes; default is 4')
+    serve.add_argument("--no_bonds", action='store_true', help='if included, RDKit is not preloaded')
+    serve.add_argument("-m", "--metrics", required=False, help='if included, per-job timings are appended to this .jsonl file')
+
+    client = subparsers.add_parser('send', help='send JSON-lines requests (from a file or stdin) to a running daemon')
+    client.add_argument("-s", "--socket", required=True)
+    client.add_argument("requests", nargs='?', help='file of requests, one JSON object per line; default is stdin')
+
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        if args.metrics:
+            metrics.enable(args.metrics)
+        daemon = Daemon(args.workers, bonds=not args.no_bonds)
+        if args.socket:
+            daemon.serve_socket(args.socket)
+        else:
+            daemon.serve_stdio()
+    elif args.command == 'send':
+        lines = open(args.requests) if args.requests else sys.stdin
+        requests = [json.loads(line) for line in lines if line.strip()]
+        for response in send(args.socket, requests):
+            print(json.dumps(response))